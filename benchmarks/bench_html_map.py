@@ -0,0 +1,70 @@
+'''
+Measures WebTreeHandler.get_html_map scaling with the number of nodes.
+
+Image maps are synthetic (one node area and one face per node), so the
+benchmark does not depend on the renderer. Time per node should stay flat
+as the tree grows.
+
+Usage:
+    python benchmarks/bench_html_map.py [--sizes 1000 4000 16000 64000] [--repeat 3]
+'''
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ete3 import Tree
+from ete3_webserver import WebTreeHandler, NodeActions
+
+
+def synthetic_map(handler):
+    img_map = {'nodes' : [], 'faces' : [], 'node_areas' : {}}
+    for nid, node in handler.nodes.items():
+        y = nid * 10.0
+        img_map['node_areas'][nid] = [0.0, y, 200.0, y + 10.0]
+        img_map['nodes'].append([1.0, y, 5.0, y + 4.0, nid, None])
+        if node.is_leaf():
+            img_map['faces'].append([100.0, y, 150.0, y + 10.0, nid, node.name])
+    return img_map
+
+def load_pair(leaves):
+    t = Tree()
+    t.populate(leaves, random_branches=True)
+    newick = t.write()
+    names = t.get_leaf_names()
+    random.shuffle(names)
+    for leaf, name in zip(t.iter_leaves(), names):
+        leaf.name = name
+    actions = NodeActions()
+    h1 = WebTreeHandler(newick, '', 'bench1', actions, None)
+    h2 = WebTreeHandler(t.write(), '', 'bench2', actions, None)
+    # A trivial mapping, the map builder only reads it
+    h1.diffdict['target'] = h2
+    for nid, node in h1.nodes.items():
+        h1.set_diff(node, nid, random.random(), None, None, set())
+    return h1, h2
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000, 16000, 64000], help='number of leaves')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the best one is reported')
+    args = parser.parse_args()
+
+    print("%10s %10s %12s %12s %14s" %('leaves', 'nodes', 'seconds', 'us/node', 'map bytes'))
+    for leaves in args.sizes:
+        h1, h2 = load_pair(leaves)
+        img_map = synthetic_map(h1)
+        target_map = synthetic_map(h2)
+        best = None
+        for _ in range(args.repeat):
+            t1 = time.perf_counter()
+            html_map = h1.get_html_map(img_map, target_map)
+            elapsed = time.perf_counter() - t1
+            best = elapsed if best is None else min(best, elapsed)
+        print("%10d %10d %12.4f %12.2f %14d" %(leaves, len(h1.nodes), best, 1e6 * best / len(h1.nodes), len(html_map)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+'''
+Benchmarks loading, diffing, rendering and map generation end to end.
+
+Every size loads a random tree and a perturbed copy of it (moved leaves and
+swapped leaf names), so treediff has realistic work. The suite times each
+WebTreeHandler stage and each web service, called through an in-process WSGI
+client, and records peak Python memory (tracemalloc, which does not see Qt
+allocations) and payload bytes. Results are written as JSON, and can be
+compared with the results of a previous run.
+
+Usage:
+    python benchmarks/bench_suite.py [--sizes 100 1000 10000] [--repeat 3] [--output results.json]
+                                     [--compare baseline.json]
+'''
+import io
+import os
+import sys
+import gzip
+import json
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import subprocess
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ete3 import Tree, TreeStyle
+from bottle import default_app
+from ete3_webserver import WebTreeHandler, NodeActions
+from ete3_webserver import webapi
+from ete3_webserver.sessions import TreeStore
+from ete3_webserver.compression import compress
+from bench_html_map import synthetic_map
+
+
+def random_pair(leaves, perturb, seed):
+    '''
+    Generates a random tree and a perturbed copy of it
+
+    Parameters:
+        leaves: number of leaves
+        perturb: fraction of leaves moved to another branch, and of leaf names swapped
+        seed: random seed
+
+    Returns:
+        tuple: source and target newick strings
+    '''
+    random.seed(seed)
+    t = Tree()
+    t.populate(leaves, random_branches=True)
+    newick1 = t.write()
+
+    moves = int(leaves * perturb)
+    nodes = [n for n in t.traverse() if n.up]
+    leaves_list = t.get_leaves()
+    for _ in range(moves):
+        leaf = random.choice(leaves_list)
+        parent = leaf.up
+        if parent.up is None:
+            continue
+        leaf.detach()
+        if len(parent.children) == 1:
+            parent.delete(preserve_branch_length=True)
+        target = random.choice(nodes)
+        while target.up is None or target.get_tree_root() is not t:
+            target = random.choice(nodes)
+        # Graft the moved leaf as a sibling of the target branch
+        up = target.up
+        target.detach()
+        graft = up.add_child(dist=target.dist / 2)
+        target.dist /= 2
+        graft.add_child(target)
+        graft.add_child(leaf)
+        nodes.append(graft)
+
+    for _ in range(moves):
+        a, b = random.sample(leaves_list, 2)
+        a.name, b.name = b.name, a.name
+    return newick1, t.write()
+
+def trivial_diff(h1, h2):
+    # Used above --diff-max-leaves, the map builders only read the mapping
+    h1.diffdict['target'] = h2
+    h2.diffdict['target'] = h1
+    for h in (h1, h2):
+        for nid, node in h.nodes.items():
+            h.set_diff(node, nid, random.random(), None, None, set())
+
+def measure(fn, traced):
+    '''
+    Runs a stage
+
+    Parameters:
+        fn: stage function
+        traced: whether to record the peak memory, with tracemalloc already started
+
+    Returns:
+        tuple: stage result, seconds and peak bytes allocated by the stage, or None
+    '''
+    if traced:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+    t1 = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t1
+    peak = tracemalloc.get_traced_memory()[1] - base if traced else None
+    return result, elapsed, peak
+
+def run_stages(newick1, newick2, args, render, traced):
+    '''
+    Loads, diffs, renders and maps a tree pair, stage by stage
+
+    Parameters:
+        newick1: source tree, as newick string
+        newick2: target tree, as newick string
+        args: command line arguments
+        render: whether to render the trees, synthetic image maps are used otherwise
+        traced: whether to record the peak memory of every stage
+
+    Returns:
+        OrderedDict: stage name -> seconds, peak bytes and payload bytes
+    '''
+    stats = OrderedDict()
+    def stage(name, fn):
+        result, elapsed, peak = measure(fn, traced)
+        size = len(result) if isinstance(result, (bytes, str)) else None
+        stats[name] = {'seconds' : elapsed, 'peak_bytes' : peak, 'payload_bytes' : size}
+        return result
+
+    actions = NodeActions()
+    style = TreeStyle()
+    h1 = stage('parse_source', lambda: WebTreeHandler(newick1, '', 'bench1', actions, style))
+    h2 = stage('parse_target', lambda: WebTreeHandler(newick2, '', 'bench2', actions, style))
+    if args.diff_max_leaves and len(h1.tree) > args.diff_max_leaves:
+        trivial_diff(h1, h2)
+    else:
+        stage('diff', lambda: h1.diff(h2, symmetric=True))
+
+    if render:
+        _, map1 = stage('render_source', h1.render)
+        _, map2 = stage('render_target', h2.render)
+        stage('redraw', lambda: h1.redraw('tree_image/bench1/0'))
+        stage('image', lambda: h1.get_image()[0])
+    else:
+        map1, map2 = synthetic_map(h1), synthetic_map(h2)
+
+    html = stage('html_map', lambda: h1.get_html_map(map1, map2))
+    geometry = stage('geometry', lambda: h1.get_geometry(map1, map2))
+    text = stage('json', lambda: json.dumps(geometry, separators=(',', ':')))
+    stage('gzip_html', lambda: compress(html.encode('utf-8'), 'gzip', args.compress_level))
+    stage('gzip_json', lambda: compress(text.encode('utf-8'), 'gzip', args.compress_level))
+    return stats
+
+
+class WSGIClient(object):
+    '''
+    Calls a WSGI application in process, without a server or sockets
+    '''
+    def __init__(self, app, headers=None):
+        self.app = app
+        self.headers = headers or {}
+
+    def request(self, method, path, params=None, files=None):
+        '''
+        Sends a request
+
+        Parameters:
+            self: self handler
+            method: GET or POST
+            path: request path
+            params: query or form params, as dict
+            files: files uploaded in a multipart POST, as dict of name -> (filename, bytes)
+
+        Returns:
+            tuple: status code, response headers, as dict, and body, as bytes
+        '''
+        query = urlencode(params or {})
+        body = query.encode('utf-8') if method == 'POST' else b''
+        content_type = 'application/x-www-form-urlencoded'
+        if files:
+            boundary = 'bench%016x' %random.getrandbits(64)
+            parts = []
+            for name, value in (params or {}).items():
+                parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n'
+                              %(boundary, name, value)).encode('utf-8'))
+            for name, (filename, data) in files.items():
+                parts.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                              'Content-Type: application/octet-stream\r\n\r\n' %(boundary, name, filename)).encode('utf-8'))
+                parts.append(data + b'\r\n')
+            parts.append(('--%s--\r\n' %boundary).encode('utf-8'))
+            body = b''.join(parts)
+            content_type = 'multipart/form-data; boundary=%s' %boundary
+        environ = {'REQUEST_METHOD' : method, 'PATH_INFO' : path, 'SCRIPT_NAME' : '',
+                   'QUERY_STRING' : '' if method == 'POST' else query,
+                   'SERVER_NAME' : 'localhost', 'SERVER_PORT' : '80', 'SERVER_PROTOCOL' : 'HTTP/1.1',
+                   'CONTENT_TYPE' : content_type, 'CONTENT_LENGTH' : str(len(body)),
+                   'wsgi.input' : io.BytesIO(body), 'wsgi.errors' : sys.stderr, 'wsgi.url_scheme' : 'http',
+                   'wsgi.version' : (1, 0), 'wsgi.multithread' : False, 'wsgi.multiprocess' : False,
+                   'wsgi.run_once' : False}
+        for name, value in self.headers.items():
+            environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+        result = {}
+        def start_response(status, headers, exc_info=None):
+            result['status'] = int(status.split()[0])
+            result['headers'] = dict(headers)
+        chunks = self.app(environ, start_response)
+        try:
+            data = b''.join(chunks)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+        return result['status'], result['headers'], data
+
+def configure_webapi(args):
+    # The state start_server sets up, without running a server
+    webapi.DEFAULT_ACTIONS = NodeActions()
+    webapi.DEFAULT_STYLE = TreeStyle()
+    webapi.LOADED_TREES = TreeStore()
+    webapi.DIFF_CACHE = None
+    webapi.COMPRESS_CACHE.max_entries = 0
+    webapi.COMPRESS_CACHE.level = args.compress_level
+
+def run_endpoints(newick1, newick2, args, render):
+    '''
+    Calls the web services with a tree pair through an in-process WSGI client
+
+    Parameters:
+        newick1: source tree, as newick string
+        newick2: target tree, as newick string
+        args: command line arguments
+        render: whether to call the web services that render trees
+
+    Returns:
+        OrderedDict: web service name -> seconds, status, payload bytes and content encoding
+    '''
+    client = WSGIClient(default_app(), {'Accept-Encoding' : 'gzip'})
+    pair = {'newick1' : newick1, 'treeid1' : 'bench1', 'newick2' : newick2, 'treeid2' : 'bench2'}
+    # Large trees only fit in multipart uploads, form params are limited to bottle's MEMFILE_MAX
+    uploads = {'newick1' : ('tree1.nw.gz', gzip.compress(newick1.encode('utf-8'), 1)),
+               'newick2' : ('tree2.nw.gz', gzip.compress(newick2.encode('utf-8'), 1))}
+    calls = [('load_trees', 'POST', '/load_trees', pair),
+             ('upload_trees', 'POST', '/load_trees', ({'treeid1' : 'bench1', 'treeid2' : 'bench2'}, uploads))]
+    if render:
+        calls += [('load_and_draw', 'POST', '/load_and_draw', pair),
+                  ('tree_geometry', 'GET', '/tree_geometry', {'treeid' : 'bench1'}),
+                  ('tree_image', 'GET', '/tree_image/bench1', None),
+                  ('draw_tree', 'POST', '/draw_tree', {'treeid' : 'bench1'}),
+                  ('search', 'GET', '/search', {'treeid' : 'bench1', 'q' : 'a'})]
+    calls += [('get_actions', 'POST', '/get_actions', {'treeid' : 'bench1', 'nodeid' : '0'}),
+              ('get_dist', 'POST', '/get_dist', {'treeid' : 'bench1', 'nodeid' : '0'}),
+              ('metrics', 'GET', '/metrics', None)]
+
+    stats = OrderedDict()
+    for name, method, path, params in calls:
+        best = None
+        for _ in range(args.repeat):
+            t1 = time.perf_counter()
+            status, headers, body = client.request(method, path, *(params if isinstance(params, tuple) else (params,)))
+            elapsed = time.perf_counter() - t1
+            best = elapsed if best is None else min(best, elapsed)
+        stats[name] = {'seconds' : best, 'status' : status, 'payload_bytes' : len(body),
+                       'encoding' : headers.get('Content-Encoding')}
+    return stats
+
+def best_stages(runs):
+    # Fastest time of every stage over the runs, peak memory from the traced run
+    stats = OrderedDict()
+    for run in runs:
+        for name, values in run.items():
+            best = stats.setdefault(name, dict(values))
+            best['seconds'] = min(best['seconds'], values['seconds'])
+            if values['peak_bytes'] is not None:
+                best['peak_bytes'] = values['peak_bytes']
+    return stats
+
+def environment():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+                                         cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    import ete3
+    return {'python' : platform.python_version(), 'platform' : platform.platform(),
+            'ete3' : getattr(ete3, '__version__', None), 'commit' : commit,
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(results, baseline):
+    '''
+    Prints the time ratio of every stage and web service against a previous run
+
+    Parameters:
+        results: results of this run
+        baseline: results of the previous run, as loaded from its JSON output
+
+    Returns:
+        None
+    '''
+    previous = dict((run['leaves'], run) for run in baseline['results'])
+    print("\n%10s %-16s %12s %12s %8s" %('leaves', 'stage', 'before', 'after', 'ratio'))
+    for run in results['results']:
+        before = previous.get(run['leaves'])
+        if before is None:
+            continue
+        for kind in ('stages', 'endpoints'):
+            for name, values in run[kind].items():
+                old = before.get(kind, {}).get(name)
+                if not old or not old['seconds']:
+                    continue
+                print("%10d %-16s %12.4f %12.4f %8.2f" %(run['leaves'], name, old['seconds'], values['seconds'],
+                                                       values['seconds'] / old['seconds']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000], help='number of leaves, up to 100000')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per size, the best one is reported')
+    parser.add_argument('--perturb', type=float, default=0.05, help='fraction of leaves moved and renamed in the target tree')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--render-max-leaves', type=int, default=20000, help='larger trees are not rendered, synthetic image maps are used')
+    parser.add_argument('--diff-max-leaves', type=int, default=None, help='larger trees are not diffed, a trivial mapping is used')
+    parser.add_argument('--compress-level', type=int, default=6, help='gzip compression level')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run measuring peak memory')
+    parser.add_argument('--no-endpoints', action='store_true', help='skip the web services')
+    parser.add_argument('--output', help='JSON results file')
+    parser.add_argument('--compare', help='JSON results file of a previous run')
+    args = parser.parse_args()
+
+    configure_webapi(args)
+    results = {'environment' : environment(), 'args' : vars(args), 'results' : []}
+    print("%10s %-16s %12s %14s %14s %8s" %('leaves', 'stage', 'seconds', 'peak bytes', 'payload bytes', 'status'))
+    for leaves in args.sizes:
+        newick1, newick2 = random_pair(leaves, args.perturb, args.seed + leaves)
+        render = leaves <= args.render_max_leaves
+
+        runs = [run_stages(newick1, newick2, args, render, False) for _ in range(args.repeat)]
+        if not args.no_memory:
+            tracemalloc.start()
+            try:
+                runs.append(run_stages(newick1, newick2, args, render, True))
+            finally:
+                tracemalloc.stop()
+        stages = best_stages(runs)
+        endpoints = OrderedDict() if args.no_endpoints else run_endpoints(newick1, newick2, args, render)
+
+        for name, values in list(stages.items()) + list(endpoints.items()):
+            print("%10d %-16s %12.4f %14s %14s %8s" %(leaves, name, values['seconds'],
+                                                      '-' if values.get('peak_bytes') is None else values['peak_bytes'],
+                                                      '-' if values['payload_bytes'] is None else values['payload_bytes'],
+                                                      values.get('status', '-')))
+        results['results'].append({'leaves' : leaves, 'perturbed' : int(leaves * args.perturb), 'rendered' : render, 'stages' : stages, 'endpoints' : endpoints})
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(results, fh, indent=1)
+    if args.compare:
+        with open(args.compare) as fh:
+            compare(results, json.load(fh))
+
+if __name__ == '__main__':
+    main()
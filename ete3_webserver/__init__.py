@@ -1,4 +1,5 @@
 from .webapi import start_server
 from .tree_handler import WebTreeHandler, NodeActions
+from .matrix import diff_matrix
 
-__all__ = ['start_server', 'WebTreeHandler', 'NodeActions']
+__all__ = ['start_server', 'WebTreeHandler', 'NodeActions', 'diff_matrix']
@@ -0,0 +1,129 @@
+import gzip
+import zlib
+import time
+import hashlib
+import threading
+import logging as log
+from collections import OrderedDict
+
+from .metrics import phase
+
+
+# Supported content encodings, by server preference
+ENCODINGS = ['gzip', 'deflate']
+
+def negotiate(accept_encoding):
+    '''
+    Chooses the response content encoding from an Accept-Encoding header
+
+    Parameters:
+        accept_encoding: Accept-Encoding request header, as string
+
+    Returns:
+        string: content encoding, or None if the client accepts no supported encoding
+    '''
+    accepted = dict()
+    for item in (accept_encoding or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+
+    best = None
+    for coding in ENCODINGS:
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > 0 and (best is None or q > best[1]):
+            best = (coding, q)
+    return best[0] if best else None
+
+def compress(data, encoding, level=6):
+    '''
+    Compresses a response body
+
+    Parameters:
+        data: body, as bytes
+        encoding: content encoding, 'gzip' or 'deflate'
+        level: compression level, from 1 (fastest) to 9 (smallest)
+
+    Returns:
+        bytes: compressed body
+    '''
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == 'deflate':
+        return zlib.compress(data, level)
+    raise ValueError('unsupported content encoding %s' %encoding)
+
+
+class CompressionCache(object):
+    '''
+    Size bounded LRU cache of compressed response bodies, keyed by content digest,
+    encoding and level, so identical responses are only compressed once
+    '''
+    def __init__(self, max_entries=64, level=6):
+        self.max_entries = max_entries
+        self.level = level
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def compress(self, data, encoding):
+        '''
+        Compresses a response body, reusing the cached result of identical bodies
+
+        Parameters:
+            self: self handler
+            data: body, as bytes
+            encoding: content encoding, 'gzip' or 'deflate'
+
+        Returns:
+            bytes: compressed body
+        '''
+        key = (hashlib.sha1(data).digest(), encoding, self.level)
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                log.info('returning cached %s %0.3f KB' %(encoding, len(body)/1024.))
+                return body
+            self.misses += 1
+
+        start = time.time()
+        with phase('compress'):
+            body = compress(data, encoding, self.level)
+        log.info('compressed %0.3f KB to %0.3f KB with %s level %d (ratio %0.2f) in %0.4f secs' %(
+            len(data)/1024., len(body)/1024., encoding, self.level, len(body)/float(len(data) or 1), time.time() - start))
+
+        if self.max_entries:
+            with self._lock:
+                self._entries[key] = body
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return body
+
+    def clear(self):
+        '''
+        Empties the cache
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,192 @@
+import os
+import sys
+import pickle
+import hashlib
+import tempfile
+import threading
+import logging as log
+from collections import OrderedDict
+
+
+def content_digest(*texts):
+    '''
+    Calculates a digest identifying the given texts
+
+    Parameters:
+        texts: texts to digest, as strings
+
+    Returns:
+        string: hexadecimal sha1 digest
+    '''
+    h = hashlib.sha1()
+    for text in texts:
+        text = text or ''
+        h.update(str(len(text)).encode('utf-8'))
+        h.update(b':')
+        h.update(text.encode('utf-8'))
+    return h.hexdigest()
+
+def _describe(value):
+    if callable(value):
+        return "%s.%s" %(getattr(value, '__module__', ''), getattr(value, '__qualname__', getattr(value, '__name__', repr(value))))
+    return repr(value)
+
+def _rows_size(rows):
+    # Nodes observe the same attribute values, so shared objects are only counted once
+    seen = set()
+    size = 0
+    stack = [rows]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+    return size
+
+
+class DiffCache(object):
+    '''
+    Content addressed cache of treediff results, with a LRU memory tier bounded by number
+    of results and estimated bytes, and an optional on-disk tier
+    '''
+    def __init__(self, max_entries=128, cache_dir=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict() # key -> (rows, estimated size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, source_digest, target_digest, params):
+        '''
+        Generates the cache key of a tree comparison
+
+        Parameters:
+            self: self handler
+            source_digest: digest of the source newick and alignment, as string
+            target_digest: digest of the target newick and alignment, as string
+            params: treediff parameters, as dict
+
+        Returns:
+            string: cache key
+        '''
+        desc = ';'.join("%s=%s" %(name, _describe(params[name])) for name in sorted(params))
+        return content_digest(source_digest, target_digest, desc)
+
+    def get(self, key):
+        '''
+        Fetches a cached treediff result
+
+        Parameters:
+            self: self handler
+            key: cache key, as string
+
+        Returns:
+            list: treediff rows, or None when the comparison is not cached
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+
+        rows = self._load(key)
+        with self._lock:
+            if rows is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, rows)
+        return rows
+
+    def put(self, key, rows):
+        '''
+        Stores a treediff result
+
+        Parameters:
+            self: self handler
+            key: cache key, as string
+            rows: treediff rows, as list of (source nid, target nid, distance, side1, side2, diff) tuples
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            self._store(key, rows)
+        self._dump(key, rows)
+
+    def clear(self):
+        '''
+        Empties the memory tier
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def memory_usage(self):
+        '''
+        Estimates the memory used by the results held by the memory tier
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            integer: size in bytes
+        '''
+        return self._bytes
+
+    def _store(self, key, rows):
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[1]
+        size = _rows_size(rows)
+        self._entries[key] = (rows, size)
+        self._bytes += size
+        # The newest result is kept even if larger than max_bytes
+        while len(self._entries) > 1 and ((self.max_entries and len(self._entries) > self.max_entries)
+                                          or (self.max_bytes is not None and self._bytes > self.max_bytes)):
+            self._bytes -= self._entries.popitem(last=False)[1][1]
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._path(key), 'rb') as fh:
+                return pickle.load(fh)
+        except (IOError, OSError):
+            return None
+        except Exception as e:
+            log.warning('discarding unreadable diff cache entry %s: %s' %(key, e))
+            return None
+
+    def _dump(self, key, rows):
+        if not self.cache_dir:
+            return
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(rows, fh, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except Exception as e:
+            log.warning('could not write diff cache entry %s: %s' %(key, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
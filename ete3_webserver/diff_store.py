@@ -0,0 +1,291 @@
+import sys
+import math
+from array import array
+
+
+_FIELDS = ('target_nodeid', 'distance', 'side1', 'side2', 'diff')
+_EMPTY = frozenset()
+
+
+class DiffView(object):
+    '''
+    Read-only view of the diff data of a node, used as a dict with target_nodeid, distance,
+    side1, side2 and diff keys. Views are pickled together with their store, use snapshot
+    to pickle the data of some nodes only
+    '''
+    __slots__ = ('store', 'nid')
+
+    def __init__(self, store, nid):
+        self.store = store
+        self.nid = nid
+
+    def __getitem__(self, key):
+        return self.store.get_field(self.nid, key)
+
+    def get(self, key, default=None):
+        return self[key] if key in _FIELDS else default
+
+    def __contains__(self, key):
+        return key in _FIELDS
+
+    def __iter__(self):
+        return iter(_FIELDS)
+
+    def __len__(self):
+        return len(_FIELDS)
+
+    def keys(self):
+        return list(_FIELDS)
+
+    def values(self):
+        return [self[key] for key in _FIELDS]
+
+    def items(self):
+        return [(key, self[key]) for key in _FIELDS]
+
+    def __eq__(self, other):
+        try:
+            return dict(self.items()) == dict(other.items())
+        except AttributeError:
+            return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+    def snapshot(self, sides=False):
+        '''
+        Copies the diff data of the node, detached from the store
+
+        Parameters:
+            self: self handler
+            sides: whether to also copy side1 and side2, the observed attributes under both
+                nodes, which hold as many values as leaves, as boolean
+
+        Returns:
+            dict: diff data of the node
+        '''
+        keys = _FIELDS if sides else ('target_nodeid', 'distance', 'diff')
+        return dict((key, self[key]) for key in keys)
+
+    def __getstate__(self):
+        return (self.store, self.nid)
+
+    def __setstate__(self, state):
+        self.store, self.nid = state
+
+
+class DiffStore(object):
+    '''
+    Columnar store of the diff data of the nodes of a tree, indexed by node internal ID.
+    Target node IDs and distances are kept in arrays, and leaf sets are interned frozensets
+    shared by every node with the same content. Reading a node returns a DiffView
+    '''
+    def __init__(self):
+        self._target = array('l')
+        self._distance = array('d') # NaN when unmatched
+        self._side1 = []
+        self._side2 = []
+        self._diff = []
+        self._present = bytearray()
+        self._sets = dict()
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, nid):
+        nid = int(nid)
+        return 0 <= nid < len(self._present) and self._present[nid] == 1
+
+    def __iter__(self):
+        present = self._present
+        return (nid for nid in range(len(present)) if present[nid])
+
+    def __getitem__(self, nid):
+        nid = int(nid)
+        if nid not in self:
+            raise KeyError(nid)
+        return DiffView(self, nid)
+
+    def items(self):
+        return ((nid, DiffView(self, nid)) for nid in self)
+
+    def get_field(self, nid, key):
+        '''
+        Fetches a diff field of a node
+
+        Parameters:
+            self: self handler
+            nid: node internal ID, as integer
+            key: target_nodeid, distance, side1, side2 or diff
+
+        Returns:
+            field value, distance is None for unmatched nodes
+        '''
+        if nid not in self:
+            raise KeyError(nid)
+        if key == 'target_nodeid':
+            return self._target[nid]
+        if key == 'distance':
+            return self.distance(nid)
+        if key == 'side1':
+            return self._side1[nid]
+        if key == 'side2':
+            return self._side2[nid]
+        if key == 'diff':
+            return self._diff[nid]
+        raise KeyError(key)
+
+    def target_nodeid(self, nid):
+        '''
+        Fetches the internal ID of the target node matched with a node
+
+        Parameters:
+            self: self handler
+            nid: node internal ID, as integer
+
+        Returns:
+            integer: target node internal ID, -1 when unmatched
+        '''
+        return self._target[nid]
+
+    def distance(self, nid):
+        '''
+        Fetches the distance between a node and its matched target node
+
+        Parameters:
+            self: self handler
+            nid: node internal ID, as integer
+
+        Returns:
+            float: distance, or None when unmatched
+        '''
+        dist = self._distance[nid]
+        return None if math.isnan(dist) else dist
+
+    def set(self, nid, target_nodeid=-1, dist=None, side1=None, side2=None, diff=None):
+        '''
+        Stores the diff data of a node, the empty diff when only the node ID is given
+
+        Parameters:
+            self: self handler
+            nid: node internal ID, as integer
+            target_nodeid: internal ID of the matched node in the target tree, as integer
+            dist: distance between both nodes, as float
+            side1: observed attributes under the node, as set
+            side2: observed attributes under the matched node, as set
+            diff: attribute differences between both nodes, as set
+
+        Returns:
+            DiffView: read-only view of the node diff data
+        '''
+        nid = int(nid)
+        missing = nid + 1 - len(self._present)
+        if missing > 0:
+            self._target.extend([-1] * missing)
+            self._distance.extend([math.nan] * missing)
+            self._side1.extend([None] * missing)
+            self._side2.extend([None] * missing)
+            self._diff.extend([_EMPTY] * missing)
+            self._present.extend(bytes(missing))
+
+        if not self._present[nid]:
+            self._present[nid] = 1
+            self._len += 1
+        self._target[nid] = int(target_nodeid)
+        self._distance[nid] = math.nan if dist is None else float(dist)
+        self._side1[nid] = self.intern(side1)
+        self._side2[nid] = self.intern(side2)
+        self._diff[nid] = self.intern(diff) if diff is not None else _EMPTY
+        return DiffView(self, nid)
+
+    def set_target_nodeid(self, nid, target_nodeid):
+        '''
+        Changes the matched target node of a node
+
+        Parameters:
+            self: self handler
+            nid: node internal ID, as integer
+            target_nodeid: internal ID of the matched node in the target tree, as integer
+
+        Returns:
+            None
+        '''
+        if nid not in self:
+            raise KeyError(nid)
+        self._target[nid] = int(target_nodeid)
+
+    def pop(self, nid, default=None):
+        '''
+        Removes the diff data of a node
+
+        Parameters:
+            self: self handler
+            nid: node internal ID, as integer
+            default: value returned when the node is not stored
+
+        Returns:
+            dict: removed diff data, or default
+        '''
+        if nid not in self:
+            return default
+        entry = dict(DiffView(self, nid).items())
+        nid = int(nid)
+        self._present[nid] = 0
+        self._len -= 1
+        self._target[nid] = -1
+        self._distance[nid] = math.nan
+        self._side1[nid] = self._side2[nid] = None
+        self._diff[nid] = _EMPTY
+        return entry
+
+    def intern(self, values):
+        '''
+        Returns the shared frozenset equal to the given set
+
+        Parameters:
+            self: self handler
+            values: set of observed attributes, or None
+
+        Returns:
+            frozenset: interned set, or None
+        '''
+        if values is None:
+            return None
+        values = frozenset(values)
+        return self._sets.setdefault(values, values)
+
+    def compact(self):
+        '''
+        Drops interned sets no longer used by any node
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            None
+        '''
+        used = set(id(s) for column in (self._side1, self._side2, self._diff) for s in column if s is not None)
+        self._sets = dict((s, s) for s in self._sets if id(s) in used)
+
+    def memory_usage(self):
+        '''
+        Estimates the memory used by the store
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            integer: size in bytes
+        '''
+        size = sys.getsizeof(self) + sys.getsizeof(self._present) + sys.getsizeof(self._sets)
+        for column in (self._target, self._distance, self._side1, self._side2, self._diff):
+            size += sys.getsizeof(column)
+        # Set members are the node attributes, accounted with the tree
+        for values in self._sets:
+            size += sys.getsizeof(values)
+        return size
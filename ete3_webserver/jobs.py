@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import logging as log
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .tree_handler import id_generator
+
+
+class JobManager(object):
+    '''
+    Runs background jobs and keeps track of their phase and progress. When a state
+    directory is given, job status is also stored there so every server worker can report it.
+    Job results are returned once: they are dropped when fetched, when older than result_ttl
+    or, oldest first, when the retained results are larger than max_result_bytes
+    '''
+    def __init__(self, workers=2, state_dir=None, max_jobs=1000, result_ttl=600, max_result_bytes=256 << 20):
+        self.state_dir = state_dir
+        self.max_jobs = max_jobs
+        self.result_ttl = result_ttl
+        self.max_result_bytes = max_result_bytes
+        self._jobs = OrderedDict()
+        self._results = OrderedDict() # jobid -> (finish time, JSON size) of retained results
+        self._result_bytes = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(workers)
+        if state_dir and not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+
+    def submit(self, fn, *args, **kargs):
+        '''
+        Queues a job
+
+        Parameters:
+            self: self handler
+            fn: job function, called with a progress(phase, fraction) function followed by args and kargs,
+                whose return value, if any, is reported as the JSON serializable job result
+
+        Returns:
+            string: job id
+        '''
+        jobid = "job_" + id_generator(12)
+        self._update(jobid, 'queued', 0.0, created=time.time())
+        self._executor.submit(self._run, jobid, fn, args, kargs)
+        return jobid
+
+    def status(self, jobid):
+        '''
+        Fetches the status of a job. The result of a finished job is dropped once fetched, later
+        fetches report why it is missing in result_dropped
+
+        Parameters:
+            self: self handler
+            jobid: job id, as string
+
+        Returns:
+            dict: job id, phase, progress, done, error and result, or None for unknown jobs
+        '''
+        with self._lock:
+            dropped = self._expire_results()
+            status = self._jobs.get(jobid)
+            if status is not None:
+                status = dict(status)
+                if jobid in self._results:
+                    dropped.append(self._drop_result(jobid, 'fetched'))
+        self._store(dropped)
+        if status is not None:
+            return status
+
+        if self.state_dir:
+            # Jobs run by other server workers
+            try:
+                with open(self._file(jobid)) as fh:
+                    status = json.load(fh)
+            except (IOError, OSError, ValueError):
+                return None
+            if status.get('result') is not None:
+                self._store([dict(status, result=None, result_dropped='fetched')])
+            return status
+        return None
+
+    def _run(self, jobid, fn, args, kargs):
+        def progress(phase, fraction):
+            self._update(jobid, phase, fraction)
+
+        try:
+            result = fn(progress, *args, **kargs)
+        except Exception as e:
+            log.exception('job %s failed' %jobid)
+            self._update(jobid, 'failed', 1.0, done=True, error=str(e))
+        else:
+            size = len(json.dumps(result)) if result is not None else 0
+            self._update(jobid, 'done', 1.0, result_size=size, done=True, result=result)
+
+    def _update(self, jobid, phase, fraction, result_size=None, **fields):
+        with self._lock:
+            status = self._jobs.setdefault(jobid, {'jobid' : jobid, 'done' : False, 'error' : None, 'result' : None})
+            status.update(fields)
+            status['phase'] = phase
+            status['progress'] = round(fraction, 3)
+            status['elapsed'] = round(time.time() - status['created'], 3)
+            if result_size is not None and status['result'] is not None:
+                self._results[jobid] = (time.time(), result_size)
+                self._result_bytes += result_size
+            while len(self._jobs) > self.max_jobs:
+                old_jobid, _ = self._jobs.popitem(last=False)
+                if old_jobid in self._results:
+                    self._result_bytes -= self._results.pop(old_jobid)[1]
+                if self.state_dir and os.path.exists(self._file(old_jobid)):
+                    os.remove(self._file(old_jobid))
+            dropped = self._expire_results()
+            status = dict(status)
+
+        self._store(dropped + [status])
+
+    def _expire_results(self):
+        # Results are retained in finish order, so the oldest ones are dropped first. The
+        # newest result is kept even if larger than max_result_bytes, until it expires
+        dropped = []
+        now = time.time()
+        while self._results:
+            jobid, (finished, size) = next(iter(self._results.items()))
+            if self.result_ttl is not None and now - finished > self.result_ttl:
+                dropped.append(self._drop_result(jobid, 'expired'))
+            elif self.max_result_bytes is not None and self._result_bytes > self.max_result_bytes and len(self._results) > 1:
+                dropped.append(self._drop_result(jobid, 'evicted'))
+            else:
+                break
+        return dropped
+
+    def _drop_result(self, jobid, reason):
+        self._result_bytes -= self._results.pop(jobid)[1]
+        status = self._jobs[jobid]
+        status['result'] = None
+        status['result_dropped'] = reason
+        log.info('dropped result of job %s, %s' %(jobid, reason))
+        return dict(status)
+
+    def _store(self, statuses):
+        if not self.state_dir:
+            return
+        for status in statuses:
+            fd, tmp_path = tempfile.mkstemp(dir=self.state_dir, suffix='.tmp')
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(status, fh)
+            os.replace(tmp_path, self._file(status['jobid']))
+
+    def _file(self, jobid):
+        return os.path.join(self.state_dir, jobid + '.json')
@@ -0,0 +1,88 @@
+import os
+import time
+import logging as log
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from .tree_handler import diff_params, diff_rows
+
+# Trees compared by the current matrix worker process
+_TREES = None
+
+def _init_worker(trees):
+    global _TREES
+    _TREES = trees
+
+def _diff_pair(i, j, params):
+    return i, j, diff_rows(_TREES[i], _TREES[j], **params)
+
+def summarize(rows):
+    '''
+    Summarizes the treediff result of a tree pair
+
+    Parameters:
+        rows: treediff rows, as list of (source nid, target nid, distance, side1, side2, diff) tuples
+
+    Returns:
+        dict: mean and maximum best match distance of the reference nodes, number of
+            compared nodes and number of perfectly matched nodes
+    '''
+    dists = [float(row[2]) for row in rows if row[2] is not None]
+    return {'dist' : sum(dists) / len(dists) if dists else None,
+            'max_dist' : max(dists) if dists else None,
+            'nodes' : len(rows),
+            'matches' : sum(1 for dist in dists if dist == 0)}
+
+def diff_matrix(handlers, workers=None, cache=None, **params):
+    '''
+    Compares every pair of trees, running the treediffs in parallel worker processes.
+    Every tree is parsed once, by its handler, and pair results are yielded as soon as
+    they are ready. Results are stored in the diff cache, so the pairs can be loaded
+    later without computing the treediff again
+
+    Parameters:
+        handlers: loaded trees, as list of tree handler objects
+        workers: number of worker processes, the number of CPUs if not given, 1 runs in process
+        cache: treediff results cache, as DiffCache
+        params: treediff parameters, as accepted by diff_params
+
+    Returns:
+        generator: (source index, target index, summary dict) tuples, for every source index lower
+            than its target index, in completion order
+    '''
+    params = diff_params(**params)
+    pairs = [(i, j) for i in range(len(handlers)) for j in range(i + 1, len(handlers))]
+    trees = [h.tree for h in handlers]
+    workers = workers or os.cpu_count() or 1
+
+    def done(i, j, rows):
+        if cache is not None:
+            cache.put(cache.key(handlers[i].source_digest, handlers[j].source_digest, params), rows)
+        return i, j, summarize(rows)
+
+    todo = []
+    for i, j in pairs:
+        rows = None
+        if cache is not None:
+            rows = cache.get(cache.key(handlers[i].source_digest, handlers[j].source_digest, params))
+        if rows is None:
+            todo.append((i, j))
+        else:
+            yield i, j, summarize(rows)
+
+    t1 = time.time()
+    if workers == 1 or len(todo) < 2:
+        for i, j in todo:
+            yield done(i, j, diff_rows(trees[i], trees[j], **params))
+    else:
+        # Forked workers inherit the parsed trees instead of receiving them with every pair
+        executor = ProcessPoolExecutor(min(workers, len(todo)), mp_context=mp.get_context('fork'),
+                                       initializer=_init_worker, initargs=(trees,))
+        try:
+            futures = [executor.submit(_diff_pair, i, j, params) for i, j in todo]
+            for future in as_completed(futures):
+                yield done(*future.result())
+        finally:
+            # Pending pairs are dropped when the consumer stops early
+            executor.shutdown(wait=True, cancel_futures=True)
+    log.info('compared %d tree pairs (%d cached) in %0.3f secs' %(len(pairs), len(pairs) - len(todo), time.time() - t1))
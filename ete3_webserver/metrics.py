@@ -0,0 +1,313 @@
+import os
+import time
+import uuid
+import re
+import bisect
+import cProfile
+import threading
+import logging as log
+from functools import wraps
+from contextlib import contextmanager
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1024, 10240, 102400, 1048576, 10485760, 104857600)
+# Request ids given by clients are kept if safe to use in file names
+_REQUEST_ID = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+
+
+class Histogram(object):
+    '''
+    Cumulative histogram of observed values, as exposed by Prometheus
+    '''
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics(object):
+    '''
+    Registry of counters, gauges and histograms labeled by name and label values, rendered
+    in the Prometheus text exposition format. Every server worker process has its own
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = dict()
+        self._counters = dict()
+        self._gauges = dict()
+        self._histograms = dict()
+
+    def describe(self, name, kind, text):
+        '''
+        Sets the type and help text of a metric
+
+        Parameters:
+            self: self handler
+            name: metric name
+            kind: "counter", "gauge" or "histogram"
+            text: help text
+
+        Returns:
+            None
+        '''
+        self._help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        '''
+        Increments a counter
+
+        Parameters:
+            self: self handler
+            name: metric name
+            value: increment
+            labels: label values
+
+        Returns:
+            None
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        '''
+        Sets a gauge value
+
+        Parameters:
+            self: self handler
+            name: metric name
+            value: current value
+            labels: label values
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        '''
+        Adds a value to a histogram
+
+        Parameters:
+            self: self handler
+            name: metric name
+            value: observed value
+            buckets: histogram bucket upper bounds, used when the histogram is created
+            labels: label values
+
+        Returns:
+            None
+        '''
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def render(self):
+        '''
+        Generates the Prometheus text exposition of every metric
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            string: metrics text
+        '''
+        lines = []
+        described = set()
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                kind, text = self._help.get(name, (kind, ''))
+                if text:
+                    lines.append('# HELP %s %s' %(name, text))
+                lines.append('# TYPE %s %s' %(name, kind))
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                header(name, 'counter')
+                lines.append('%s%s %s' %(name, _labels(labels), _number(value)))
+            for (name, labels), value in sorted(self._gauges.items()):
+                header(name, 'gauge')
+                lines.append('%s%s %s' %(name, _labels(labels), _number(value)))
+            for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+                header(name, 'histogram')
+                total = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    total += count
+                    lines.append('%s_bucket%s %d' %(name, _labels(labels + (('le', _number(bound)),)), total))
+                lines.append('%s_sum%s %s' %(name, _labels(labels), _number(histogram.sum)))
+                lines.append('%s_count%s %d' %(name, _labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{%s}' %','.join('%s="%s"' %(name, escape(value)) for name, value in labels)
+
+def _number(value):
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+METRICS = Metrics()
+METRICS.describe('ete_request_duration_seconds', 'histogram', 'Request handling time, by route and method')
+METRICS.describe('ete_requests_total', 'counter', 'Handled requests, by route, method and status')
+METRICS.describe('ete_response_size_bytes', 'histogram', 'Response body size before compression, by route')
+METRICS.describe('ete_phase_duration_seconds', 'histogram', 'Time spent per processing phase')
+
+_current = threading.local()
+
+class RequestContext(object):
+    '''
+    Request id and phase timings of the request handled by the current thread
+    '''
+    def __init__(self, request_id):
+        self.request_id = request_id
+        self.started = time.time()
+        self.phases = []
+        self.body_size = None # response body size before compression, set by web_return
+
+def current_request():
+    '''
+    Fetches the context of the request handled by the current thread
+
+    Parameters:
+        None
+
+    Returns:
+        RequestContext: request context, or None outside of requests (e.g. background jobs)
+    '''
+    return getattr(_current, 'request', None)
+
+@contextmanager
+def phase(name):
+    '''
+    Times a processing phase, accounted in the phase histogram and in the current request
+
+    Parameters:
+        name: phase name, such as parse, predraw, diff, action, render_self, render_target, map or compress
+
+    Returns:
+        context manager
+    '''
+    t1 = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - t1
+        METRICS.observe('ete_phase_duration_seconds', elapsed, phase=name)
+        context = current_request()
+        if context is not None:
+            context.phases.append((name, elapsed))
+
+def timeit(f):
+    '''
+    Times every call of the decorated function as a phase. Used as @timeit the phase is
+    named after the function, used as @timeit("name") it is given that name
+
+    Parameters:
+        f: function to measure, or phase name
+
+    Returns:
+        function: decorated function, or decorator
+    '''
+    if isinstance(f, str):
+        name = f
+        def decorator(f):
+            @wraps(f)
+            def wrapper(*args, **kargs):
+                with phase(name):
+                    return f(*args, **kargs)
+            return wrapper
+        return decorator
+    return timeit(f.__name__)(f)
+
+
+class MetricsPlugin(object):
+    '''
+    Bottle plugin giving every request an id and accounting its latency, status, response
+    size and phase timings. With a profile directory, requests sent with the "X-Profile"
+    header or a "profile" query param are run under cProfile and their stats dumped there
+    '''
+    name = 'metrics'
+    api = 2
+
+    def __init__(self, metrics=METRICS, profile_dir=None):
+        self.metrics = metrics
+        self.profile_dir = profile_dir
+
+    def apply(self, callback, route):
+        from bottle import request, response, HTTPResponse
+
+        rule = route.rule
+        @wraps(callback)
+        def wrapper(*args, **kargs):
+            request_id = request.get_header('X-Request-ID', '')
+            if not _REQUEST_ID.match(request_id) or request_id.strip('.') == '':
+                request_id = uuid.uuid4().hex[:16]
+            context = _current.request = RequestContext(request_id)
+            response.set_header('X-Request-ID', request_id)
+
+            profiler = None
+            if self.profile_dir and (request.get_header('X-Profile') or request.query.get('profile')):
+                profiler = cProfile.Profile()
+
+            status = 500
+            size = None
+            try:
+                body = profiler.runcall(callback, *args, **kargs) if profiler else callback(*args, **kargs)
+                status = response.status_code
+                if context.body_size is not None:
+                    size = context.body_size
+                elif isinstance(body, (bytes, str)):
+                    size = len(body)
+                self._finish(context, rule, status, size, profiler, response)
+                return body
+            except HTTPResponse as e:
+                # aborts and redirects
+                status = e.status_code
+                self._finish(context, rule, status, None, profiler, e)
+                raise
+            except Exception:
+                self._finish(context, rule, status, None, profiler, response)
+                raise
+            finally:
+                _current.request = None
+        return wrapper
+
+    def _finish(self, context, rule, status, size, profiler, response):
+        from bottle import request
+
+        elapsed = time.time() - context.started
+        self.metrics.observe('ete_request_duration_seconds', elapsed, route=rule, method=request.method)
+        self.metrics.inc('ete_requests_total', route=rule, method=request.method, status=status)
+        if size is not None:
+            self.metrics.observe('ete_response_size_bytes', size, SIZE_BUCKETS, route=rule)
+
+        response.set_header('X-Request-ID', context.request_id)
+        if context.phases:
+            response.set_header('Server-Timing', ', '.join('%s;dur=%0.1f' %(name, secs*1000) for name, secs in context.phases))
+        if profiler is not None:
+            if not os.path.isdir(self.profile_dir):
+                os.makedirs(self.profile_dir)
+            path = os.path.join(self.profile_dir, '%s.prof' %context.request_id)
+            profiler.dump_stats(path)
+            response.set_header('X-Profile', os.path.basename(path))
+            log.info('request %s profile stored in %s' %(context.request_id, path))
+
+        log.info('request %s %s %s %d %0.3f secs%s' %(
+            context.request_id, request.method, request.path, status, elapsed,
+            ''.join(' %s=%0.3f' %(name, secs) for name, secs in context.phases)))
@@ -0,0 +1,137 @@
+import threading
+from contextlib import contextmanager
+
+
+class _Queued(object):
+    def __init__(self, item):
+        self.item = item
+        self.taken = False
+        self.error = None
+        self.result = None
+        self.finished = threading.Event()
+
+
+class MutationQueue(object):
+    '''
+    Serializes the mutations of the trees sharing a key, such as a tree and its diff target,
+    and coalesces them. Mutations queued while a batch of the key is applied or redrawn are
+    applied as the next batch, by the first of their requests, so the trees are redrawn
+    once for all of them
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._keys = dict() # key -> [lock, queued mutations, users, busy]
+
+    @contextmanager
+    def lock(self, key):
+        '''
+        Holds the lock of a key, so no mutation of its trees runs meanwhile
+
+        Parameters:
+            self: self handler
+            key: trees key, as hashable
+
+        Returns:
+            context manager
+        '''
+        entry = self._enter(key)
+        try:
+            with entry[0]:
+                yield
+        finally:
+            self._exit(key)
+
+    def submit(self, key, item, run_batch):
+        '''
+        Queues a mutation and waits until it is applied, either by this thread or by the
+        thread leading the batch it joined
+
+        Parameters:
+            self: self handler
+            key: trees key, as hashable
+            item: mutation, passed to run_batch
+            run_batch: function applying a batch, called with the list of queued items, a
+                take() function returning the items queued since, which join the batch, and an
+                unlocked() context manager releasing the key meanwhile. It returns one
+                (error, result) tuple per item
+
+        Returns:
+            result of the mutation, errors are raised
+        '''
+        queued = _Queued(item)
+        entry = self._enter(key)
+        try:
+            with self._changed:
+                entry[1].append(queued)
+                while entry[3] and not queued.taken:
+                    self._changed.wait()
+                leader = not queued.taken
+                if leader:
+                    entry[3] = True
+
+            if leader:
+                try:
+                    with entry[0]:
+                        # This thread leads the batch of every mutation queued once the key is free
+                        with self._lock:
+                            batch = self._take(entry)
+                        self._run(batch, run_batch, entry)
+                finally:
+                    with self._changed:
+                        entry[3] = False
+                        self._changed.notify_all()
+            queued.finished.wait()
+        finally:
+            self._exit(key)
+
+        if queued.error is not None:
+            raise queued.error
+        return queued.result
+
+    def _take(self, entry):
+        batch, entry[1][:] = list(entry[1]), []
+        for queued in batch:
+            queued.taken = True
+        return batch
+
+    def _run(self, batch, run_batch, entry):
+        @contextmanager
+        def unlocked():
+            entry[0].release()
+            try:
+                yield
+            finally:
+                entry[0].acquire()
+
+        def take():
+            with self._lock:
+                more = self._take(entry)
+            batch.extend(more)
+            return [queued.item for queued in more]
+
+        try:
+            outcomes = run_batch([queued.item for queued in batch], take, unlocked)
+            for queued, (error, result) in zip(batch, outcomes):
+                queued.error, queued.result = error, result
+        except Exception as e:
+            for queued in batch:
+                queued.error = e
+        finally:
+            for queued in batch:
+                queued.finished.set()
+
+    def _enter(self, key):
+        with self._lock:
+            entry = self._keys.get(key)
+            if entry is None:
+                entry = self._keys[key] = [threading.Lock(), [], 0, False]
+            entry[2] += 1
+            return entry
+
+    def _exit(self, key):
+        with self._lock:
+            entry = self._keys[key]
+            entry[2] -= 1
+            if not entry[2]:
+                del self._keys[key]
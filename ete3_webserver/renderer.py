@@ -0,0 +1,528 @@
+import os
+import time
+import pickle
+import queue
+import signal
+import logging as log
+import multiprocessing as mp
+from io import BytesIO
+from collections import OrderedDict
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Event, Lock
+
+from .metrics import timeit
+from .diff_store import DiffView
+
+
+class RenderError(Exception):
+    '''
+    Raised when a render worker fails
+    '''
+    pass
+
+class RenderTimeout(RenderError):
+    '''
+    Raised when a render takes longer than its timeout
+    '''
+    pass
+
+class RenderCancelled(RenderError):
+    '''
+    Raised when a running render is cancelled
+    '''
+    pass
+
+
+def reset_scale(tree_style):
+    '''
+    Forgets the branch length scale ete3 stores in a tree style when drawing, so every tree
+    drawn with a shared style gets its own scale, whatever was drawn before with it
+
+    Parameters:
+        tree_style: tree style, as TreeStyle
+
+    Returns:
+        None
+    '''
+    if tree_style is not None:
+        tree_style._scale = None
+
+@timeit('render')
+def render_tree(tree, tree_style=None):
+    '''
+    Renders a tree in the current process
+
+    Parameters:
+        tree: tree to render, with _nid node internal IDs
+        tree_style: tree style, as TreeStyle
+
+    Returns:
+        tuple: base64 encoded PNG image, as string, and image map
+    '''
+    reset_scale(tree_style)
+    base64_img, img_map = tree.render("%%return.PNG", tree_style=tree_style)
+    return base64_img.data().decode("utf-8"), img_map
+
+def _tiny_tree():
+    from ete3 import Tree
+    t = Tree('((a,b),c);')
+    for index, n in enumerate(t.traverse('preorder')):
+        n._nid = index
+    return t
+
+def _warmup():
+    render_tree(_tiny_tree())
+
+# Laid out tile scenes kept by every render worker
+WORKER_SCENES = 2
+
+# Tile scenes of the current render worker
+_SCENES = OrderedDict()
+
+def _render_task(job):
+    tree, tree_style = loads_tree(job)
+    return render_tree(tree, tree_style)
+
+def _scene(key, job):
+    from .tiles import TileScene
+    scene = _SCENES.get(key)
+    if scene is None:
+        tree, tree_style = loads_tree(job)
+        scene = _SCENES[key] = TileScene(tree, tree_style)
+        while len(_SCENES) > WORKER_SCENES:
+            _SCENES.popitem(last=False)
+    _SCENES.move_to_end(key)
+    return scene
+
+def _layout_task(key, job):
+    return _scene(key, job).layout()
+
+def _tile_task(key, job, zoom, x, y, tile_size):
+    return _scene(key, job).render_tile(zoom, x, y, tile_size)
+
+# Tasks run by render workers, by name
+_TASKS = {'render' : _render_task, 'layout' : _layout_task, 'tile' : _tile_task}
+
+def _worker_main(conn, warmup):
+    if warmup:
+        _warmup()
+    while True:
+        try:
+            task, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            result = (True, _TASKS[task](*args))
+        except Exception as e:
+            result = (False, '%s: %s' %(type(e).__name__, e))
+        conn.send(result)
+
+
+def _spawner_main(conn, warmup):
+    # Workers are forked directly, as daemon processes cannot start multiprocessing children
+    while True:
+        try:
+            if not conn.poll(1.0):
+                _reap()
+                continue
+            conn.recv()
+        except (EOFError, OSError):
+            break
+        parent_conn, child_conn = mp.Pipe()
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            parent_conn.close()
+            try:
+                _worker_main(child_conn, warmup)
+            finally:
+                os._exit(0)
+        child_conn.close()
+        conn.send(pid)
+        reduction.send_handle(conn, parent_conn.fileno(), os.getppid())
+        parent_conn.close()
+
+def _reap():
+    try:
+        while os.waitpid(-1, os.WNOHANG)[0]:
+            pass
+    except ChildProcessError:
+        pass
+
+# Seconds a cancelled render may keep running before its worker is replaced
+CANCEL_GRACE = 5
+
+
+class RenderFuture(Future):
+    '''
+    Future of a render, which can also be cancelled while running
+    '''
+    def __init__(self):
+        Future.__init__(self)
+        self.cancel_event = Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+        return Future.cancel(self)
+
+
+class _RenderWorker(object):
+    def __init__(self, ctx, warmup):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, args=(child_conn, warmup))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def kill(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+
+class _SpawnedWorker(object):
+    # Render worker forked by the spawner, so it is not a child of this process
+    def __init__(self, conn, pid):
+        self.conn = conn
+        self.pid = pid
+
+    def alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def kill(self):
+        self.conn.close()
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+
+class _WorkerSpawner(object):
+    '''
+    Process forked along with the first render workers, before the Qt application is
+    created in this process, which forks the render workers replacing failed ones
+    '''
+    def __init__(self, ctx, warmup):
+        self.ctx = ctx
+        self.warmup = warmup
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_spawner_main, args=(child_conn, warmup))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+        self._lock = Lock()
+
+    def spawn(self):
+        '''
+        Starts a render worker
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            render worker, forked by the spawner
+        '''
+        with self._lock:
+            try:
+                self.conn.send(None)
+                pid = self.conn.recv()
+                fd = reduction.recv_handle(self.conn)
+            except (EOFError, OSError) as e:
+                log.warning('render worker spawner failed, forking the worker: %s' %e)
+                return _RenderWorker(self.ctx, self.warmup)
+        return _SpawnedWorker(Connection(fd), pid)
+
+    def kill(self):
+        self.conn.close()
+        self.process.terminate()
+        self.process.join()
+
+
+class RenderPool(object):
+    '''
+    Pool of pre-warmed worker processes rendering pickled trees, so renders run in
+    parallel and outside the request handling process
+    '''
+    def __init__(self, workers=2, timeout=None, warmup=True):
+        self.workers = workers
+        self.timeout = timeout
+        self.warmup = warmup
+        self.pid = os.getpid()
+        # Workers are forked before the Qt application is created in this process
+        self._ctx = mp.get_context('fork')
+        self._idle = queue.Queue()
+        for _ in range(workers):
+            self._idle.put(_RenderWorker(self._ctx, warmup))
+        self._spawner = _WorkerSpawner(self._ctx, warmup)
+        self._executor = ThreadPoolExecutor(workers)
+
+    def submit(self, tree, tree_style=None, timeout=None):
+        '''
+        Queues a tree render
+
+        Parameters:
+            self: self handler
+            tree: tree to render, with _nid node internal IDs
+            tree_style: tree style, as TreeStyle
+            timeout: seconds to wait for the render, the pool timeout if not given
+
+        Returns:
+            RenderFuture: future of the base64 encoded PNG image and image map
+        '''
+        # Serialize now, so later changes of the tree do not leak into the render
+        job = dumps_tree(tree, tree_style)
+        if job is None:
+            future = RenderFuture()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(render_tree(tree, tree_style))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        return self.submit_task('render', (job,), timeout)
+
+    def submit_task(self, task, args, timeout=None):
+        '''
+        Queues a task run by a render worker: "render" a pickled tree, "layout" the tile scene
+        of a pickled tree, or paint a "tile" of it. Workers keep the last WORKER_SCENES tile
+        scenes laid out, by key, and lay them out again from the pickled tree when missing
+
+        Parameters:
+            self: self handler
+            task: task name, as string
+            args: task arguments, as tuple. The pickled tree, as returned by dumps_tree, for
+                "render"; the scene key and pickled tree for "layout"; and the scene key,
+                pickled tree, zoom level, tile column, tile row and tile size for "tile"
+            timeout: seconds to wait for the task, the pool timeout if not given
+
+        Returns:
+            RenderFuture: future of the task result
+        '''
+        future = RenderFuture()
+        self._executor.submit(self._run, future, (task, args), timeout or self.timeout)
+        return future
+
+    def render(self, tree, tree_style=None, timeout=None):
+        '''
+        Renders a tree and waits for the result
+
+        Parameters:
+            self: self handler
+            tree: tree to render, with _nid node internal IDs
+            tree_style: tree style, as TreeStyle
+            timeout: seconds to wait for the render, the pool timeout if not given
+
+        Returns:
+            tuple: base64 encoded PNG image, as string, and image map
+        '''
+        return self.submit(tree, tree_style, timeout).result()
+
+    def shutdown(self):
+        '''
+        Stops the worker processes
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            None
+        '''
+        self._executor.shutdown(wait=True)
+        while not self._idle.empty():
+            self._idle.get().kill()
+        self._spawner.kill()
+
+    def _run(self, future, request, timeout):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        worker = self._idle.get()
+        deadline = time.time() + timeout if timeout else None
+        cancelled = False
+        try:
+            try:
+                worker.conn.send(request)
+            except OSError:
+                raise RenderError('render worker died')
+            while True:
+                wait = 0.1 if deadline is None else max(0, min(0.1, deadline - time.time()))
+                if worker.conn.poll(wait):
+                    try:
+                        ok, result = worker.conn.recv()
+                    except (EOFError, OSError):
+                        # The worker closed its end of the pipe when exiting
+                        raise RenderError('render worker died')
+                    break
+                if future.cancel_event.is_set() and not cancelled:
+                    # The worker finishes the render, whose result is dropped, and is only
+                    # replaced if it takes longer than CANCEL_GRACE
+                    cancelled = True
+                    future.set_exception(RenderCancelled('render cancelled'))
+                    grace = time.time() + CANCEL_GRACE
+                    deadline = grace if deadline is None else min(deadline, grace)
+                if deadline is not None and time.time() >= deadline:
+                    if cancelled:
+                        raise RenderCancelled('cancelled render took more than %s seconds' %CANCEL_GRACE)
+                    raise RenderTimeout('render took more than %s seconds' %timeout)
+                if not worker.alive():
+                    raise RenderError('render worker died')
+        except Exception as e:
+            # The worker state is unknown, replace it with a worker forked by the spawner,
+            # as this process may have started Qt meanwhile
+            log.warning('restarting render worker: %s' %e)
+            worker.kill()
+            worker = self._spawner.spawn()
+            if not cancelled:
+                future.set_exception(e if isinstance(e, RenderError) else RenderError(str(e)))
+            return
+        finally:
+            self._idle.put(worker)
+
+        if cancelled:
+            return
+        if ok:
+            future.set_result(result)
+        else:
+            future.set_exception(RenderError(result))
+
+def dumps_tree(tree, tree_style):
+    '''
+    Pickles a tree and its style to render them elsewhere, or later. Node actions are not
+    needed to render, and are left out. Node diff views are replaced by snapshots of their
+    node diff data, instead of pulling in the diff data of every node of the tree
+
+    Parameters:
+        tree: tree to render, with _nid node internal IDs
+        tree_style: tree style, as TreeStyle
+
+    Returns:
+        bytes: pickled tree and style, or None when they cannot be pickled (e.g. lambda
+            layouts), so they must be rendered in the current process
+    '''
+    def persistent_id(obj):
+        if obj is getattr(tree, 'actions', None):
+            return 'actions'
+        if isinstance(obj, DiffView):
+            return ('diff', obj.snapshot())
+        return None
+
+    try:
+        buf = BytesIO()
+        pickler = pickle.Pickler(buf, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = persistent_id
+        pickler.dump((tree, tree_style))
+    except Exception as e:
+        log.debug('rendering in process, tree cannot be pickled: %s' %e)
+        return None
+    return buf.getvalue()
+
+def loads_tree(job):
+    '''
+    Unpickles a tree and its style pickled by dumps_tree
+
+    Parameters:
+        job: pickled tree and style, as bytes
+
+    Returns:
+        tuple: tree, without node actions, and tree style
+    '''
+    def persistent_load(pid):
+        return pid[1] if isinstance(pid, tuple) and pid[0] == 'diff' else None
+
+    unpickler = pickle.Unpickler(BytesIO(job))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+_POOL_CONFIG = None
+_POOL = None
+
+def configure(workers=0, timeout=None, warmup=True):
+    '''
+    Sets up the render pool used by the tree handlers. The pool is created on first use
+    in every process, so it is never shared between forked server workers
+
+    Parameters:
+        workers: number of render worker processes, 0 renders in the calling process
+        timeout: default seconds to wait for a render, unbounded if not given
+        warmup: whether to render a tiny tree when starting each worker
+
+    Returns:
+        None
+    '''
+    global _POOL_CONFIG
+    _POOL_CONFIG = dict(workers=workers, timeout=timeout, warmup=warmup) if workers else None
+
+def get_pool():
+    '''
+    Fetches the render pool of the current process
+
+    Parameters:
+        None
+
+    Returns:
+        RenderPool: render pool, or None when rendering in process
+    '''
+    global _POOL
+    if _POOL_CONFIG is None:
+        return None
+    if _POOL is None or _POOL.pid != os.getpid():
+        _POOL = RenderPool(**_POOL_CONFIG)
+    return _POOL
+
+def warmup():
+    '''
+    Imports the tree drawing and treediff modules and renders a tiny tree with the render
+    pool of the current process, or in process when there is no pool, so that the first
+    request does not pay for them
+
+    Parameters:
+        None
+
+    Returns:
+        dict: seconds spent importing the modules and rendering
+    '''
+    t1 = time.time()
+    # ete3 also imports its Qt tree viewer
+    import ete3.tools.ete_diff
+    t2 = time.time()
+    pool = get_pool()
+    if pool is None:
+        _warmup()
+    else:
+        # Waits for a pool worker, which warms up once started
+        pool.render(_tiny_tree())
+    t3 = time.time()
+    return {'imports' : t2 - t1, 'render' : t3 - t2}
+
+def submit_render(tree, tree_style=None, timeout=None):
+    '''
+    Renders a tree with the render pool, or in process when there is no pool
+
+    Parameters:
+        tree: tree to render, with _nid node internal IDs
+        tree_style: tree style, as TreeStyle
+        timeout: seconds to wait for the render, the pool timeout if not given
+
+    Returns:
+        Future: future of the base64 encoded PNG image and image map
+    '''
+    pool = get_pool()
+    if pool is not None:
+        return pool.submit(tree, tree_style, timeout)
+
+    future = RenderFuture()
+    future.set_running_or_notify_cancel()
+    try:
+        future.set_result(render_tree(tree, tree_style))
+    except Exception as e:
+        future.set_exception(e)
+    return future
@@ -0,0 +1,82 @@
+import time
+import bisect
+import logging as log
+
+
+MODES = ('exact', 'prefix', 'substring')
+
+
+def _trigrams(text):
+    return set(text[i:i+3] for i in range(len(text) - 2))
+
+
+class NodeIndex(object):
+    '''
+    Case insensitive index of node names and features. Exact matches are looked up in a
+    dict, prefixes by bisection of the sorted keys, and substrings of three or more
+    characters by intersecting the keys sharing every trigram of the query
+    '''
+    def __init__(self, nodes, features=('name',)):
+        t1 = time.time()
+        self._nids = dict()
+        for nid, node in nodes.items():
+            for feature in features:
+                value = getattr(node, feature, None)
+                if value is None or value == '':
+                    continue
+                self._nids.setdefault(str(value).lower(), []).append(nid)
+
+        self._keys = sorted(self._nids)
+        self._trigrams = dict()
+        for key in self._keys:
+            for trigram in _trigrams(key):
+                self._trigrams.setdefault(trigram, []).append(key)
+        log.info('indexed %d node keys in %0.3f secs' %(len(self._keys), time.time() - t1))
+
+    def __len__(self):
+        return len(self._keys)
+
+    def search(self, query, mode='substring'):
+        '''
+        Finds the nodes matching a query
+
+        Parameters:
+            self: self handler
+            query: searched text, case insensitive
+            mode: "exact", "prefix" or "substring" match of the node names and features
+
+        Returns:
+            list: node internal IDs, ordered by matched key
+        '''
+        if mode not in MODES:
+            raise ValueError('unknown search mode %s' %mode)
+        query = query.lower()
+        if not query:
+            return []
+
+        if mode == 'exact':
+            keys = [query] if query in self._nids else []
+        elif mode == 'prefix':
+            start = bisect.bisect_left(self._keys, query)
+            end = bisect.bisect_left(self._keys, query + '\U0010ffff')
+            keys = self._keys[start:end]
+        elif len(query) < 3:
+            keys = [key for key in self._keys if query in key]
+        else:
+            # Candidates share every trigram of the query, starting from the rarest one
+            postings = sorted((self._trigrams.get(trigram, []) for trigram in _trigrams(query)), key=len)
+            candidates = set(postings[0])
+            for keys in postings[1:]:
+                candidates.intersection_update(keys)
+                if not candidates:
+                    break
+            keys = sorted(key for key in candidates if query in key)
+
+        seen = set()
+        nids = []
+        for key in keys:
+            for nid in self._nids[key]:
+                if nid not in seen:
+                    seen.add(nid)
+                    nids.append(nid)
+        return nids
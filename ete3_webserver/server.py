@@ -0,0 +1,69 @@
+import os
+import signal
+import logging as log
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+from bottle import ServerAdapter
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    '''
+    wsgiref server handling every request in a thread of its own
+    '''
+    daemon_threads = True
+
+
+class PreforkServer(ServerAdapter):
+    '''
+    wsgiref based server whose listening socket is shared by several forked worker
+    processes. Dead workers are replaced until the server is interrupted.
+
+    Options:
+        workers: number of worker processes, as integer
+        threads: whether every worker handles requests in threads of their own, as boolean
+        post_fork: function called in every worker process once started
+    '''
+    def run(self, app):
+        class QuietHandler(WSGIRequestHandler):
+            def log_request(*args, **kw):
+                pass
+
+        handler_cls = QuietHandler if self.quiet else WSGIRequestHandler
+        server_cls = ThreadingWSGIServer if self.options.get('threads') else WSGIServer
+        srv = make_server(self.host, self.port, app, server_class=server_cls, handler_class=handler_cls)
+        workers = int(self.options.get('workers', 1))
+
+        children = set()
+        try:
+            for _ in range(workers):
+                children.add(self._spawn(srv))
+            log.info('serving on %s:%s with %d workers' %(self.host, self.port, workers))
+
+            while children:
+                pid, status = os.wait()
+                if pid in children:
+                    children.discard(pid)
+                    log.warning('worker %d exited with status %d, restarting it' %(pid, status))
+                    children.add(self._spawn(srv))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            for pid in children:
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            srv.server_close()
+
+    def _spawn(self, srv):
+        pid = os.fork()
+        if pid:
+            return pid
+        try:
+            if self.options.get('post_fork'):
+                self.options['post_fork']()
+            srv.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os._exit(0)
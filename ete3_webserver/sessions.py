@@ -0,0 +1,472 @@
+import os
+import time
+import fcntl
+import pickle
+import tempfile
+import threading
+import logging as log
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import quote, unquote
+
+
+class TreeExpired(KeyError):
+    '''
+    Raised when requesting a tree that was evicted from the store
+    '''
+    pass
+
+
+class TreeStore(object):
+    '''
+    Loaded tree handlers store, bounded by number of entries, memory use and idle time.
+    Evicting a tree also evicts its paired diff target.
+    '''
+    def __init__(self, max_entries=None, max_bytes=None, ttl=None, max_expired=10000):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_expired = max_expired
+        self.evictions = 0
+        self._entries = OrderedDict() # treeid -> [handler, size, topology version, last access, renders size]
+        self._expired = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, treeid):
+        return treeid in self._entries
+
+    def __getitem__(self, treeid):
+        with self._lock:
+            self._expire_idle()
+            entry = self._entries.get(treeid)
+            if entry is None:
+                if treeid in self._expired:
+                    raise TreeExpired(treeid)
+                raise KeyError(treeid)
+            entry[3] = time.time()
+            self._entries.move_to_end(treeid)
+            return entry[0]
+
+    def __setitem__(self, treeid, handler):
+        size = handler.memory_usage()
+        with self._lock:
+            if treeid in self._entries:
+                self._remove(treeid)
+            self._entries[treeid] = [handler, size, handler.topology_version, time.time(), handler.render_memory_usage()]
+            self._bytes += size
+            self._expired.pop(treeid, None)
+            self._evict(keep=treeid)
+
+    def get(self, treeid, default=None):
+        try:
+            return self[treeid]
+        except KeyError:
+            return default
+
+    def refresh(self, treeid):
+        '''
+        Measures again the memory used by a tree whose topology changed
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            entry = self._entries.get(treeid)
+            if entry is None or entry[2] == entry[0].topology_version:
+                return
+            size = entry[0].memory_usage()
+            self._bytes += size - entry[1]
+            entry[1] = size
+            entry[2] = entry[0].topology_version
+            entry[4] = entry[0].render_memory_usage()
+            self._evict(keep=treeid)
+
+    def measure_renders(self, treeid):
+        '''
+        Measures again the memory used by the cached renders of a tree, which change without
+        changing the tree
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            entry = self._entries.get(treeid)
+            if entry is None:
+                return
+            renders = entry[0].render_memory_usage()
+            self._bytes += renders - entry[4]
+            entry[1] += renders - entry[4]
+            entry[4] = renders
+            self._evict(keep=treeid)
+
+    @contextmanager
+    def lock(self, treeid):
+        '''
+        Locks a tree against mutations by other server workers. Trees stored in memory are only
+        served by this worker, whose threads are serialized by the caller
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            context manager
+        '''
+        yield
+
+    def evict(self, treeid):
+        '''
+        Removes a tree and its paired diff target from the store
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            entry = self._entries.get(treeid)
+            if entry is None:
+                return
+            handler = entry[0]
+            self._remove(treeid, expired=True)
+            target = handler.diffdict['target']
+            if target and self._entries.get(target.treeid, [None])[0] is target:
+                self._remove(target.treeid, expired=True)
+            log.info('evicted tree %s, %d trees using %0.3f KB' %(treeid, len(self._entries), self._bytes/1024.))
+
+    def memory_usage(self):
+        '''
+        Returns the estimated memory used by the stored trees
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            integer: size in bytes
+        '''
+        return self._bytes
+
+    def stats(self):
+        '''
+        Returns the store usage figures
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            dict: number of trees, bytes used and evictions
+        '''
+        with self._lock:
+            return {'trees' : len(self._entries), 'bytes' : self._bytes, 'evictions' : self.evictions}
+
+    def _remove(self, treeid, expired=False):
+        size = self._entries.pop(treeid)[1]
+        self._bytes -= size
+        if expired:
+            self.evictions += 1
+            self._expired[treeid] = True
+            while len(self._expired) > self.max_expired:
+                self._expired.popitem(last=False)
+
+    def _expire_idle(self):
+        if not self.ttl:
+            return
+        limit = time.time() - self.ttl
+        while self._entries:
+            treeid, entry = next(iter(self._entries.items()))
+            if entry[3] >= limit:
+                break
+            self.evict(treeid)
+
+    def _over_limits(self):
+        if self.max_entries and len(self._entries) > self.max_entries:
+            return True
+        if self.max_bytes and self._bytes > self.max_bytes:
+            return True
+        return False
+
+    def _evict(self, keep):
+        self._expire_idle()
+        protected = set([keep])
+        target = self._entries[keep][0].diffdict['target'] if keep in self._entries else None
+        if target:
+            protected.add(target.treeid)
+
+        while self._over_limits():
+            victim = next((tid for tid in self._entries if tid not in protected), None)
+            if victim is None:
+                break
+            self.evict(victim)
+
+
+class FileTreeStore(object):
+    '''
+    Loaded tree handlers store backed by a directory, so that every worker process using
+    the same directory can serve any tree. Handlers are pickled with their tree and diff
+    data, while the objects in shared_objects (node actions, tree styles) are stored as
+    references and must be registered in the same order by every worker.
+    '''
+    def __init__(self, path, max_entries=None, max_bytes=None, ttl=None, shared_objects=None, expired_ttl=86400):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.expired_ttl = expired_ttl
+        self.evictions = 0
+        self.shared_objects = list(shared_objects or [])
+        self._shared_ids = dict((id(obj), index) for index, obj in enumerate(self.shared_objects))
+        self._loaded = dict() # treeid -> [handler, file mtime, dumped topology version]
+        self._last_scan = 0
+        self._lock = threading.RLock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def __len__(self):
+        return len(self._scan())
+
+    def __contains__(self, treeid):
+        return os.path.exists(self._file(treeid))
+
+    def __getitem__(self, treeid):
+        with self._lock:
+            if self.ttl and time.time() - self._last_scan > min(self.ttl, 60):
+                self._evict(keep=None)
+            return self._load(treeid, dict())
+
+    def __setitem__(self, treeid, handler):
+        with self._lock:
+            self._dump(handler)
+            self._evict(keep=treeid)
+
+    def get(self, treeid, default=None):
+        try:
+            return self[treeid]
+        except KeyError:
+            return default
+
+    def refresh(self, treeid):
+        '''
+        Stores again a modified tree, and its diff target when the tree topology changed
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            entry = self._loaded.get(treeid)
+            if entry is None:
+                return
+            handler = entry[0]
+            target = handler.diffdict['target']
+            topology_changed = entry[2] != handler.topology_version
+            self._dump(handler)
+            if topology_changed and target:
+                self._dump(target)
+            self._evict(keep=treeid)
+
+    def measure_renders(self, treeid):
+        '''
+        Does nothing, as cached renders are not stored with the trees
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            None
+        '''
+        pass
+
+    @contextmanager
+    def lock(self, treeid):
+        '''
+        Locks a tree against mutations by other server workers, with an advisory lock on a
+        file of the store directory, so a tree is loaded, modified and stored again by one
+        worker at a time
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            context manager
+        '''
+        with open(self._file(treeid, '.lock'), 'a') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def evict(self, treeid):
+        '''
+        Removes a tree and its paired diff target from the store
+
+        Parameters:
+            self: self handler
+            treeid: tree id, as string
+
+        Returns:
+            None
+        '''
+        with self._lock:
+            header = self._header(treeid)
+            if header is None:
+                return
+            self._remove(treeid)
+            if header['target']:
+                self._remove(header['target'])
+            log.info('evicted tree %s' %treeid)
+
+    def memory_usage(self):
+        '''
+        Returns the size of the stored trees
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            integer: serialized size in bytes
+        '''
+        return sum(size for _, _, size in self._scan())
+
+    def stats(self):
+        '''
+        Returns the store usage figures
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            dict: number of trees, bytes used and evictions
+        '''
+        entries = self._scan()
+        return {'trees' : len(entries), 'bytes' : sum(size for _, _, size in entries), 'evictions' : self.evictions}
+
+    def _file(self, treeid, ext='.pkl'):
+        return os.path.join(self.path, quote(treeid, safe='') + ext)
+
+    def _header(self, treeid):
+        try:
+            with open(self._file(treeid), 'rb') as fh:
+                return pickle.load(fh)
+        except (IOError, OSError, EOFError):
+            return None
+
+    def _load(self, treeid, memo):
+        if treeid in memo:
+            return memo[treeid]
+
+        path = self._file(treeid)
+        try:
+            st = os.stat(path)
+        except OSError:
+            if os.path.exists(self._file(treeid, '.expired')):
+                raise TreeExpired(treeid)
+            raise KeyError(treeid)
+
+        entry = self._loaded.get(treeid)
+        if entry is None or entry[1] != st.st_mtime_ns:
+            with open(path, 'rb') as fh:
+                pickle.load(fh) # header
+                unpickler = pickle.Unpickler(fh)
+                unpickler.persistent_load = self.shared_objects.__getitem__
+                handler = unpickler.load()
+            entry = [handler, st.st_mtime_ns, handler.topology_version]
+            self._loaded[treeid] = entry
+        handler = entry[0]
+
+        # The access time keeps track of idle trees
+        os.utime(path, ns=(time.time_ns(), st.st_mtime_ns))
+        memo[treeid] = handler
+
+        target = handler.diffdict['target']
+        if target:
+            target_id = target if isinstance(target, str) else target.treeid
+            handler.diffdict['target'] = self._load(target_id, memo)
+        return handler
+
+    def _dump(self, handler):
+        target = handler.diffdict['target']
+        header = {'treeid' : handler.treeid, 'target' : target.treeid if target else ''}
+        path = self._file(handler.treeid)
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(header, fh)
+                pickler = pickle.Pickler(fh, pickle.HIGHEST_PROTOCOL)
+                pickler.persistent_id = lambda obj: self._shared_ids.get(id(obj))
+                pickler.dump(handler)
+            os.replace(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._loaded[handler.treeid] = [handler, os.stat(path).st_mtime_ns, handler.topology_version]
+        if os.path.exists(self._file(handler.treeid, '.expired')):
+            os.remove(self._file(handler.treeid, '.expired'))
+
+    def _remove(self, treeid):
+        self._loaded.pop(treeid, None)
+        try:
+            os.remove(self._file(treeid))
+        except OSError:
+            return
+        open(self._file(treeid, '.expired'), 'w').close()
+        self.evictions += 1
+
+    def _scan(self):
+        # Returns (last access, tree id, size) of the stored trees, least recently used first
+        entries = []
+        now = time.time()
+        for fname in os.listdir(self.path):
+            fpath = os.path.join(self.path, fname)
+            try:
+                st = os.stat(fpath)
+            except OSError:
+                continue
+            if fname.endswith('.pkl'):
+                entries.append((st.st_atime, unquote(fname[:-4]), st.st_size))
+            elif fname.endswith('.expired') and now - st.st_mtime > self.expired_ttl:
+                os.remove(fpath)
+        entries.sort()
+        return entries
+
+    def _evict(self, keep):
+        self._last_scan = time.time()
+        entries = self._scan()
+        protected = set()
+        if keep is not None:
+            header = self._header(keep)
+            protected = set([keep, header['target'] if header else ''])
+
+        sizes = dict((treeid, size) for _, treeid, size in entries)
+        total = sum(sizes.values())
+        for atime, treeid, size in entries:
+            if treeid in protected or treeid not in sizes:
+                continue
+            idle = self.ttl and self._last_scan - atime > self.ttl
+            over = (self.max_entries and len(sizes) > self.max_entries) or (self.max_bytes and total > self.max_bytes)
+            if not idle and not over:
+                continue
+            header = self._header(treeid)
+            self.evict(treeid)
+            for tid in (treeid, header['target'] if header else None):
+                total -= sizes.pop(tid, 0)
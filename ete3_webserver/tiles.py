@@ -0,0 +1,281 @@
+import math
+import time
+import hashlib
+import threading
+import logging as log
+from collections import OrderedDict
+
+from .metrics import phase
+from .renderer import reset_scale, dumps_tree, loads_tree, get_pool
+
+
+TILE_SIZE = 256
+MAX_ZOOM = 2
+
+
+class SceneLayout(object):
+    '''
+    Size and image map of a laid out tree scene. Zoom level z draws the tree at 2^z times
+    its size, so level 0 matches the full tree image and its image map
+    '''
+    def __init__(self, x, y, width, height, img_map):
+        self.x, self.y = x, y
+        self.width, self.height = width, height
+        self.img_map = img_map
+        self.key = None # set by TileCache
+
+    def layout(self):
+        '''
+        Returns the size and image map of the scene
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            dict: scene x and y offsets, width, height and image map, as taken by SceneLayout
+        '''
+        return {'x' : self.x, 'y' : self.y, 'width' : self.width, 'height' : self.height, 'img_map' : self.img_map}
+
+    def min_zoom(self, tile_size=TILE_SIZE):
+        '''
+        Returns the zoom level at which the whole tree fits in one tile
+
+        Parameters:
+            self: self handler
+            tile_size: tile width and height in pixels
+
+        Returns:
+            integer: zoom level, 0 or negative
+        '''
+        size = max(self.width, self.height, 1)
+        return -max(0, int(math.ceil(math.log(size / float(tile_size), 2))))
+
+    def tile_rect(self, zoom, x, y, tile_size=TILE_SIZE):
+        '''
+        Returns the image region drawn by a tile
+
+        Parameters:
+            self: self handler
+            zoom: zoom level, as integer
+            x: tile column, as integer
+            y: tile row, as integer
+            tile_size: tile width and height in pixels
+
+        Returns:
+            tuple: x1, y1, x2, y2 region, in full image (zoom 0) pixels
+        '''
+        side = tile_size / 2.0 ** zoom
+        return (x * side, y * side, (x + 1) * side, (y + 1) * side)
+
+
+class TileScene(SceneLayout):
+    '''
+    Laid out Qt scene of a tree, kept to paint any viewport of the tree image at any zoom
+    level without drawing the whole image
+    '''
+    def __init__(self, tree, tree_style=None):
+        from ete3.treeview.drawer import init_scene
+        from ete3.treeview.qt4_render import render, get_tree_img_map
+
+        t1 = time.time()
+        reset_scale(tree_style)
+        self.scene, img = init_scene(tree, None, tree_style)
+        tree_item, n2i, n2f = render(tree, img)
+        self.scene.init_values(tree, img, n2i, n2f)
+        tree_item.setParentItem(self.scene.master_item)
+        self.scene.master_item.setPos(0, 0)
+        self.scene.addItem(self.scene.master_item)
+
+        rect = self.scene.sceneRect()
+        x, y = rect.x(), rect.y()
+        img_map = get_tree_img_map(n2i)
+        # Image map coordinates relative to the image, as in full tree renders
+        for kind in ('nodes', 'faces'):
+            for area in img_map[kind]:
+                area[0:4] = [area[0] - x, area[1] - y, area[2] - x, area[3] - y]
+        for nid, area in img_map['node_areas'].items():
+            img_map['node_areas'][nid] = [area[0] - x, area[1] - y, area[2] - x, area[3] - y]
+        SceneLayout.__init__(self, x, y, rect.width(), rect.height(), img_map)
+        self._lock = threading.Lock()
+        log.info('laid out %0.0fx%0.0f tree scene in %0.3f secs' %(self.width, self.height, time.time() - t1))
+
+    def render_tile(self, zoom, x, y, tile_size=TILE_SIZE):
+        '''
+        Paints a tile of the tree image
+
+        Parameters:
+            self: self handler
+            zoom: zoom level, as integer
+            x: tile column, as integer
+            y: tile row, as integer
+            tile_size: tile width and height in pixels
+
+        Returns:
+            bytes: PNG image
+        '''
+        from ete3.treeview.qt import QImage, QPainter, QColor, QRectF, QByteArray, QBuffer, QIODevice, Qt
+
+        x1, y1, x2, y2 = self.tile_rect(zoom, x, y, tile_size)
+        with self._lock:
+            ii = QImage(tile_size, tile_size, QImage.Format_ARGB32)
+            ii.fill(QColor(Qt.white).rgb())
+            pp = QPainter(ii)
+            pp.setRenderHint(QPainter.Antialiasing)
+            pp.setRenderHint(QPainter.TextAntialiasing)
+            pp.setRenderHint(QPainter.SmoothPixmapTransform)
+            self.scene.render(pp, QRectF(0, 0, tile_size, tile_size),
+                              QRectF(self.x + x1, self.y + y1, x2 - x1, y2 - y1), Qt.IgnoreAspectRatio)
+            pp.end()
+            ba = QByteArray()
+            buf = QBuffer(ba)
+            buf.open(QIODevice.WriteOnly)
+            ii.save(buf, "PNG")
+            return bytes(ba.data())
+
+
+class WorkerScene(SceneLayout):
+    '''
+    Tree scene laid out by the render workers, which also paint its tiles. The pickled tree
+    is kept, so any worker can lay out the scene again when it does not hold it
+    '''
+    def __init__(self, pool, key, job, layout):
+        SceneLayout.__init__(self, **layout)
+        self.key = key
+        self._pool = pool
+        self._job = job
+
+    def render_tile(self, zoom, x, y, tile_size=TILE_SIZE):
+        '''
+        Paints a tile of the tree image with a render worker
+
+        Parameters:
+            self: self handler
+            zoom: zoom level, as integer
+            x: tile column, as integer
+            y: tile row, as integer
+            tile_size: tile width and height in pixels
+
+        Returns:
+            bytes: PNG image
+        '''
+        return self._pool.submit_task('tile', (self.key, self._job, zoom, x, y, tile_size)).result()
+
+
+class TileCache(object):
+    '''
+    Size bounded LRU caches of tree scenes and painted tiles, keyed by tree and render
+    version, so panning and zooming only paint the tiles not seen before
+    '''
+    def __init__(self, max_scenes=4, max_tiles=1024):
+        self.max_scenes = max_scenes
+        self.max_tiles = max_tiles
+        self._scenes = OrderedDict()
+        self._tiles = OrderedDict()
+        self._lock = threading.RLock()
+
+    def scene(self, h):
+        '''
+        Fetches the laid out scene of the current version of a tree. Scenes are laid out by
+        the render workers, or in process when there are none or the tree cannot be pickled
+
+        Parameters:
+            self: self handler
+            h: tree handler object
+
+        Returns:
+            SceneLayout: tree scene
+        '''
+        key = self._key(h)
+        with self._lock:
+            scene = self._scenes.get(key)
+            if scene is not None:
+                self._scenes.move_to_end(key)
+                return scene
+
+        pool = get_pool()
+        job = dumps_tree(h.tree, h.tree.tree_style) if pool is not None else None
+        with phase('tile_layout'):
+            if job is None:
+                scene = TileScene(h.tree, h.tree.tree_style)
+            else:
+                scene = WorkerScene(pool, key, job, pool.submit_task('layout', (key, job)).result())
+        with self._lock:
+            if key not in self._scenes:
+                self._store_scene(key, scene)
+            self._scenes.move_to_end(key)
+            return self._scenes[key]
+
+    def prepare(self, h):
+        '''
+        Starts laying out the scene of the current version of a tree, when not laid out yet,
+        from a copy of the tree, so the scene can be waited for without holding the lock of
+        the tree
+
+        Parameters:
+            self: self handler
+            h: tree handler object
+
+        Returns:
+            function: waits for the scene and caches it, doing nothing when the scene is
+                cached or the tree cannot be copied
+        '''
+        key = self._key(h)
+        with self._lock:
+            if key in self._scenes:
+                return lambda: None
+        job = dumps_tree(h.tree, h.tree.tree_style)
+        if job is None:
+            return lambda: None
+
+        pool = get_pool()
+        future = pool.submit_task('layout', (key, job)) if pool is not None else None
+
+        def layout():
+            with phase('tile_layout'):
+                if future is None:
+                    scene = TileScene(*loads_tree(job))
+                else:
+                    scene = WorkerScene(pool, key, job, future.result())
+            with self._lock:
+                if key not in self._scenes:
+                    self._store_scene(key, scene)
+        return layout
+
+    def tile(self, scene, zoom, x, y):
+        '''
+        Fetches a painted tile of a tree scene
+
+        Parameters:
+            self: self handler
+            scene: tree scene, as returned by scene
+            zoom: zoom level, as integer
+            x: tile column, as integer
+            y: tile row, as integer
+
+        Returns:
+            tuple: PNG image, as bytes, and its strong ETag
+        '''
+        key = scene.key + (zoom, x, y)
+        with self._lock:
+            cached = self._tiles.get(key)
+            if cached is not None:
+                self._tiles.move_to_end(key)
+                return cached
+
+        with phase('tile_paint'):
+            png = scene.render_tile(zoom, x, y)
+        cached = (png, '"%s"' %hashlib.sha1(png).hexdigest())
+        with self._lock:
+            self._tiles[key] = cached
+            while len(self._tiles) > self.max_tiles:
+                self._tiles.popitem(last=False)
+        return cached
+
+    def _store_scene(self, key, scene):
+        scene.key = key
+        self._scenes[key] = scene
+        while len(self._scenes) > max(self.max_scenes, 1):
+            self._scenes.popitem(last=False)
+
+    def _key(self, h):
+        return (h.treeid, h.source_digest, h.version, id(h.tree.tree_style))
@@ -1,32 +1,167 @@
-import time
+import sys
+import base64
+import hashlib
 import string
 import random
+import heapq
 import logging as log
-from ete3 import PhyloTree, TreeStyle, NCBITaxa, Tree
-from ete3.parser.newick import NewickError
-from ete3.tools.ete_diff import *
+from collections import OrderedDict
 
-def timeit(f):
+from .diff_cache import content_digest
+from .diff_store import DiffStore
+from .renderer import submit_render
+from .search import NodeIndex
+from .uploads import Upload
+from .metrics import timeit, phase
+
+# Maximum number of clade renders cached per tree, besides those of the whole tree
+MAX_CLADE_RENDERS = 8
+
+def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
+    return ''.join(random.choice(chars) for _ in range(size))
+
+def _reverse_diff(side1, side2, diff):
+    # A symmetric difference is valid for both directions, otherwise keep
+    # the elements only present in the target side
+    if diff == side1 ^ side2:
+        return diff
+    return side2 - side1
+
+# ete3 and its Qt tree viewer are imported on first use, so that importing the
+# web server, and starting its worker processes, stays fast
+_ETE_NAMES = ('PhyloTree', 'TreeStyle', 'NCBITaxa', 'Tree', 'TextFace')
+
+def __getattr__(name):
+    # Names this module used to import from ete3 and ete_diff
+    if name in _ETE_NAMES:
+        import ete3
+        return getattr(ete3, name)
+    if not name.startswith('_'):
+        from ete3.tools import ete_diff
+        if hasattr(ete_diff, name):
+            return getattr(ete_diff, name)
+    raise AttributeError("module %r has no attribute %r" %(__name__, name))
+
+def diff_params(attr1='name', attr2='name', dist_fn=None, support=None, reduce_matrix=False, extended=False):
     '''
-    Calculates the elapsed time taken by a function decarated
+    Collects the treediff parameters that determine its result, also used as diff cache key
 
+    Parameters:
+        attr1: observed attribute for the reference node, as string
+        attr2: observed attribute for the target node, as string
+        dist_fn: distance function that will be used to calculate the distances between nodes, as python function,
+            ete_diff EUCL_DIST if not given
+        support: whether to use support values for the different calculations, as boolean
+        reduce_matrix: whether to reduce the distances matrix removing columns and rows where observations equal to 0 (perfect matches) are found, as boolean
+        extended: whether to use an extension function, as python function
+
+    Returns:
+        dict: treediff parameters
+    '''
+    if dist_fn is None:
+        from ete3.tools.ete_diff import EUCL_DIST
+        dist_fn = EUCL_DIST
+    return dict(attr1=attr1, attr2=attr2, dist_fn=dist_fn, support=support, reduce_matrix=reduce_matrix, extended=extended)
+
+@timeit('diff')
+def diff_rows(tree1, tree2, jobs=1, parallel=None, **params):
+    '''
+    Runs treediff between two trees with _nid node internal IDs
 
     Parameters:
-        f: function to measure
+        tree1: reference tree
+        tree2: target tree
+        jobs: maximum number of parallel jobs to use if parallel argument is given, as integer
+        parallel: parallelization method, async or sync, as string
+        params: treediff parameters, as returned by diff_params
 
     Returns:
-        float: elapsed time
+        list: (source nid, target nid, distance, side1, side2, diff) tuples, one per reference node
     '''
-    def a_wrapper_accepting_arguments(*args, **kargs):
-        t1 = time.time()
-        r = f(*args, **kargs)
-        print ("%s: %0.3f secs " %(f.__name__, time.time() - t1))
-        return r
-    return a_wrapper_accepting_arguments
+    from ete3.tools.ete_diff import treediff
+    result = treediff(tree1, tree2, jobs=jobs, parallel=parallel, **params)
+    return [(int(r[-2]._nid), int(r[-1]._nid), r[0], r[2], r[3], r[4]) for r in result]
 
-def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
-    return ''.join(random.choice(chars) for _ in range(size))
+def match_nodes(tree1, nids, tree2, jobs=1, parallel=None, **params):
+    '''
+    Finds the best match in a tree for some nodes of another tree, running treediff on the
+    top-most clades holding them instead of the whole tree
+
+    Parameters:
+        tree1: tree holding the nodes to match
+        nids: internal IDs of the nodes to match, as set
+        tree2: tree to match them with
+        jobs: maximum number of parallel jobs to use if parallel argument is given, as integer
+        parallel: parallelization method, async or sync, as string
+        params: treediff parameters, as returned by diff_params
+
+    Returns:
+        list: (source nid, target nid, distance, side1, side2, diff) tuples, one per given node
+    '''
+    rows = []
+    for n in tree1.traverse('preorder', is_leaf_fn=lambda n: n._nid in nids):
+        if n._nid in nids:
+            rows.extend(row for row in diff_rows(n, tree2, jobs=jobs, parallel=parallel, **params) if row[0] in nids)
+    return rows
+
+def score_nodes(nodes, content, tree, attr1='name', attr2='name', dist_fn=None, support=None, **params):
+    '''
+    Finds the best match in a tree for some nodes of another tree, scoring every node on its
+    own against the cached content of the tree nodes, as treediff does, instead of running
+    treediff on the clades holding them
+
+    Parameters:
+        nodes: nodes to match, as list
+        content: observed attributes under every node of their tree, as returned by get_cached_content
+        tree: tree to match them with
+        attr1: observed attribute for the given nodes, as string
+        attr2: observed attribute for the tree nodes, as string
+        dist_fn: distance function, as python function, ete_diff EUCL_DIST if not given
+        support: whether to use support values for the different calculations, as boolean
+        params: other treediff parameters, not used to score nodes
+
+    Returns:
+        list: (source nid, target nid, distance, side1, side2, diff) tuples, one per given node
+    '''
+    dist_fn = diff_params(dist_fn=dist_fn)['dist_fn']
+    targets = list(tree.get_cached_content(store_attr=attr2).items())
+    rows = []
+    for n in nodes:
+        best = None
+        for target, side2 in targets:
+            dist = dist_fn(content[n], side2, support, attr1, attr2)
+            if best is None or dist < best[0]:
+                best = (dist, target, side2)
+        dist, target, side2 = best
+        rows.append((int(n._nid), int(target._nid), dist, content[n], side2, content[n] ^ side2))
+    return rows
+
+def _getsizeof(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += _getsizeof(key, seen) + _getsizeof(value, seen)
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        for value in obj:
+            size += _getsizeof(value, seen)
+    return size
+
+
+# Image map areas of nodes and faces, handled by ete.js
+_NODE_AREA = """ <AREA SHAPE="rect" COORDS="%s,%s,%s,%s" 
+                                onMouseLeave='hide_diff();'
+                                onMouseEnter='highlight_node("%s", "%s", "%s", "%s", "%s", %s, %s, %s, %s, %s, %s, %s, %s, %.2f);'
+                                onClick='show_actions("%s", "%s", "%s");'
+                                href="javascript:void('%s');">"""
 
+_FACE_AREA = """ <AREA SHAPE="rect" COORDS="%s,%s,%s,%s"
+                                onMouseLeave='hide_diff();'
+                                onMouseEnter='highlight_node("%s", "%s", "%s", "%s", "%s", %s, %s, %s, %s, %s, %s, %s, %s, %.2f);'
+                                onClick='show_actions("%s", "%s", "%s");'
+                                href='javascript:void("%s");'>"""
 
 
 class WebTreeHandler(object):
@@ -34,17 +169,35 @@ class WebTreeHandler(object):
     Tree object handler
     '''
     def __init__(self, newick, alg, tid, actions, style, predraw_fn=None):
-        try:
-            self.tree = PhyloTree(newick = newick, alignment = alg, alg_format="fasta")            
-        except NewickError:
-            self.tree = Tree(newick, format=1)
+        from ete3 import PhyloTree, Tree
+        from ete3.parser.newick import NewickError
+
+        with phase('parse'):
+            if isinstance(alg, Upload):
+                # Only the sequences of the tree leaves are read from uploaded alignments
+                try:
+                    self.tree = PhyloTree(newick = newick)
+                except NewickError:
+                    self.tree = Tree(newick, format=1)
+                    alg.close()
+                else:
+                    fasta = alg.fasta(self.tree.get_leaf_names())
+                    if fasta:
+                        self.tree.link_to_alignment(fasta, alg_format="fasta")
+                    del fasta
+            else:
+                try:
+                    self.tree = PhyloTree(newick = newick, alignment = alg, alg_format="fasta")            
+                except NewickError:
+                    self.tree = Tree(newick, format=1)
             
         self.diffdict = dict()
-        self.diffdict['nodes'] = dict()
+        self.diffdict['nodes'] = DiffStore()
         self.diffdict['target'] = ''
             
         if predraw_fn:
-            predraw_fn(self.tree)
+            with phase('predraw'):
+                predraw_fn(self.tree)
         self.tree.actions = actions
         self.tree.tree_style = style
 
@@ -52,13 +205,269 @@ class WebTreeHandler(object):
         self.mapid = "map_" + tid
         self.imgid = "img_" + tid
         self.boxid = 'box_' + tid
-        # Initialze node internal IDs
+        # Uploaded alignments are identified by the digest of the whole file
+        self.source_digest = content_digest(newick, 'sha1:' + alg.digest if isinstance(alg, Upload) else alg)
+        # Initialze node internal IDs, the _nid -> node index and the _nid -> parent _nid index
+        self.nodes = dict()
+        self.parents = dict()
+        self.topology_version = 0
         for index, n in enumerate(self.tree.traverse('preorder')):
             n._nid = index
-            n.diffdict = {'target_nodeid' : -1, 'distance' : None, 'side1' : None, 'side2' : None, 'diff' : set()}
-            self.diffdict['nodes'][n._nid] = {'target_nodeid' : -1, 'distance' : None, 'side1' : None, 'side2' : None, 'diff' : set()}
+            n.diffdict = self.diffdict['nodes'].set(index)
+            self.nodes[index] = n
+            self.parents[index] = n.up._nid if n.up else -1
+        self._next_nid = len(self.nodes)
+        self._diff_params = None
+
+        # Level of detail, collapsed node internal IDs -> summary face
+        self.lod_max_leaves = None
+        self.collapsed = dict()
+
+        # Render cache, invalidated whenever the tree or its style change
+        self.version = 0
+        self._render_cache = OrderedDict()
+        self._image_cache = None
+
+        # Node search index, rebuilt on the first search after the tree changes
+        self.search_features = ('name',)
+        self._search_index = (self.version, NodeIndex(self.nodes, self.search_features))
+
+    def touch(self):
+        '''
+        Marks the tree as modified, invalidating the cached renders
+
+        Parameters:
+            self: self handler
 
-    def diff(self, ht, attr1 = 'name', attr2 = 'name', dist_fn=EUCL_DIST, support=None, reduce_matrix=False, extended=False, jobs=1, parallel=None):
+        Returns:
+            None
+        '''
+        self.version += 1
+        for _, future in self._render_cache.values():
+            future.cancel()
+        self._render_cache.clear()
+
+    def set_style(self, style):
+        '''
+        Changes the tree style
+
+        Parameters:
+            self: self handler
+            style: new tree style, as TreeStyle
+
+        Returns:
+            None
+        '''
+        self.tree.tree_style = style
+        self.touch()
+
+    def render_async(self, tree_style=None, nodeid=None):
+        '''
+        Starts rendering the tree image, reusing the last render while neither the tree nor the style change
+
+        Parameters:
+            self: self handler
+            tree_style: style used to render the tree, the tree style if not given
+            nodeid: internal ID of the node whose clade is rendered alone, the whole tree if not given
+
+        Returns:
+            Future: future of the base64 encoded PNG image, as string, and image map
+        '''
+        if tree_style is None:
+            tree_style = self.tree.tree_style
+        key = (id(tree_style), None if nodeid is None else int(nodeid))
+
+        cached = self._render_cache.get(key)
+        if cached and cached[0] is tree_style:
+            self._render_cache.move_to_end(key)
+            return cached[1]
+
+        if nodeid is None:
+            future = submit_render(self.tree, tree_style)
+        else:
+            # The clade is rendered as a tree of its own, keeping its node internal IDs,
+            # and the rest of the tree is neither pickled nor drawn
+            node = self.get_node(nodeid)
+            up = node.up
+            node.up = None
+            try:
+                future = submit_render(node, tree_style)
+            finally:
+                node.up = up
+        self._render_cache[key] = (tree_style, future)
+        # The least recently used clade renders are dropped, not cancelled as they may be awaited
+        clades = [cached_key for cached_key in self._render_cache if cached_key[1] is not None]
+        for cached_key in clades[:max(0, len(clades) - MAX_CLADE_RENDERS)]:
+            del self._render_cache[cached_key]
+        return future
+
+    def start_renders(self, nodeid=None, target=True):
+        '''
+        Starts the renders drawing the tree, or one of its clades, needs: its own and, unless
+        disabled, that of the diff target, or of the target clade matched with the clade
+
+        Parameters:
+            self: self handler
+            nodeid: internal ID of the node whose clade is drawn alone, the whole tree if not given
+            target: whether to also render the diff target, as boolean
+
+        Returns:
+            list: render futures
+        '''
+        futures = [self.render_async(nodeid=nodeid)]
+        target_handler = self.diffdict['target']
+        if target and target_handler:
+            target_nodeid = None
+            if nodeid is not None:
+                target_nodeid = self.diffdict['nodes'].target_nodeid(self.get_node(nodeid)._nid)
+                if target_nodeid == -1:
+                    target_nodeid = None
+            futures.append(target_handler.render_async(self.tree.tree_style, target_nodeid))
+        return futures
+
+    def render(self, tree_style=None, nodeid=None):
+        '''
+        Renders the tree image, reusing the last render while neither the tree nor the style change
+
+        Parameters:
+            self: self handler
+            tree_style: style used to render the tree, the tree style if not given
+            nodeid: internal ID of the node whose clade is rendered alone, the whole tree if not given
+
+        Returns:
+            tuple: base64 encoded PNG image, as string, and image map
+        '''
+        if tree_style is None:
+            tree_style = self.tree.tree_style
+        try:
+            return self.render_async(tree_style, nodeid).result()
+        except:
+            # Failed renders are not cached
+            self._render_cache.pop((id(tree_style), None if nodeid is None else int(nodeid)), None)
+            raise
+
+    def __getstate__(self):
+        # The diff target is referenced by its tree id and cached renders are not kept
+        state = self.__dict__.copy()
+        state['diffdict'] = dict(self.diffdict)
+        target = self.diffdict['target']
+        state['diffdict']['target'] = target.treeid if target else ''
+        state['_render_cache'] = OrderedDict()
+        state['_image_cache'] = None
+        state['_search_index'] = None
+        return state
+
+    def memory_usage(self):
+        '''
+        Estimates the memory used by the tree nodes, their diff data and the cached renders
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            integer: size in bytes
+        '''
+        # Objects shared with other handlers (actions, style, parent links) are not accounted
+        seen = set([id(self.tree.actions), id(self.tree.tree_style)])
+        size = sys.getsizeof(self) + _getsizeof(self.nodes, seen)
+        for node in self.tree.traverse():
+            size += sys.getsizeof(node)
+            for name, value in node.__dict__.items():
+                if name in ('up', 'children'):
+                    size += sys.getsizeof(value)
+                else:
+                    size += _getsizeof(value, seen)
+        size += self.diffdict['nodes'].memory_usage()
+        return size + self.render_memory_usage()
+
+    def render_memory_usage(self):
+        '''
+        Estimates the memory used by the cached renders and tree image
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            integer: size in bytes
+        '''
+        seen = set()
+        size = 0
+        for _, future in list(self._render_cache.values()):
+            if future.done() and not future.cancelled() and future.exception() is None:
+                size += _getsizeof(future.result(), seen)
+        if self._image_cache is not None:
+            size += sys.getsizeof(self._image_cache[1])
+        return size
+
+    def get_node(self, nodeid):
+        '''
+        Fetches a node from its internal ID
+
+        Parameters:
+            self: self handler
+            nodeid: node internal ID, as integer or string
+
+        Returns:
+            node: tree node
+        '''
+        return self.nodes[int(nodeid)]
+
+    def sync_nodes(self):
+        '''
+        Updates the node index after a structural change of the tree. Nodes keep their _nid,
+        new nodes get a fresh one and removed nodes are dropped together with their diff data
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            boolean: whether the tree structure changed, either adding, removing or moving nodes
+        '''
+        seen = set()
+        new_nodes = []
+        moved = []
+        for n in self.tree.traverse('preorder'):
+            nid = getattr(n, '_nid', None)
+            if nid is not None and self.nodes.get(nid) is n:
+                seen.add(nid)
+                if self.nodes.get(self.parents[nid]) is not n.up:
+                    moved.append(n)
+            else:
+                new_nodes.append(n)
+
+        removed = set(self.nodes) - seen
+        if not new_nodes and not removed and not moved:
+            return False
+
+        for nid in removed:
+            del self.nodes[nid]
+            del self.parents[nid]
+            self.collapsed.pop(nid, None)
+            self.diffdict['nodes'].pop(nid, None)
+
+        # Parents are set in preorder, before their children
+        for n in new_nodes:
+            n._nid = self._next_nid
+            n.diffdict = self.diffdict['nodes'].set(n._nid)
+            self.nodes[n._nid] = n
+            self.parents[n._nid] = n.up._nid if n.up else -1
+            self._next_nid += 1
+
+        for n in moved:
+            self.parents[n._nid] = n.up._nid if n.up else -1
+
+        # Target nodes matched with removed nodes are left unmatched
+        target = self.diffdict['target']
+        if target and removed:
+            target_diff = target.diffdict['nodes']
+            for nid in target_diff:
+                if target_diff.target_nodeid(nid) in removed:
+                    target_diff.set_target_nodeid(nid, -1)
+
+        self.topology_version += 1
+        return True
+
+    def diff(self, ht, attr1 = 'name', attr2 = 'name', dist_fn=None, support=None, reduce_matrix=False, extended=False, jobs=1, parallel=None, symmetric=False, cache=None):
         '''
         Calculates treediff for self handler and a target tree and loads the data into handler properties
 
@@ -67,7 +476,8 @@ class WebTreeHandler(object):
             ht: target tree handler, as tree handler object
             attr1: observed attribute for the reference node, as string
             attr2: observed attribute for the target node, as string
-            dist_fn: distance function that will be used to calculate the distances between nodes, as python function
+            dist_fn: distance function that will be used to calculate the distances between nodes, as python function,
+                ete_diff EUCL_DIST if not given
             support: whether to use support values for the different calculations, as boolean
             reduce_matrix: whether to reduce the distances matrix removing columns and rows where observations equal to 0 (perfect matches) are found, as boolean
             extended: whether to use an extension function, as python function
@@ -75,51 +485,450 @@ class WebTreeHandler(object):
             parallel: parallelization method, as string. Options are:
                 async for asyncronous parallelization
                 sync for asyncronous parallelization
+            symmetric: whether to also load the reverse mapping into the target handler from the same
+                treediff computation, keeping the best match for each target node. Target nodes not
+                matched by any reference node are matched on their own, as boolean
+            cache: treediff results cache, used while both trees keep their loaded topology, as DiffCache.
+                Symmetric comparisons also store there the reverse mapping
 
         Returns:
             None
         '''
+        params = diff_params(attr1, attr2, dist_fn, support, reduce_matrix, extended)
+        # Kept to recalculate the diff of modified clades
+        self._diff_params = dict(params, jobs=jobs, parallel=parallel)
+        reverse_params = dict(params, attr1=attr2, attr2=attr1)
+        if symmetric:
+            ht._diff_params = dict(reverse_params, jobs=jobs, parallel=parallel)
+
+        rows = None
+        key = None
+        reverse_rows = None
+        if cache is not None and self.topology_version == 0 and ht.topology_version == 0:
+            key = cache.key(self.source_digest, ht.source_digest, params)
+            rows = cache.get(key)
+            if rows is not None and symmetric:
+                reverse_rows = cache.get(content_digest(key, 'symmetric'))
+            if rows is None and symmetric and cache.get(cache.key(ht.source_digest, self.source_digest, reverse_params)) is not None:
+                # Both mappings come from the cached reverse comparison
+                ht.diff(self, jobs=jobs, parallel=parallel, symmetric=True, cache=cache, **reverse_params)
+                return
 
-        result = treediff(self.tree, ht.tree, attr1 = attr1, attr2 = attr2, dist_fn=dist_fn, support=support, reduce_matrix=reduce_matrix, extended=extended, jobs=jobs)
+        if rows is None:
+            rows = diff_rows(self.tree, ht.tree, jobs=jobs, parallel=parallel, **params)
+            if key is not None:
+                cache.put(key, rows)
         
         self.diffdict['target'] = ht
-        
-        for r in result:
-            node = self.tree.search_nodes(_nid=int(r[-2]._nid))[0]
-            target = ht.tree.search_nodes(_nid=int(r[-1]._nid))[0]
-            dist = r[0]
-            side1 = r[2]
-            side2 = r[3]
-            diff = r[4]
-            
-            node.diffdict = {'target_nodeid' : target._nid, 'distance' : dist, 'side1' : side1, 'side2' : side2, 'diff' : diff} 
-            
-            self.diffdict['nodes'][node._nid] = {'target_nodeid' : target._nid, 'distance' : dist, 'side1' : side1, 'side2' : side2, 'diff' : diff} 
-            
+        if symmetric:
+            ht.diffdict['target'] = self
+
+        reverse = dict()
+        for nid, target_nid, dist, side1, side2, diff in rows:
+            self.set_diff(self.get_node(nid), target_nid, dist, side1, side2, diff)
+
+            if symmetric and reverse_rows is None:
+                best = reverse.get(target_nid)
+                if best is None or dist < best[1]:
+                    reverse[target_nid] = (nid, dist, side2, side1, _reverse_diff(side1, side2, diff))
+
+        if symmetric and reverse_rows is None:
+            # Target nodes that are not the best match of any reference node get their own
+            unmatched = set(ht.nodes) - set(reverse)
+            if unmatched:
+                for row in match_nodes(ht.tree, unmatched, self.tree, jobs=jobs, parallel=parallel, **reverse_params):
+                    reverse[row[0]] = row[1:]
+                log.info('matched %d target nodes of tree %s not matched by the reverse mapping' %(len(unmatched), ht.treeid))
+            reverse_rows = [(nid,) + row for nid, row in reverse.items()]
+            if key is not None:
+                cache.put(content_digest(key, 'symmetric'), reverse_rows)
+
+        for nid, target_nid, dist, side1, side2, diff in reverse_rows or ():
+            ht.set_diff(ht.get_node(nid), target_nid, dist, side1, side2, diff)
+
+    def rediff(self, first_nid=None):
+        '''
+        Recalculates the diff data after a structural change of the tree. Only nodes whose observed
+        attributes changed, which include the ancestors of modified clades, and new nodes are
+        updated, each one scored against the target tree nodes. Target nodes matched with updated
+        or removed nodes are scored again against the tree nodes in the same way
+
+        Parameters:
+            self: self handler
+            first_nid: first internal ID given to nodes created by the change, as integer
+
+        Returns:
+            integer: number of updated nodes
+        '''
+        ht = self.diffdict['target']
+        if not ht or self._diff_params is None:
+            return 0
+
+        params = dict((key, value) for key, value in self._diff_params.items() if key not in ('jobs', 'parallel'))
+        content = self.tree.get_cached_content(store_attr=params['attr1'])
+        nodes_diff = self.diffdict['nodes']
+        changed = []
+        for nid, n in self.nodes.items():
+            side1 = nodes_diff[nid]['side1']
+            if (first_nid is not None and nid >= first_nid) or (side1 is not None and side1 != content[n]):
+                changed.append(n)
+        if not changed:
+            return 0
+
+        rows = score_nodes(changed, content, ht.tree, **params)
+        for nid, target_nid, dist, side1, side2, diff in rows:
+            self.set_diff(self.nodes[nid], target_nid, dist, side1, side2, diff)
+
+        # Target nodes matched with updated or removed nodes are matched again with the whole
+        # tree, the other target nodes only take an updated node if it is a better match
+        changed_nids = set(n._nid for n in changed)
+        reset = [ht.nodes[nid] for nid, entry in ht.diffdict['nodes'].items()
+                 if entry['target_nodeid'] == -1 or entry['target_nodeid'] in changed_nids]
+        reverse_params = ht._diff_params or dict(self._diff_params, attr1=params['attr2'], attr2=params['attr1'])
+        reverse_params = dict((key, value) for key, value in reverse_params.items() if key not in ('jobs', 'parallel'))
+        target_content = ht.tree.get_cached_content(store_attr=reverse_params['attr1'])
+        reverse_rows = score_nodes(reset, target_content, self.tree, **reverse_params)
+        for nid, target_nid, dist, side1, side2, diff in reverse_rows:
+            ht.set_diff(ht.nodes[nid], target_nid, dist, side1, side2, diff)
+        reset = set(n._nid for n in reset)
+        for nid, target_nid, dist, side1, side2, diff in rows:
+            entry = ht.diffdict['nodes'][target_nid]
+            if target_nid not in reset and dist < entry['distance']:
+                ht.set_diff(ht.nodes[target_nid], nid, dist, side2, side1, _reverse_diff(side1, side2, diff))
+        self.diffdict['nodes'].compact()
+        ht.diffdict['nodes'].compact()
+
+        log.info('rediff of tree %s updated %d nodes and %d target nodes, %d node pairs compared'
+                 %(self.treeid, len(rows), len(reverse_rows), len(rows) * len(ht.nodes) + len(reverse_rows) * len(self.nodes)))
+        return len(rows)
+
+    def set_diff(self, node, target_nodeid, dist, side1, side2, diff):
+        '''
+        Stores the diff information of a node
+
+        Parameters:
+            self: self handler
+            node: tree node
+            target_nodeid: internal ID of the matched node in the target tree, as integer
+            dist: distance between both nodes, as float
+            side1: observed attributes under the node, as set
+            side2: observed attributes under the matched node, as set
+            diff: attribute differences between both nodes, as set
+
+        Returns:
+            None
+        '''
+        node.diffdict = self.diffdict['nodes'].set(node._nid, target_nodeid, dist, side1, side2, diff)
             
                     
-    def redraw(self):
+    def set_level_of_detail(self, max_leaves=None):
+        '''
+        Collapses clades so that at most max_leaves leaves and collapsed clades are drawn,
+        making render time and image map size depend on the visible nodes. Clades are
+        expanded from the root, the most divergent ones first
+
+        Parameters:
+            self: self handler
+            max_leaves: maximum number of visible leaves, every node is drawn if not given
+
+        Returns:
+            integer: number of collapsed clades
+        '''
+        self.lod_max_leaves = max_leaves
+        for nid in list(self.collapsed):
+            self._set_collapsed(self.nodes[nid], False)
+        if max_leaves:
+            self._expand(self.tree, max_leaves)
+        self.touch()
+        return len(self.collapsed)
+
+    def expand_node(self, nodeid, max_leaves=None):
+        '''
+        Expands a collapsed clade, its most divergent subclades first
+
+        Parameters:
+            self: self handler
+            nodeid: node internal ID, as integer or string
+            max_leaves: maximum number of visible leaves in the clade, the tree level of detail if not given
+
+        Returns:
+            integer: number of collapsed clades
+        '''
+        node = self.get_node(nodeid)
+        self._expand(node, max_leaves or self.lod_max_leaves or len(node))
+        self.touch()
+        return len(self.collapsed)
+
+    def collapse_node(self, nodeid):
+        '''
+        Collapses a clade
+
+        Parameters:
+            self: self handler
+            nodeid: node internal ID, as integer or string
+
+        Returns:
+            integer: number of collapsed clades
+        '''
+        node = self.get_node(nodeid)
+        if not node.is_leaf():
+            self._set_collapsed(node, True)
+            self.touch()
+        return len(self.collapsed)
+
+    def _expand(self, root, max_leaves):
+        # Greedy expansion: the clade holding the largest distance to the target tree, and
+        # the biggest one on ties, is expanded while the visible leaves fit in max_leaves
+        nodes_diff = self.diffdict['nodes']
+        divergence = dict()
+        for n in root.traverse('postorder'):
+            dist = nodes_diff.distance(n._nid)
+            dist = 1.0 if dist is None else dist
+            divergence[n] = max([dist] + [divergence[ch][0] for ch in n.children]), sum(divergence[ch][1] for ch in n.children) or 1
+
+        heap = [(-divergence[root][0], -divergence[root][1], root._nid, root)]
+        visible = 1
+        while heap:
+            _, _, _, node = heapq.heappop(heap)
+            if node.is_leaf():
+                continue
+            if visible + len(node.children) - 1 > max_leaves:
+                self._set_collapsed(node, True)
+                continue
+            self._set_collapsed(node, False)
+            visible += len(node.children) - 1
+            for ch in node.children:
+                heapq.heappush(heap, (-divergence[ch][0], -divergence[ch][1], ch._nid, ch))
+
+    def _set_collapsed(self, node, collapsed):
+        if collapsed and node._nid not in self.collapsed:
+            from ete3 import TextFace
+            node.img_style['draw_descendants'] = False
+            face = TextFace(' [%d leaves]' %len(node), fsize=8, fgcolor='#666666')
+            node.add_face(face, column=0, position='branch-right')
+            self.collapsed[node._nid] = face
+        elif not collapsed and node._nid in self.collapsed:
+            node.img_style['draw_descendants'] = True
+            face = self.collapsed.pop(node._nid)
+            container = getattr(node._faces, 'branch-right')
+            for column, faces in list(container.items()):
+                if face in faces:
+                    faces.remove(face)
+                    if not faces:
+                        del container[column]
+
+    def node_area(self, nodeid, node_areas):
+        '''
+        Fetches the image area of a node, or of its visible ancestor when the node is inside a collapsed clade
+
+        Parameters:
+            self: self handler
+            nodeid: node internal ID, as integer
+            node_areas: node areas of the tree image map
+
+        Returns:
+            list: x1, y1, x2, y2 node area
+        '''
+        while nodeid != -1 and nodeid not in node_areas:
+            nodeid = self.parents.get(nodeid, -1)
+        return node_areas.get(nodeid, [0,0,0,0])
+
+    def redraw(self, image_url=None):
         '''
         Generates the html tree image and related information
 
         Parameters:
             self: self handler
+            image_url: URL of the tree image, the image is inlined as a data URI if not given
 
         Returns:
             html text: Tree image and related information
         '''
-        base64_img, img_map = self.tree.render("%%return.PNG", tree_style=self.tree.tree_style)
-        _, target_map = self.diffdict['target'].tree.render("%%return.PNG", tree_style=self.tree.tree_style)
-        base64_img = base64_img.data().decode("utf-8")
+        # Both trees are rendered at the same time when there is a render pool
+        with phase('render_target'):
+            target_render = self.diffdict['target'].render_async(self.tree.tree_style)
+        with phase('render_self'):
+            base64_img, img_map = self.render()
+        with phase('render_target'):
+            _, target_map = target_render.result()
         
-        html_map = self.get_html_map(img_map,target_map)
+        with phase('map'):
+            html_map = self.get_html_map(img_map,target_map)
 
-        html_img = """<img id="%s" class="ete_tree_img" USEMAP="#%s" onLoad="javascript:bind_popup();" src="data:image/gif;base64,%s">""" %(self.imgid, self.mapid, base64_img)
+        if image_url is None:
+            image_url = "data:image/gif;base64,%s" %base64_img
+        html_img = """<img id="%s" class="ete_tree_img" USEMAP="#%s" onLoad="javascript:bind_popup();" src="%s">""" %(self.imgid, self.mapid, image_url)
         ete_link = '<div style="margin:0px;padding:0px;text-align:left;"><a href="http://etetoolkit.org" style="font-size:7pt;" target="_blank" >Powered by etetoolkit</a></div>'
 
         tree_div_id = self.boxid
         return html_map+ '<div id="%s" >'%tree_div_id + html_img + ete_link + "</div>"
 
+    def redraw_geometry(self):
+        '''
+        Generates the tree node geometry and diff information, the image is fetched separately with get_image
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            dict: columnar node geometry and diff information
+        '''
+        with phase('render_target'):
+            target_render = self.diffdict['target'].render_async(self.tree.tree_style)
+        with phase('render_self'):
+            _, img_map = self.render()
+        with phase('render_target'):
+            _, target_map = target_render.result()
+        with phase('map'):
+            return self.get_geometry(img_map, target_map)
+
+    def redraw_subtree_geometry(self, nodeid):
+        '''
+        Generates the node geometry and diff information of a clade and of its matched clade
+        in the target tree, each drawn alone. Node internal IDs are those of the whole trees
+
+        Parameters:
+            self: self handler
+            nodeid: internal ID of the clade root node
+
+        Returns:
+            tuple: columnar node geometry of the clade and of the target clade, the whole target
+                tree when the node has no match
+        '''
+        nodeid = self.get_node(nodeid)._nid
+        target = self.diffdict['target']
+        target_nodeid = self.diffdict['nodes'].target_nodeid(nodeid)
+        if target_nodeid == -1:
+            target_nodeid = None
+
+        with phase('render_target'):
+            target_render = target.render_async(self.tree.tree_style, target_nodeid)
+        with phase('render_self'):
+            _, img_map = self.render(nodeid=nodeid)
+        with phase('render_target'):
+            _, target_map = target_render.result()
+
+        with phase('map'):
+            geometry = self.get_geometry(img_map, target_map)
+            target_geometry = target.get_geometry(target_map, img_map)
+        geometry['nodeid'] = nodeid
+        target_geometry['nodeid'] = target_nodeid
+        return geometry, target_geometry
+
+    def search(self, query, mode='substring', limit=50):
+        '''
+        Finds the nodes whose name or search features match a query, with their image areas
+        and matched target nodes
+
+        Parameters:
+            self: self handler
+            query: searched text, case insensitive
+            mode: "exact", "prefix" or "substring" match
+            limit: maximum number of nodes returned
+
+        Returns:
+            dict: number of matches and columnar node IDs, names, boxes, matched target node
+                IDs, target node boxes and distances of the first matches
+        '''
+        if self._search_index is None or self._search_index[0] != self.version:
+            self._search_index = (self.version, NodeIndex(self.nodes, self.search_features))
+        nids = self._search_index[1].search(query, mode)
+
+        target = self.diffdict['target']
+        target_render = target.render_async(self.tree.tree_style) if nids else None
+        node_areas = self.render()[1]['node_areas'] if nids else {}
+        target_areas = target_render.result()[1]['node_areas'] if nids else {}
+        nodes_diff = self.diffdict['nodes']
+
+        matches = {'nid' : [], 'name' : [], 'box' : [], 'target_nid' : [], 'target_box' : [], 'dist' : []}
+        for nid in nids[:limit]:
+            target_nodeid = nodes_diff.target_nodeid(nid)
+            # Nodes inside collapsed clades are shown at their visible ancestor
+            area = self.node_area(nid, node_areas)
+            area2 = target.node_area(target_nodeid, target_areas)
+            dist = nodes_diff.distance(nid)
+            matches['nid'].append(nid)
+            matches['name'].append(self.nodes[nid].name)
+            matches['box'].extend((int(area[0]), int(area[1]), int(area[2]-area[0]), int(area[3]-area[1])))
+            matches['target_nid'].append(target_nodeid)
+            matches['target_box'].extend((int(area2[0]), int(area2[1]), int(area2[2]-area2[0]), int(area2[3]-area2[1])))
+            matches['dist'].append(1.0 if dist is None else round(float(dist), 4))
+
+        return {'treeid' : self.treeid, 'target_treeid' : target.treeid, 'version' : self.version,
+                'query' : query, 'mode' : mode, 'total' : len(nids), 'matches' : matches}
+
+    def get_image(self, nodeid=None):
+        '''
+        Fetches the tree image
+
+        Parameters:
+            self: self handler
+            nodeid: internal ID of the node whose clade image is fetched, the whole tree if not given
+
+        Returns:
+            tuple: PNG image, as bytes, and its strong ETag
+        '''
+        future = self.render_async(nodeid=nodeid)
+        cached = self._image_cache
+        if cached and cached[0] is future:
+            return cached[1], cached[2]
+
+        with phase('render_self'):
+            base64_img, _ = self.render(nodeid=nodeid)
+        png = base64.b64decode(base64_img)
+        etag = '"%s"' %hashlib.sha1(png).hexdigest()
+        self._image_cache = (future, png, etag)
+        return png, etag
+
+    def get_geometry(self, img_map, target_map, clip=None):
+        '''
+        Generates the compact, columnar, equivalent of the html tree map. Areas hold the
+        clickable regions of nodes and faces; nodes hold, for every node with an area, its
+        box, matched target node, target node box and distance. Boxes are flat x, y, width,
+        height lists and area coordinates flat x1, y1, x2, y2 lists
+
+        Parameters:
+            self: self handler
+            img_map: self tree image map from tree.render
+            target_map: target tree image map from tree.render
+            clip: x1, y1, x2, y2 image region, only the areas overlapping it are kept if given
+
+        Returns:
+            dict: node geometry and diff information
+        '''
+        node_areas = img_map["node_areas"]
+        target_areas = target_map["node_areas"]
+        nodes_diff = self.diffdict['nodes']
+        target = self.diffdict['target']
+
+        areas = {'nid' : [], 'coords' : [], 'text' : []}
+        nodes = {'nid' : [], 'box' : [], 'target_nid' : [], 'target_box' : [], 'dist' : []}
+        seen = set()
+        for kind in ("nodes", "faces"):
+            for x1, y1, x2, y2, nodeid, text in img_map[kind] or []:
+                if clip and (x2 < clip[0] or y2 < clip[1] or x1 > clip[2] or y1 > clip[3]):
+                    continue
+                areas['nid'].append(nodeid)
+                areas['coords'].extend((int(x1), int(y1), int(x2), int(y2)))
+                areas['text'].append(text or "")
+                if nodeid in seen:
+                    continue
+                seen.add(nodeid)
+
+                target_nodeid = nodes_diff.target_nodeid(int(nodeid))
+                area = node_areas.get(int(nodeid), [0,0,0,0])
+                area2 = target.node_area(target_nodeid, target_areas)
+                dist = nodes_diff.distance(int(nodeid))
+                nodes['nid'].append(nodeid)
+                nodes['box'].extend((int(area[0]), int(area[1]), int(area[2]-area[0]), int(area[3]-area[1])))
+                nodes['target_nid'].append(target_nodeid)
+                nodes['target_box'].extend((int(area2[0]), int(area2[1]), int(area2[2]-area2[0]), int(area2[3]-area2[1])))
+                nodes['dist'].append(1.0 if dist is None else round(float(dist), 4))
+
+        return {'treeid' : self.treeid, 'target_treeid' : self.diffdict['target'].treeid,
+                'mapid' : self.mapid, 'imgid' : self.imgid, 'boxid' : self.boxid,
+                'version' : self.version, 'areas' : areas, 'nodes' : nodes}
+
     def get_html_map(self, img_map, target_map):
         '''
         Generates the html tree map
@@ -133,39 +942,41 @@ class WebTreeHandler(object):
             html: html map for self tree image web representation
         '''
         
-        html_map = '<MAP NAME="%s" class="ete_tree_img">' %(self.mapid)
-        if img_map["nodes"]:
-            for x1, y1, x2, y2, nodeid, text in img_map["nodes"]:
-                
-                text = "" if not text else text
-                area = img_map["node_areas"].get(int(nodeid), [0,0,0,0])
-                area2 = target_map["node_areas"].get(int(self.diffdict['nodes'][nodeid]['target_nodeid']), [0,0,0,0])
-                html_map += """ <AREA SHAPE="rect" COORDS="%s,%s,%s,%s" 
-                                onMouseLeave='hide_diff();'
-                                onMouseEnter='highlight_node("%s", "%s", "%s", "%s", "%s", %s, %s, %s, %s, %s, %s, %s, %s, %.2f);'
-                                onClick='show_actions("%s", "%s", "%s");'
-                                href="javascript:void('%s');">""" %\
-                    (int(x1), int(y1), int(x2), int(y2), # coords
-                     self.treeid, self.diffdict['target'].treeid, nodeid, self.diffdict['nodes'][nodeid]['target_nodeid'], text, area[0], area[1], area[2]-area[0], area[3]-area[1], area2[0], area2[1], area2[2]-area2[0], area2[3]-area2[1], self.diffdict['nodes'][nodeid]['distance'], # highlight_node
-                     self.treeid, nodeid, text, # show_actions
-                     nodeid) # javascript:void
-
-        if img_map["faces"]:
-            for x1, y1, x2, y2, nodeid, text in img_map["faces"]:
+        target = self.diffdict['target']
+        target_treeid = target.treeid
+        node_areas = img_map["node_areas"]
+        target_areas = target_map["node_areas"]
+        nodes_diff = self.diffdict['nodes']
+
+        # highlight_node arguments are computed once per node, not once per area
+        node_args = dict()
+        def get_node_args(nodeid):
+            args = node_args.get(nodeid)
+            if args is None:
+                target_nodeid = nodes_diff.target_nodeid(int(nodeid))
+                area = node_areas.get(int(nodeid), [0,0,0,0])
+                area2 = target.node_area(target_nodeid, target_areas)
+                # Unmatched nodes are shown as completely different
+                dist = nodes_diff.distance(int(nodeid))
+                dist = 1.0 if dist is None else dist
+                args = ((self.treeid, target_treeid, nodeid, target_nodeid),
+                        (area[0], area[1], area[2]-area[0], area[3]-area[1], area2[0], area2[1], area2[2]-area2[0], area2[3]-area2[1], dist))
+                node_args[nodeid] = args
+            return args
+
+        parts = ['<MAP NAME="%s" class="ete_tree_img">' %(self.mapid)]
+        for template, areas, void_text in ((_NODE_AREA, img_map["nodes"], False), (_FACE_AREA, img_map["faces"], True)):
+            if not areas:
+                continue
+            for x1, y1, x2, y2, nodeid, text in areas:
                 text = "" if not text else text
-                area = img_map["node_areas"].get(int(nodeid), [0,0,0,0])
-                area2 = target_map["node_areas"].get(int(self.diffdict['nodes'][nodeid]['target_nodeid']), [0,0,0,0])
-                html_map += """ <AREA SHAPE="rect" COORDS="%s,%s,%s,%s"
-                                onMouseLeave='hide_diff();'
-                                onMouseEnter='highlight_node("%s", "%s", "%s", "%s", "%s", %s, %s, %s, %s, %s, %s, %s, %s, %.2f);'
-                                onClick='show_actions("%s", "%s", "%s");'
-                                href='javascript:void("%s");'>""" %\
-                    (int(x1),int(y1),int(x2),int(y2),
-                     self.treeid, self.diffdict['target'].treeid, nodeid, self.diffdict['nodes'][nodeid]['target_nodeid'], text, area[0], area[1], area[2]-area[0], area[3]-area[1], area2[0], area2[1], area2[2]-area2[0], area2[3]-area2[1], self.diffdict['nodes'][nodeid]['distance'],
-                     self.treeid, nodeid, text,
-                     text)
-        html_map += '</MAP>'
-        return html_map
+                ids, coords = get_node_args(nodeid)
+                parts.append(template %((int(x1), int(y1), int(x2), int(y2)) + # coords
+                                        ids + (text,) + coords + # highlight_node
+                                        (self.treeid, nodeid, text, # show_actions
+                                         text if void_text else nodeid))) # javascript:void
+        parts.append('</MAP>')
+        return ''.join(parts)
 
     def get_avail_actions(self, nodeid):
         '''
@@ -178,7 +989,7 @@ class WebTreeHandler(object):
         Returns:
             list: action list
         '''
-        target = self.tree.search_nodes(_nid=int(nodeid))[0]
+        target = self.get_node(nodeid)
         action_list = []
         for aindex, aname, show_fn, run_fn in self.tree.actions:
             if show_fn(target):
@@ -188,17 +999,23 @@ class WebTreeHandler(object):
     def run_action(self, aindex, nodeid, side = 'source'):
 
         if side == 'source':
-            node = self.tree.search_nodes(_nid=int(nodeid))[0]
+            node = self.get_node(nodeid)
             diff = node.diffdict['diff']
         elif side == 'target':
             nodeid = self.diffdict['target'].diffdict['nodes'][int(nodeid)]['target_nodeid']
-            node = self.tree.search_nodes(_nid=int(nodeid))[0]
+            node = self.get_node(nodeid)
             diff = self.diffdict['nodes'][int(nodeid)]['diff']
         else: 
             node = None
             diff = None
         run_fn = self.tree.actions.actions[aindex][2]
-        return run_fn(self.tree, node, diff)
+        first_nid = self._next_nid
+        with phase('action'):
+            result = run_fn(self.tree, node, diff)
+        if self.sync_nodes():
+            self.rediff(first_nid)
+        self.touch()
+        return result
     
 class NodeActions(object):
     '''
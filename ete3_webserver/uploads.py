@@ -0,0 +1,248 @@
+import re
+import gzip
+import zlib
+import hashlib
+import tempfile
+import logging as log
+
+
+CHUNK_SIZE = 1 << 16
+GZIP_MAGIC = b'\x1f\x8b'
+_BOUNDARY = re.compile(r'boundary=(?:"([^"]+)"|([^;\s]+))', re.I)
+_PARAM = re.compile(r';\s*([\w-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;]*))')
+
+
+class UploadError(ValueError):
+    '''
+    Raised when a multipart request or an uploaded file cannot be read
+    '''
+
+class UploadTooLarge(UploadError):
+    '''
+    Raised when an uploaded file is larger than allowed, as received or once decompressed
+    '''
+
+
+class Upload(object):
+    '''
+    Tree or alignment file uploaded in a multipart request, spooled to a temporary file as
+    it is received. Gzip compressed files are decompressed on the fly when read, and the
+    digest of their content is calculated meanwhile, so uploads are never held in memory
+    as a whole. Uploads are read once, the temporary file is removed when read
+    '''
+    def __init__(self, name, filename='', max_bytes=None):
+        self.name = name
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.received = 0
+        self.compressed = False
+        self._sha1 = hashlib.sha1()
+        self._file = tempfile.TemporaryFile()
+
+    def write(self, data):
+        '''
+        Appends received data to the temporary file, up to max_bytes
+
+        Parameters:
+            self: self handler
+            data: received data, as bytes
+
+        Returns:
+            None
+        '''
+        self.received += len(data)
+        if self.max_bytes is not None and self.received > self.max_bytes:
+            raise UploadTooLarge('Upload %s larger than %d bytes' %(self.filename or self.name, self.max_bytes))
+        self._file.write(data)
+
+    @property
+    def digest(self):
+        '''
+        Hexadecimal sha1 digest of the uploaded content once decompressed, known once read
+        '''
+        return self._sha1.hexdigest()
+
+    def _chunks(self):
+        self._file.seek(0)
+        self.compressed = self._file.read(len(GZIP_MAGIC)) == GZIP_MAGIC
+        self._file.seek(0)
+        # GzipFile also reads the concatenated gzip members written by pigz or cat
+        source = gzip.GzipFile(fileobj=self._file, mode='rb') if self.compressed else self._file
+        try:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+                self.size += len(chunk)
+                if self.max_bytes is not None and self.size > self.max_bytes:
+                    raise UploadTooLarge('Upload %s larger than %d bytes' %(self.filename or self.name, self.max_bytes))
+                self._sha1.update(chunk)
+                yield chunk
+        except (OSError, EOFError, zlib.error) as e:
+            raise UploadError('Unreadable upload %s: %s' %(self.filename or self.name, e))
+
+    def lines(self):
+        '''
+        Iterates the lines of the uploaded text, decompressing it if needed
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            iterator: text lines
+        '''
+        pending = []
+        for chunk in self._chunks():
+            start = 0
+            end = chunk.find(b'\n')
+            while end != -1:
+                pending.append(chunk[start:end + 1])
+                yield b''.join(pending).decode('utf-8', errors='replace')
+                pending = []
+                start = end + 1
+                end = chunk.find(b'\n', start)
+            if start < len(chunk):
+                pending.append(chunk[start:])
+        if pending:
+            yield b''.join(pending).decode('utf-8', errors='replace')
+
+    def text(self):
+        '''
+        Reads the whole uploaded text, used for the trees, which are parsed from strings
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            string: uploaded text, stripped
+        '''
+        with self:
+            return b''.join(self._chunks()).decode('utf-8', errors='replace').strip()
+
+    def fasta(self, names):
+        '''
+        Reads the sequences of the given names from an uploaded FASTA alignment, so only
+        the sequences of the tree leaves are ever kept in memory
+
+        Parameters:
+            self: self handler
+            names: sequence names to keep, usually the tree leaf names
+
+        Returns:
+            string: FASTA alignment of the kept sequences
+        '''
+        names = set(names)
+        kept = []
+        keep = False
+        found = total = 0
+        with self:
+            for line in self.lines():
+                header = line.strip()
+                if header.startswith('>'):
+                    total += 1
+                    # Sequence names as read by ete3, up to the first tab of the header
+                    keep = header[1:].split('\t')[0].strip() in names
+                    found += keep
+                if keep:
+                    kept.append(line)
+        log.info('kept %d of %d sequences from %s (%d bytes%s)' %(found, total, self.filename or self.name,
+                                                                  self.size, ', gzip' if self.compressed else ''))
+        return ''.join(kept)
+
+    def close(self):
+        '''
+        Removes the temporary file
+
+        Parameters:
+            self: self handler
+
+        Returns:
+            None
+        '''
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_multipart(stream, content_type, max_bytes=None):
+    '''
+    Reads the params of a multipart/form-data request body line by line. Files are spooled
+    to temporary files as they are read, instead of being buffered in memory
+
+    Parameters:
+        stream: request body, as binary file object
+        content_type: request content type, holding the multipart boundary
+        max_bytes: maximum size of every plain param, and of every file both as received and
+            once decompressed, unbounded if not given
+
+    Returns:
+        dict: param name -> value, as string, or uploaded file, as Upload
+    '''
+    match = _BOUNDARY.search(content_type or '')
+    if not match:
+        raise UploadError('Missing multipart boundary')
+    delimiter = b'--' + (match.group(1) or match.group(2)).encode('latin1')
+    terminator = delimiter + b'--'
+
+    def readline():
+        line = stream.readline(CHUNK_SIZE)
+        # Long lines are read in chunks, never splitting their line break
+        while line.endswith(b'\r'):
+            rest = stream.read(1)
+            if not rest:
+                break
+            line += rest
+        return line
+
+    params = dict()
+    line = readline()
+    while line and line.rstrip(b'\r\n') != delimiter:
+        line = readline()
+
+    while line and line.rstrip(b'\r\n') != terminator:
+        headers = dict()
+        line = readline()
+        while line.rstrip(b'\r\n'):
+            name, _, value = line.decode('utf-8', errors='replace').partition(':')
+            headers[name.strip().lower()] = value.strip()
+            line = readline()
+        if not line:
+            raise UploadError('Unexpected end of multipart body')
+
+        disposition = dict((key.lower(), quoted if quoted else plain.strip())
+                           for key, quoted, plain in _PARAM.findall(headers.get('content-disposition', '')))
+        name = disposition.get('name', '')
+        part = Upload(name, disposition['filename'], max_bytes) if 'filename' in disposition else []
+
+        # The line break before a delimiter belongs to it, so it is only written with the next line
+        size = 0
+        newline = b''
+        line = readline()
+        while line:
+            if newline and line.rstrip(b'\r\n') in (delimiter, terminator):
+                break
+            data = newline + line
+            newline = b''
+            if line.endswith(b'\r\n'):
+                data, newline = data[:-2], b'\r\n'
+            elif line.endswith(b'\n'):
+                data, newline = data[:-1], b'\n'
+            if isinstance(part, list):
+                size += len(data)
+                if max_bytes is not None and size > max_bytes:
+                    raise UploadTooLarge('Param %s larger than %d bytes' %(name, max_bytes))
+                part.append(data)
+            else:
+                try:
+                    part.write(data)
+                except UploadTooLarge:
+                    part.close()
+                    raise
+            line = readline()
+        else:
+            raise UploadError('Unexpected end of multipart body')
+
+        params[name] = b''.join(part).decode('utf-8', errors='replace') if isinstance(part, list) else part
+    return params
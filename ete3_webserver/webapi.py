@@ -1,44 +1,447 @@
-import gzip
+import os
+import time
+import json
+import tempfile
 import logging as log
-from io import StringIO, BytesIO
+from io import StringIO
+from collections import OrderedDict
+from contextlib import contextmanager
 from bottle import (run, get, post, request, route, response, abort, hook,
-                    error, HTTPResponse, static_file)
+                    error, HTTPResponse, static_file, redirect, install)
 
-from .tree_handler import WebTreeHandler, NodeActions, TreeStyle
+from .tree_handler import WebTreeHandler, NodeActions
+from .diff_cache import DiffCache
+from .sessions import TreeStore, FileTreeStore, TreeExpired
+from .server import PreforkServer, ThreadingWSGIServer
+from . import renderer
+from .renderer import RenderTimeout
+from .jobs import JobManager
+from .compression import CompressionCache, negotiate
+from .matrix import diff_matrix
+from .tiles import TileCache, TILE_SIZE, MAX_ZOOM
+from .metrics import METRICS, MetricsPlugin, current_request
+from .uploads import Upload, UploadError, UploadTooLarge, read_multipart
+from .mutations import MutationQueue
 
 
 
-LOADED_TREES = {}
+LOADED_TREES = TreeStore()
 COMPRESS_DATA = True
 COMPRESS_MIN_BYTES = 10000
+COMPRESS_CACHE = CompressionCache()
+IMAGE_MAX_AGE = 3600
 TREE_HANDLER = WebTreeHandler
+SYMMETRIC_DIFF = True
+DIFF_CACHE = None
+DIFF_JOBS = 1
+DIFF_PARALLEL = None
+JOBS = JobManager()
+MATRIX_WORKERS = None
+LOD_MAX_LEAVES = None
+UPLOAD_MAX_BYTES = None
+TILES = TileCache()
+MUTATIONS = MutationQueue()
+MUTATION_BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+METRICS_PLUGIN = MetricsPlugin(METRICS)
+install(METRICS_PLUGIN)
+METRICS.describe('ete_loaded_trees', 'gauge', 'Trees in the loaded tree store')
+METRICS.describe('ete_loaded_tree_bytes', 'gauge', 'Estimated size of the loaded trees')
+METRICS.describe('ete_tree_evictions', 'gauge', 'Trees evicted from the loaded tree store')
+METRICS.describe('ete_cache_entries', 'gauge', 'Entries of the compression and treediff caches')
+METRICS.describe('ete_cache_hits', 'gauge', 'Hits of the compression and treediff caches')
+METRICS.describe('ete_cache_misses', 'gauge', 'Misses of the compression and treediff caches')
+METRICS.describe('ete_mutation_batch_size', 'histogram', 'Tree mutations applied together, and redrawn once')
+METRICS.describe('ete_startup_seconds', 'gauge', 'Time the server worker took to start, and to warm up its renderer')
 
 def web_return(html, response):
     '''
     Generates the web return information
 
     Parameters:
-        html: html code
+        html: html code, or bytes of an already compressed content such as PNG images
         response: response code
 
     Returns:
         html: information to be returned
     '''
-    if COMPRESS_DATA and len(html) >= COMPRESS_MIN_BYTES:
-        chtmlF = BytesIO()
-        z = gzip.GzipFile(fileobj=chtmlF, mode='w')
-        
-        z.write(bytes(html,'utf-8'))
-        z.close()
-        chtmlF.seek(0)
-        html = chtmlF.read()
+    response.add_header('Vary', 'Accept-Encoding')
+    context = current_request()
+    if context is not None:
+        context.body_size = len(html)
+    encoding = negotiate(request.get_header('Accept-Encoding'))
+    if COMPRESS_DATA and encoding and not isinstance(html, bytes) and len(html) >= COMPRESS_MIN_BYTES:
+        html = COMPRESS_CACHE.compress(html.encode('utf-8'), encoding)
         log.info('returning compressed %0.3f KB' %(len(html)/1024.))
-        response.set_header( 'Content-encoding', 'gzip')
-        response.set_header( 'Content-length', len(html))
+        response.set_header('Content-Encoding', encoding)
+        response.set_header('Content-Length', len(html))
     else:
         log.info('returning %0.3f KB' %(len(html)/1024.))
     return html
 
+def get_tree(treeid):
+    '''
+    Fetches a loaded tree handler, aborting the request if it is not available
+
+    Parameters:
+        treeid: tree id, as string
+
+    Returns:
+        tree handler object
+    '''
+    try:
+        return LOADED_TREES[treeid]
+    except TreeExpired:
+        abort(410, 'Tree %s expired, please load it again' %treeid)
+    except KeyError:
+        abort(404, 'Tree %s not found' %treeid)
+
+def is_true(value):
+    '''
+    Interprets a request flag
+
+    Parameters:
+        value: flag value, as string, number or boolean
+
+    Returns:
+        boolean: False for empty, "0" and "false" values, True otherwise
+    '''
+    return str(value).strip().lower() not in ('', '0', 'false')
+
+def upload_error(e):
+    '''
+    Aborts the request on an unreadable or too large upload
+
+    Parameters:
+        e: UploadError exception
+
+    Returns:
+        None
+    '''
+    abort(413 if isinstance(e, UploadTooLarge) else 400, str(e))
+
+def load_params():
+    '''
+    Reads the params of the requests loading trees, given as JSON, as form params or as a
+    multipart form. Multipart files are spooled to temporary files rather than held in memory,
+    so large trees and alignments can be uploaded, gzip compressed or not
+
+    Parameters:
+        None
+
+    Returns:
+        dict: param name -> value, uploaded files as Upload
+    '''
+    if request.json:
+        return request.json
+    # bottle lowercases request.content_type, multipart boundaries are case sensitive
+    content_type = request.environ.get('CONTENT_TYPE', '')
+    if content_type.lower().startswith('multipart/'):
+        try:
+            return read_multipart(request.body, content_type, UPLOAD_MAX_BYTES)
+        except UploadError as e:
+            upload_error(e)
+    return request.POST
+
+def tree_inputs(source_dict, side):
+    '''
+    Reads the tree, alignment and tree id of the source ("1") or target ("2") side of a
+    tree pair. Uploaded alignments are read when the tree is loaded, once its leaves are known
+
+    Parameters:
+        source_dict: request params, as returned by load_params
+        side: "1" or "2"
+
+    Returns:
+        tuple: newick string, alignment as fasta string or Upload, and tree id
+    '''
+    newick = source_dict.get('newick' + side, '')
+    if isinstance(newick, Upload):
+        try:
+            newick = newick.text()
+        except UploadError as e:
+            upload_error(e)
+    alg = source_dict.get('alg' + side, '')
+    if not isinstance(alg, Upload):
+        alg = alg.strip()
+    return newick.strip(), alg, source_dict.get('treeid' + side, '').strip()
+
+def base_url():
+    '''
+    Generates the absolute URL of the web service from the current request
+
+    Parameters:
+        None
+
+    Returns:
+        string: base URL, ending with a slash
+    '''
+    parts = request.urlparts
+    return '%s://%s%s' %(parts.scheme, parts.netloc, request.script_name)
+
+def image_url(h, base=None, nodeid=None):
+    '''
+    Generates the URL of the current tree image
+
+    Parameters:
+        h: tree handler object
+        base: base URL of the web service, taken from the current request if not given
+        nodeid: internal ID of the node whose clade image is linked, the whole tree if not given
+
+    Returns:
+        string: absolute image URL, keyed by tree id and render version
+    '''
+    if nodeid is not None:
+        return '%ssubtree_image/%s/%s/%s' %(base or base_url(), h.treeid, nodeid, h.version)
+    return '%stree_image/%s/%s' %(base or base_url(), h.treeid, h.version)
+
+def tile_url(h, base=None):
+    '''
+    Generates the base URL of the current tree image tiles
+
+    Parameters:
+        h: tree handler object
+        base: base URL of the web service, taken from the current request if not given
+
+    Returns:
+        string: absolute URL, keyed by tree id and render version, to be followed by /zoom/x/y
+    '''
+    return '%stree_tile/%s/%s' %(base or base_url(), h.treeid, h.version)
+
+def image_return(img, etag, cacheable):
+    '''
+    Generates the web return of an image, revalidated with its ETag
+
+    Parameters:
+        img: PNG image, as bytes
+        etag: strong ETag of the image
+        cacheable: whether the browser can keep the image, as for versioned URLs
+
+    Returns:
+        png: image, or empty body if the browser copy is still valid
+    '''
+    response.set_header('ETag', etag)
+    if cacheable:
+        response.set_header('Cache-Control', 'public, max-age=%d' %IMAGE_MAX_AGE)
+    else:
+        response.set_header('Cache-Control', 'no-cache')
+
+    if etag in [tag.strip() for tag in request.get_header('If-None-Match', '').split(',')]:
+        response.status = 304
+        return ''
+
+    response.content_type = 'image/png'
+    return web_return(img, response)
+
+def tile_scene(h):
+    '''
+    Fetches the laid out scene of a tree, aborting the request if laying it out times out
+
+    Parameters:
+        h: tree handler object
+
+    Returns:
+        SceneLayout: tree scene
+    '''
+    try:
+        return TILES.scene(h)
+    except RenderTimeout:
+        abort(504, 'Laying out tree %s timed out' %h.treeid)
+
+def get_tile_scene(h, version, zoom, x, y, path):
+    '''
+    Fetches the laid out scene of a tree for a tile request, redirecting outdated versions
+    and aborting the request for tiles out of the tree image
+
+    Parameters:
+        h: tree handler object
+        version: requested tree render version
+        zoom: zoom level, as integer
+        x: tile column, as integer
+        y: tile row, as integer
+        path: tile service path, as string
+
+    Returns:
+        SceneLayout: tree scene
+    '''
+    if version != h.version:
+        redirect('%s%s/%s/%d/%d/%d/%d' %(base_url(), path, h.treeid, h.version, zoom, x, y))
+
+    scene = tile_scene(h)
+    x1, y1, _, _ = scene.tile_rect(zoom, x, y)
+    if not scene.min_zoom() <= zoom <= MAX_ZOOM or x < 0 or y < 0 or x1 >= scene.width or y1 >= scene.height:
+        abort(404, 'Tile %d/%d/%d of tree %s not found' %(zoom, x, y, h.treeid))
+    return scene
+
+def redraw_tree(h, output_format='', base=None):
+    '''
+    Redraws a tree, as html image and map or as JSON node geometry
+
+    Parameters:
+        h: tree handler object
+        output_format: "json" for the node geometry, the html image and map otherwise
+        base: base URL of the web service, used to link the tree image, the one of the
+            current request if not given
+
+    Returns:
+        string: html or JSON text
+    '''
+    try:
+        if output_format == 'json':
+            return json.dumps(h.redraw_geometry(), separators=(',', ':'))
+        return h.redraw(image_url(h, base))
+    except RenderTimeout:
+        abort(504, 'Rendering tree %s timed out' %h.treeid)
+
+def pair_key(h):
+    '''
+    Returns the key locking a tree together with its diff target, as mutating a tree also
+    updates the diff data of its target
+
+    Parameters:
+        h: tree handler object
+
+    Returns:
+        tuple: sorted tree ids
+    '''
+    target = h.diffdict['target']
+    return tuple(sorted((h.treeid, target.treeid) if target else (h.treeid,)))
+
+@contextmanager
+def locked_tree(treeid):
+    '''
+    Fetches a loaded tree handler, holding the lock of the tree and its diff target so no
+    mutation runs meanwhile
+
+    Parameters:
+        treeid: tree id, as string
+
+    Returns:
+        context manager giving the tree handler object
+    '''
+    with MUTATIONS.lock(pair_key(get_tree(treeid))):
+        yield get_tree(treeid)
+
+@contextmanager
+def rendered_tree(treeid, prepare):
+    '''
+    Fetches a loaded tree handler as locked_tree, once the drawings the request needs are
+    ready. They are started while holding the lock, from the current tree version, and
+    run without holding it, as the renders of mutations do. Drawings cancelled meanwhile by
+    a mutation, or failed, are then drawn again or reported while holding the lock
+
+    Parameters:
+        treeid: tree id, as string
+        prepare: function called with the tree handler object, starting the drawings and
+            returning the functions waiting for them
+
+    Returns:
+        context manager giving the tree handler object
+    '''
+    with locked_tree(treeid) as h:
+        try:
+            waits = prepare(h)
+        except Exception:
+            # e.g. unknown nodes, reported by the request handler
+            waits = []
+    for wait in waits:
+        try:
+            wait()
+        except Exception:
+            pass
+    with locked_tree(treeid) as h:
+        yield h
+        for pair_treeid in pair_key(h):
+            LOADED_TREES.measure_renders(pair_treeid)
+
+def tree_renders(nodeid=None, target=True):
+    '''
+    Returns the rendered_tree prepare function rendering a tree, or one of its clades, and
+    its diff target
+
+    Parameters:
+        nodeid: internal ID of the node whose clade is drawn alone, the whole tree if not given
+        target: whether to also render the diff target, as boolean
+
+    Returns:
+        function: prepare function
+    '''
+    return lambda h: [future.result for future in h.start_renders(nodeid, target)]
+
+def mutate_tree(treeid, mutate, output_format=''):
+    '''
+    Modifies a tree and redraws it. Mutations of a tree and its diff target are serialized,
+    and those queued meanwhile are applied together, the trees being redrawn once for all
+
+    Parameters:
+        treeid: tree id, as string
+        mutate: function called with the tree handler object to modify it
+        output_format: "json" for the node geometry, the html image and map otherwise
+
+    Returns:
+        string: html or JSON text of the tree once modified
+    '''
+    key = pair_key(get_tree(treeid))
+    drawing = MUTATIONS.submit(key, (treeid, mutate, output_format, base_url()), apply_mutations)
+    if output_format == 'json':
+        response.content_type = 'application/json'
+    return drawing
+
+def apply_mutations(batch, take, unlocked):
+    '''
+    Applies a batch of queued tree mutations and redraws every modified tree once. Mutations
+    queued while the batch is applied join it, so no render is started for a tree version
+    that has already moved on. The renders run without holding the trees lock, and every
+    request of the batch then gets the drawing of the latest tree version
+
+    Parameters:
+        batch: mutations, as list of tree id, mutate function, output format and base URL
+        take: function returning the mutations queued since, which join the batch
+        unlocked: context manager releasing the trees lock
+
+    Returns:
+        list: error or None, and drawing, of every mutation
+    '''
+    batch = list(batch)
+    outcomes = []
+    handlers = OrderedDict()
+    with LOADED_TREES.lock(pair_key(get_tree(batch[0][0]))[0]):
+        while len(outcomes) < len(batch):
+            for treeid, mutate, output_format, base in batch[len(outcomes):]:
+                try:
+                    h = get_tree(treeid)
+                    mutate(h)
+                    handlers[treeid] = h
+                    outcomes.append(None)
+                except Exception as e:
+                    outcomes.append((e, None))
+            batch.extend(take())
+        for treeid in handlers:
+            LOADED_TREES.refresh(treeid)
+    METRICS.observe('ete_mutation_batch_size', len(batch), MUTATION_BATCH_BUCKETS)
+
+    futures = [h.render_async() for h in handlers.values()]
+    with unlocked():
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # Cancelled or failed, the drawing below tells
+                pass
+
+    drawings = dict()
+    for index, (treeid, mutate, output_format, base) in enumerate(batch):
+        if outcomes[index] is not None:
+            continue
+        try:
+            if (treeid, output_format, base) not in drawings:
+                drawings[treeid, output_format, base] = redraw_tree(get_tree(treeid), output_format, base)
+            outcomes[index] = (None, drawings[treeid, output_format, base])
+        except Exception as e:
+            outcomes[index] = (e, None)
+    for treeid in handlers:
+        LOADED_TREES.measure_renders(treeid)
+    return outcomes
+
 
 # WEB SERVICES PROVIDING DATA TO THE WEB AND API
 @error(405)
@@ -103,47 +506,310 @@ def server_status():
     return web_return('alive', response)
 
 
+@route('/metrics')
+def metrics():
+    '''
+    Reports request latency and size histograms, phase timings and cache and loaded tree
+    figures of this server worker, in the Prometheus text format
+
+    Parameters:
+        None
+
+    Returns:
+        text: metrics
+    '''
+    stats = LOADED_TREES.stats()
+    METRICS.set('ete_loaded_trees', stats['trees'])
+    METRICS.set('ete_loaded_tree_bytes', stats['bytes'])
+    METRICS.set('ete_tree_evictions', stats['evictions'])
+    METRICS.set('ete_cache_entries', len(COMPRESS_CACHE), cache='compression')
+    METRICS.set('ete_cache_hits', COMPRESS_CACHE.hits, cache='compression')
+    METRICS.set('ete_cache_misses', COMPRESS_CACHE.misses, cache='compression')
+    if DIFF_CACHE is not None:
+        METRICS.set('ete_cache_entries', len(DIFF_CACHE), cache='diff')
+        METRICS.set('ete_cache_bytes', DIFF_CACHE.memory_usage(), cache='diff')
+        METRICS.set('ete_cache_hits', DIFF_CACHE.hits, cache='diff')
+        METRICS.set('ete_cache_misses', DIFF_CACHE.misses, cache='diff')
+
+    response.content_type = 'text/plain; version=0.0.4'
+    return web_return(METRICS.render(), response)
+
+
 @post('/load_trees')
 def load_trees():
-    ''' Requires a POST param "newick" containing the tree to be loaded. '''
+    ''' Requires a POST param "newick" containing the tree to be loaded. Trees and alignments
+    may also be uploaded as multipart files, gzip compressed or not. '''
 
-    if request.json:
-        source_dict = request.json
-    else:
-        source_dict = request.POST
-        
+    source_dict = load_params()
     
-    newick1 = source_dict.get('newick1', '').strip()
-    alg1 = source_dict.get('alg1', '').strip()
-    treeid1 = source_dict.get('treeid1', '').strip()
+    newick1, alg1, treeid1 = tree_inputs(source_dict, '1')
 
     if not newick1 or not treeid1:
         return web_return('No source tree provided', response)
 
 
-    h1 = TREE_HANDLER(newick1, alg1, treeid1, DEFAULT_ACTIONS, DEFAULT_STYLE, PREDRAW_FN)
-    LOADED_TREES[h1.treeid] = h1
-    
-    
-    
-    newick2 = source_dict.get('newick2', '').strip()
-    alg2 = source_dict.get('alg2', '').strip()
-    treeid2 = source_dict.get('treeid2', '').strip()
+    newick2, alg2, treeid2 = tree_inputs(source_dict, '2')
 
     if not newick2 or not treeid2:
+        try:
+            h1 = TREE_HANDLER(newick1, alg1, treeid1, DEFAULT_ACTIONS, DEFAULT_STYLE, PREDRAW_FN)
+        except UploadError as e:
+            upload_error(e)
+        LOADED_TREES[h1.treeid] = h1
         return web_return('No target tree provided', response)
 
+    if is_true(source_dict.get('async', '')):
+        # Parse and diff in the background, progress is reported by /job_status
+        jobid = JOBS.submit(load_and_draw_pair, None, None, newick1, alg1, treeid1, newick2, alg2, treeid2)
+        response.content_type = 'application/json'
+        return web_return(json.dumps({'jobid' : jobid}), response)
 
-    h2 = TREE_HANDLER(newick2, alg2, treeid2, DEFAULT_ACTIONS, DEFAULT_STYLE, PREDRAW_FN)
-    LOADED_TREES[h2.treeid] = h2
-    
+    try:
+        load_pair(None, newick1, alg1, treeid1, newick2, alg2, treeid2)
+    except UploadError as e:
+        upload_error(e)
     
+    return web_return('', response)
+
+@post('/load_and_draw')
+def load_and_draw():
+    '''
+    Loads and diffs a source and a target tree and draws both in a single request. Requires
+    the POST params "newick1", "treeid1", "newick2" and "treeid2"; "format" chooses between
+    the node geometry ("json", default) and the html image and map ("html") of every tree.
+    With "async", trees are loaded in the background and the drawings are reported as the
+    result of the job returned. Without render workers, Qt can only draw the trees in the
+    request handler, so they are drawn by the /job_status request fetching that result.
+    Trees and alignments may be uploaded as multipart files
+
+    Parameters:
+        None
+
+    Returns:
+        json: web return containing the tree drawings, in source, target order, or the job id
+    '''
+    source_dict = load_params()
+
+    pair = []
+    for side in ('1', '2'):
+        newick, alg, treeid = tree_inputs(source_dict, side)
+        if not newick or not treeid:
+            abort(400, 'No %s tree provided' %('source' if side == '1' else 'target'))
+        pair.extend((newick, alg, treeid))
+
+    output_format = source_dict.get('format', 'json').strip() or 'json'
+    if output_format not in ('json', 'html'):
+        abort(400, 'Unknown format %s' %output_format)
+
+    response.content_type = 'application/json'
+    if is_true(source_dict.get('async', '')):
+        jobid = JOBS.submit(load_and_draw_pair, output_format, base_url(), *pair,
+                            draw=renderer.get_pool() is not None)
+        return web_return(json.dumps({'jobid' : jobid}), response)
+
+    try:
+        drawings = load_and_draw_pair(None, output_format, base_url(), *pair)
+    except RenderTimeout:
+        abort(504, 'Rendering trees %s and %s timed out' %(pair[2], pair[5]))
+    except UploadError as e:
+        upload_error(e)
+    return web_return(json.dumps(drawings, separators=(',', ':')), response)
+
+def load_and_draw_pair(progress, output_format, base, newick1, alg1, treeid1, newick2, alg2, treeid2, draw=True):
+    '''
+    Loads, diffs and draws a source and a target tree. Both trees are rendered at the same time
+
+    Parameters:
+        progress: function called with the current phase and progress fraction, or None
+        output_format: "json" for the node geometry, "html" for the html image and map, or
+            None to only load the trees
+        base: base URL of the web service, used to link the tree images
+        newick1: source tree, as newick string
+        alg1: source alignment, as fasta string or Upload
+        treeid1: source tree id
+        newick2: target tree, as newick string
+        alg2: target alignment, as fasta string or Upload
+        treeid2: target tree id
+        draw: whether to draw the trees, otherwise the drawings are left to draw_pending_pair
+
+    Returns:
+        dict: tree drawings, as list of node geometry dicts or of tree id and html dicts, the
+            pending drawing when not drawn, or None
+    '''
+    progress = progress or (lambda phase, fraction: None)
+    handlers = load_pair(progress, newick1, alg1, treeid1, newick2, alg2, treeid2)
+    if output_format is None:
+        return None
+    if not draw:
+        return {'pending' : {'treeids' : [h.treeid for h in handlers], 'format' : output_format, 'base' : base}}
+
+    progress('drawing trees', 0.95)
+    return draw_pair(handlers, output_format, base)
+
+def draw_pair(handlers, output_format, base):
+    '''
+    Draws a source and a target tree, rendering both at the same time
+
+    Parameters:
+        handlers: source and target tree handler objects
+        output_format: "json" for the node geometry, "html" for the html image and map
+        base: base URL of the web service, used to link the tree images
+
+    Returns:
+        dict: tree drawings, as list of node geometry dicts or of tree id and html dicts
+    '''
+    for h in handlers:
+        h.render_async()
+
+    if output_format == 'json':
+        return {'trees' : [h.redraw_geometry() for h in handlers]}
+    return {'trees' : [{'treeid' : h.treeid, 'html' : h.redraw(image_url(h, base))} for h in handlers]}
+
+def draw_pending_pair(pending):
+    '''
+    Draws a tree pair loaded by a background job that left the drawings to the request
+    fetching its result
+
+    Parameters:
+        pending: tree ids, output format and base URL of the drawings, as dict
+
+    Returns:
+        dict: tree drawings, as returned by draw_pair
+    '''
+    treeid1, treeid2 = pending['treeids']
+    with rendered_tree(treeid1, tree_renders()) as h:
+        try:
+            return draw_pair([h, get_tree(treeid2)], pending['format'], pending['base'])
+        except RenderTimeout:
+            abort(504, 'Rendering trees %s and %s timed out' %(treeid1, treeid2))
+
+def load_pair(progress, newick1, alg1, treeid1, newick2, alg2, treeid2):
+    '''
+    Loads a source and a target tree, diffs them and stores both handlers
+
+    Parameters:
+        progress: function called with the current phase and progress fraction, or None
+        newick1: source tree, as newick string
+        alg1: source alignment, as fasta string or Upload
+        treeid1: source tree id
+        newick2: target tree, as newick string
+        alg2: target alignment, as fasta string or Upload
+        treeid2: target tree id
+
+    Returns:
+        tuple: source and target tree handlers
+    '''
+    progress = progress or (lambda phase, fraction: None)
+
+    progress('parsing source tree', 0.0)
+    h1 = TREE_HANDLER(newick1, alg1, treeid1, DEFAULT_ACTIONS, DEFAULT_STYLE, PREDRAW_FN)
+    progress('parsing target tree', 0.2)
+    h2 = TREE_HANDLER(newick2, alg2, treeid2, DEFAULT_ACTIONS, DEFAULT_STYLE, PREDRAW_FN)
     
     # do ete diff stuff
-    h1.diff(h2)
-    h2.diff(h1)
-    
-    return web_return('', response)
+    progress('diffing trees', 0.4)
+    if SYMMETRIC_DIFF:
+        h1.diff(h2, symmetric=True, cache=DIFF_CACHE, jobs=DIFF_JOBS, parallel=DIFF_PARALLEL)
+    else:
+        h1.diff(h2, cache=DIFF_CACHE, jobs=DIFF_JOBS, parallel=DIFF_PARALLEL)
+        progress('diffing trees', 0.6)
+        h2.diff(h1, cache=DIFF_CACHE, jobs=DIFF_JOBS, parallel=DIFF_PARALLEL)
+
+    if LOD_MAX_LEAVES:
+        h1.set_level_of_detail(LOD_MAX_LEAVES)
+        h2.set_level_of_detail(LOD_MAX_LEAVES)
+
+    # Store the pair once diffed, so both are accounted with their diff data
+    progress('storing trees', 0.9)
+    LOADED_TREES[h1.treeid] = h1
+    LOADED_TREES[h2.treeid] = h2
+    return h1, h2
+
+@post('/diff_matrix')
+def tree_matrix():
+    '''
+    Compares every pair of the given trees, streaming one JSON line per pair as results
+    are ready. Requires a JSON body with a "trees" list of {"newick", "alg", "treeid"} dicts,
+    or repeated "newick" POST params. Results are kept in the diff cache, so any pair can
+    then be loaded and drawn without computing its treediff again
+
+    Parameters:
+        None
+
+    Returns:
+        ndjson: web return containing source and target tree ids and indexes, mean and
+            maximum node distances, number of nodes and of perfect matches, per tree pair
+    '''
+    if request.json:
+        trees = request.json.get('trees') or []
+    else:
+        trees = [{'newick' : newick} for newick in request.POST.getall('newick')]
+
+    if not isinstance(trees, list) or len(trees) < 2:
+        abort(400, 'At least two trees are required')
+
+    handlers = []
+    for index, tree in enumerate(trees):
+        if not isinstance(tree, dict):
+            abort(400, 'Tree %d is not a {"newick", "alg", "treeid"} object' %index)
+        newick, alg, treeid = (tree.get('newick') or ''), (tree.get('alg') or ''), str(tree.get('treeid') or index)
+        if not isinstance(newick, str) or not isinstance(alg, str) or not newick.strip():
+            abort(400, 'No newick or invalid alignment given for tree %s' %treeid)
+        try:
+            handlers.append(TREE_HANDLER(newick.strip(), alg.strip(), treeid, DEFAULT_ACTIONS, DEFAULT_STYLE, PREDRAW_FN))
+        except Exception as e:
+            abort(400, 'Invalid tree %s: %s' %(treeid, e))
+
+    pairs = len(handlers) * (len(handlers) - 1) // 2
+    if DIFF_CACHE is None:
+        log.warning('diff cache disabled, tree matrix results will not be reused')
+    elif not DIFF_CACHE.cache_dir and DIFF_CACHE.max_entries and DIFF_CACHE.max_entries < pairs:
+        # Pairs evicted from the memory tier will be compared again when loaded
+        log.warning('diff cache holds %d results, fewer than the %d tree matrix pairs, set diff_cache_dir to keep them all'
+                    %(DIFF_CACHE.max_entries, pairs))
+
+    def stream():
+        t1 = time.time()
+        try:
+            for i, j, summary in diff_matrix(handlers, MATRIX_WORKERS, DIFF_CACHE):
+                summary.update({'source' : handlers[i].treeid, 'target' : handlers[j].treeid, 'i' : i, 'j' : j})
+                yield json.dumps(summary) + '\n'
+        except Exception as e:
+            log.exception('tree matrix failed')
+            yield json.dumps({'error' : str(e)}) + '\n'
+            return
+        yield json.dumps({'done' : True, 'trees' : len(handlers), 'elapsed' : round(time.time() - t1, 3)}) + '\n'
+
+    response.content_type = 'application/x-ndjson'
+    return stream()
+
+@get('/job_status')
+@post('/job_status')
+def job_status():
+    '''
+    Reports the phase and progress of a background job as JSON. The job result is only
+    returned by the first request after the job is done
+
+    Parameters:
+        None
+
+    Returns:
+        json: web return containing the job status
+    '''
+    if request.json:
+        source_dict = request.json
+    else:
+        source_dict = request.params
+
+    jobid = source_dict.get('jobid', '').strip()
+    status = JOBS.status(jobid) if jobid else None
+    if status is None:
+        abort(404, 'Job %s not found' %jobid)
+    if status.get('result') and 'pending' in status['result']:
+        status['result'] = draw_pending_pair(status['result']['pending'])
+
+    response.content_type = 'application/json'
+    return web_return(json.dumps(status), response)
 
 @post('/draw_tree')
 def draw_tree():
@@ -164,11 +830,235 @@ def draw_tree():
     treeid = source_dict.get('treeid', '').strip()
 
     if treeid:
-        h = LOADED_TREES[treeid]
-        img = h.redraw()
+        with rendered_tree(treeid, tree_renders()) as h:
+            img = redraw_tree(h)
 
     return web_return(img, response)
 
+@get('/tree_geometry')
+@post('/tree_geometry')
+def tree_geometry():
+    '''
+    Generates the tree node geometry and diff information as compact columnar JSON,
+    the image is served by /tree_image
+
+    Parameters:
+        None
+
+    Returns:
+        json: web return containing the node geometry
+    '''
+    if request.json:
+        source_dict = request.json
+    else:
+        source_dict = request.params
+
+    treeid = source_dict.get('treeid', '').strip()
+    if not treeid:
+        abort(400, 'No tree provided')
+
+    with rendered_tree(treeid, tree_renders()) as h:
+        geometry = redraw_tree(h, 'json')
+    response.content_type = 'application/json'
+    return web_return(geometry, response)
+
+@get('/tree_image/<treeid>')
+@get('/tree_image/<treeid>/<version:int>')
+def tree_image(treeid, version=None):
+    '''
+    Returns the tree image. Versioned URLs can be cached by the browser, images are
+    revalidated with their ETag
+
+    Parameters:
+        treeid: tree id
+        version: tree render version, redirected to the current one if outdated
+
+    Returns:
+        png: tree image
+    '''
+    with rendered_tree(treeid, tree_renders(target=False)) as h:
+        if version is not None and version != h.version:
+            redirect(image_url(h))
+
+        try:
+            img, etag = h.get_image()
+        except RenderTimeout:
+            abort(504, 'Rendering tree %s timed out' %treeid)
+    return image_return(img, etag, version is not None)
+
+@get('/subtree_geometry')
+@post('/subtree_geometry')
+def subtree_geometry():
+    '''
+    Generates the node geometry and diff information of the clade of the requested node
+    and of its matched clade in the target tree, each drawn alone. Requires the "treeid"
+    and "nodeid" params; node IDs and diff highlighting are those of the whole trees
+
+    Parameters:
+        None
+
+    Returns:
+        json: web return containing the geometry of both clades, in source, target order,
+            each linking its image
+    '''
+    if request.json:
+        source_dict = request.json
+    else:
+        source_dict = request.params
+
+    treeid = str(source_dict.get('treeid', '')).strip()
+    nodeid = str(source_dict.get('nodeid', '')).strip()
+    if not treeid or not nodeid:
+        abort(400, 'No tree node provided')
+
+    with rendered_tree(treeid, tree_renders(nodeid)) as h:
+        try:
+            geometries = h.redraw_subtree_geometry(nodeid)
+        except (KeyError, ValueError):
+            abort(404, 'Node %s not found' %nodeid)
+        except RenderTimeout:
+            abort(504, 'Rendering tree %s timed out' %treeid)
+
+        for geometry, handler in zip(geometries, (h, h.diffdict['target'])):
+            geometry['image'] = image_url(handler, nodeid=geometry['nodeid'])
+    response.content_type = 'application/json'
+    return web_return(json.dumps({'trees' : geometries}, separators=(',', ':')), response)
+
+@get('/subtree_image/<treeid>/<nodeid:int>')
+@get('/subtree_image/<treeid>/<nodeid:int>/<version:int>')
+def subtree_image(treeid, nodeid, version=None):
+    '''
+    Returns the image of a clade drawn alone, cached as /tree_image
+
+    Parameters:
+        treeid: tree id
+        nodeid: internal ID of the clade root node
+        version: tree render version, redirected to the current one if outdated
+
+    Returns:
+        png: clade image
+    '''
+    with rendered_tree(treeid, tree_renders(nodeid, target=False)) as h:
+        if version is not None and version != h.version:
+            redirect(image_url(h, nodeid=nodeid))
+
+        try:
+            img, etag = h.get_image(nodeid)
+        except KeyError:
+            abort(404, 'Node %s not found' %nodeid)
+        except RenderTimeout:
+            abort(504, 'Rendering tree %s timed out' %treeid)
+    return image_return(img, etag, version is not None)
+
+@get('/tree_tiles/<treeid>')
+def tree_tiles(treeid):
+    '''
+    Describes the tiles of the tree image. Zoom level z draws the tree at 2^z times the
+    size of /tree_image, from the level fitting the whole tree in one tile up to max_zoom
+
+    Parameters:
+        treeid: tree id
+
+    Returns:
+        json: web return containing the tree render version, image width and height at zoom
+            0, tile size, zoom range and tile base URL
+    '''
+    with rendered_tree(treeid, lambda h: [TILES.prepare(h)]) as h:
+        scene = tile_scene(h)
+        info = {'treeid' : h.treeid, 'version' : h.version, 'width' : int(scene.width), 'height' : int(scene.height),
+                'tile_size' : TILE_SIZE, 'min_zoom' : scene.min_zoom(), 'max_zoom' : MAX_ZOOM, 'url' : tile_url(h)}
+    response.content_type = 'application/json'
+    return web_return(json.dumps(info), response)
+
+@get('/tree_tile/<treeid>/<version:int>/<zoom:int>/<x:int>/<y:int>')
+def tree_tile(treeid, version, zoom, x, y):
+    '''
+    Returns a tile of the tree image, only painting the requested region. Tiles are
+    cached per render version, and can be kept by the browser
+
+    Parameters:
+        treeid: tree id
+        version: tree render version, redirected to the current one if outdated
+        zoom: zoom level
+        x: tile column
+        y: tile row
+
+    Returns:
+        png: tile image
+    '''
+    with rendered_tree(treeid, lambda h: [TILES.prepare(h)]) as h:
+        scene = get_tile_scene(h, version, zoom, x, y, 'tree_tile')
+    # Scenes are painted without the lock, they no longer read the tree
+    try:
+        img, etag = TILES.tile(scene, zoom, x, y)
+    except RenderTimeout:
+        abort(504, 'Painting tile %d/%d/%d of tree %s timed out' %(zoom, x, y, treeid))
+    return image_return(img, etag, True)
+
+@get('/tree_tile_geometry/<treeid>/<version:int>/<zoom:int>/<x:int>/<y:int>')
+def tree_tile_geometry(treeid, version, zoom, x, y):
+    '''
+    Generates the node geometry and diff information of the areas inside a tile, as
+    /tree_geometry. Coordinates are those of the tree image at zoom 0
+
+    Parameters:
+        treeid: tree id
+        version: tree render version, redirected to the current one if outdated
+        zoom: zoom level
+        x: tile column
+        y: tile row
+
+    Returns:
+        json: web return containing the tile node geometry
+    '''
+    with rendered_tree(treeid, lambda h: [TILES.prepare(h), TILES.prepare(h.diffdict['target'])]) as h:
+        scene = get_tile_scene(h, version, zoom, x, y, 'tree_tile_geometry')
+        target_scene = tile_scene(h.diffdict['target'])
+        geometry = h.get_geometry(scene.img_map, target_scene.img_map, scene.tile_rect(zoom, x, y))
+        geometry.update({'zoom' : zoom, 'x' : x, 'y' : y, 'tile_size' : TILE_SIZE})
+    response.content_type = 'application/json'
+    return web_return(json.dumps(geometry, separators=(',', ':')), response)
+
+@get('/search')
+@post('/search')
+def search_nodes():
+    '''
+    Finds the nodes of a tree whose name matches a query. Requires the "treeid" and "q"
+    params; "mode" is "exact", "prefix" or "substring" (default) and "limit" bounds the
+    number of nodes returned
+
+    Parameters:
+        None
+
+    Returns:
+        json: web return containing the number of matches and the node IDs, names, image
+            boxes, matched target nodes and distances of the first ones
+    '''
+    if request.json:
+        source_dict = request.json
+    else:
+        source_dict = request.params
+
+    treeid = str(source_dict.get('treeid', '')).strip()
+    query = str(source_dict.get('q', '')).strip()
+    mode = str(source_dict.get('mode', '')).strip() or 'substring'
+    if not treeid:
+        abort(400, 'No tree provided')
+    try:
+        limit = int(source_dict.get('limit', 50))
+    except ValueError:
+        abort(400, 'Invalid limit')
+
+    with rendered_tree(treeid, tree_renders()) as h:
+        try:
+            result = h.search(query, mode, limit)
+        except ValueError as e:
+            abort(400, str(e))
+        except RenderTimeout:
+            abort(504, 'Rendering tree %s timed out' %treeid)
+    response.content_type = 'application/json'
+    return web_return(json.dumps(result, separators=(',', ':')), response)
+
 @post('/get_actions')
 def get_action():
     '''
@@ -192,12 +1082,18 @@ def get_action():
     
     if treeid1 and nodeid1:
         html = "<ul class='ete_action_list'>"
-        h = LOADED_TREES[treeid1]
-        treeid2 = h.diffdict['target'].treeid
-        nodeid2 = h.diffdict['nodes'][int(nodeid1)]['target_nodeid']
-        for aindex, aname in h.get_avail_actions(nodeid1):
-            html += """<li><a  onClick="run_action('%s', '%s', '%s', '%s', '%s', '%s');" >%s</a></li>""" %(treeid1, treeid2, nodeid1, nodeid2, '', aindex, aname)
-        html += "</ul>"
+        with locked_tree(treeid1) as h:
+            treeid2 = h.diffdict['target'].treeid
+            nodeid2 = h.diffdict['nodes'][int(nodeid1)]['target_nodeid']
+            for aindex, aname in h.get_avail_actions(nodeid1):
+                html += """<li><a  onClick="run_action('%s', '%s', '%s', '%s', '%s', '%s');" >%s</a></li>""" %(treeid1, treeid2, nodeid1, nodeid2, '', aindex, aname)
+            if int(nodeid1) in h.collapsed:
+                html += """<li><a  onClick="expand_node('%s', '%s');" >Expand clade</a></li>""" %(treeid1, nodeid1)
+            elif not h.get_node(nodeid1).is_leaf():
+                html += """<li><a  onClick="collapse_node('%s', '%s');" >Collapse clade</a></li>""" %(treeid1, nodeid1)
+            if not h.get_node(nodeid1).is_leaf():
+                html += """<li><a  onClick="focus_node('%s', '%s');" >Focus on clade</a></li>""" %(treeid1, nodeid1)
+            html += "</ul>"
     return web_return(html, response)
 
 @post('/run_action')
@@ -209,7 +1105,8 @@ def run_action():
         None
 
     Returns:
-        html: web return containing tree image and response
+        html: web return containing tree image and response, or its node geometry as JSON if the
+            "format" param is "json"
     '''
     if request.json:
         source_dict = request.json
@@ -221,14 +1118,73 @@ def run_action():
     faceid = source_dict.get('faceid', '').strip()
     aindex = source_dict.get('aindex', '').strip()
     side = source_dict.get('side', '').strip()
+    output_format = source_dict.get('format', '').strip()
 
-    if treeid and nodeid and aindex:
-        h = LOADED_TREES[treeid]
-        h.run_action(aindex, nodeid, side)
-        img = h.redraw()
+    if not treeid or not nodeid or not aindex:
+        abort(400, 'No tree node or action provided')
 
+    img = mutate_tree(treeid, lambda h: h.run_action(aindex, nodeid, side), output_format)
     return web_return(img, response)
 
+@post('/expand_node')
+def expand_node():
+    '''
+    Expands a collapsed clade and redraws the tree
+
+    Parameters:
+        None
+
+    Returns:
+        html: web return containing tree image and response, or its node geometry as JSON if the
+            "format" param is "json"
+    '''
+    return change_level_of_detail(expand=True)
+
+@post('/collapse_node')
+def collapse_node():
+    '''
+    Collapses a clade and redraws the tree
+
+    Parameters:
+        None
+
+    Returns:
+        html: web return containing tree image and response, or its node geometry as JSON if the
+            "format" param is "json"
+    '''
+    return change_level_of_detail(expand=False)
+
+def change_level_of_detail(expand):
+    '''
+    Expands or collapses the clade of the requested node and redraws the tree
+
+    Parameters:
+        expand: whether to expand the clade, it is collapsed otherwise
+
+    Returns:
+        html: web return containing tree image or node geometry
+    '''
+    if request.json:
+        source_dict = request.json
+    else:
+        source_dict = request.POST
+
+    treeid = str(source_dict.get('treeid', '')).strip()
+    nodeid = str(source_dict.get('nodeid', '')).strip()
+    output_format = source_dict.get('format', '').strip()
+    if not treeid or not nodeid:
+        abort(400, 'No tree node provided')
+
+    def change(h):
+        try:
+            if expand:
+                h.expand_node(nodeid)
+            else:
+                h.collapse_node(nodeid)
+        except (KeyError, ValueError):
+            abort(404, 'Node %s not found' %nodeid)
+    return web_return(mutate_tree(treeid, change, output_format), response)
+
 @post('/get_dist')
 def get_dist():
     '''
@@ -249,7 +1205,7 @@ def get_dist():
     nodeid = source_dict.get('nodeid', '').strip()
     if treeid and nodeid:
         html = "<ul class='ete_action_list'>"
-        h = LOADED_TREES[treeid]
+        h = get_tree(treeid)
         html += """<li><a>Distance: %s</a></li>""" %(h.diffdict['nodes'][int(nodeid)]['distance'])
         html += "</ul>"
     return web_return(html, response)
@@ -259,7 +1215,12 @@ DEFAULT_STYLE = None
 PREDRAW_FN = None
 
 
-def start_server(node_actions=None, tree_style=None, predraw_fn=None, host="localhost", port=8989):
+def start_server(node_actions=None, tree_style=None, predraw_fn=None, host="localhost", port=8989, symmetric_diff=True,
+                 diff_cache_size=128, diff_cache_bytes=256 << 20, diff_cache_dir=None, max_trees=None, max_tree_bytes=None, tree_ttl=None,
+                 workers=1, session_dir=None, shared_objects=None, render_workers=0, render_timeout=None,
+                 diff_jobs=1, diff_parallel=None, job_workers=2, compress_level=6, compress_cache_size=64,
+                 matrix_workers=None, lod_max_leaves=None, tile_cache_size=1024, tile_scenes=4, profile_dir=None,
+                 warmup=True, max_upload_bytes=None, threads=False, job_result_ttl=600, max_job_result_bytes=256 << 20):
     '''
     Starts server
 
@@ -269,12 +1230,51 @@ def start_server(node_actions=None, tree_style=None, predraw_fn=None, host="loca
         predraw_fn: wether to use tree predraw
         host: host ip
         port: listening port
+        symmetric_diff: whether to compute treediff once per tree pair and derive the reverse mapping
+        diff_cache_size: maximum number of treediff results kept in memory, 0 disables the memory tier
+        diff_cache_bytes: memory budget of the treediff results kept in memory, the least recently
+            used ones are dropped first, unbounded if None
+        diff_cache_dir: directory of the on-disk treediff results cache, disabled if not given. Tree
+            matrices with more pairs than diff_cache_size need it to keep every pair result
+        max_trees: maximum number of loaded trees, unbounded if not given
+        max_tree_bytes: memory budget of the loaded trees in bytes, unbounded if not given
+        tree_ttl: seconds a loaded tree can stay idle before being evicted, unbounded if not given
+        workers: number of worker processes serving requests
+        session_dir: directory where loaded trees are stored so that any worker can serve them,
+            a temporary one is used if not given and more than one worker is requested
+        shared_objects: extra tree styles or objects referenced by the loaded trees that must be
+            stored by reference in session_dir, as list
+        render_workers: number of pre-warmed render processes per server worker, 0 renders in the request handler
+        render_timeout: seconds to wait for a tree render before failing the request, unbounded if not given
+        diff_jobs: maximum number of parallel treediff jobs
+        diff_parallel: treediff parallelization method, async or sync, as string
+        job_workers: number of background jobs (asynchronous tree loads) run at the same time
+        compress_level: compression level of large responses, from 1 (fastest) to 9 (smallest)
+        compress_cache_size: maximum number of compressed responses kept for identical requests, 0 disables it
+        matrix_workers: number of processes comparing tree pairs in /diff_matrix, the number of CPUs if not given
+        lod_max_leaves: maximum number of leaves drawn per tree, the rest of the clades being collapsed
+            (most divergent clades are kept expanded), every node is drawn if not given
+        tile_cache_size: maximum number of tree image tiles kept per server worker
+        tile_scenes: maximum number of laid out trees kept per server worker to paint tiles
+        profile_dir: directory where the cProfile stats of requests sent with the "X-Profile" header
+            or a "profile" query param are stored, profiling is disabled if not given
+        warmup: whether every server worker imports the tree drawing and treediff modules and renders
+            a tiny tree before serving requests, otherwise the first requests pay for them
+        max_upload_bytes: maximum size of the trees and alignments sent as multipart params, once
+            decompressed, unbounded if not given. Form and JSON bodies are limited by bottle's MEMFILE_MAX
+        threads: whether every server worker handles requests in threads of their own. Mutations of
+            a tree are serialized, and those queued meanwhile are applied together and redrawn once.
+            Requires render_workers, as Qt does not draw trees outside of the main thread
+        job_result_ttl: seconds the result of a background job is kept until fetched, unbounded if None
+        max_job_result_bytes: memory budget of the job results kept until fetched per server worker,
+            the oldest ones are dropped first, unbounded if None
 
     Returns:
         None
     '''
-    global DEFAULT_STYLE, DEFAULT_ACTIONS, PREDRAW_FN
-    
+    global DEFAULT_STYLE, DEFAULT_ACTIONS, PREDRAW_FN, SYMMETRIC_DIFF, DIFF_CACHE, LOADED_TREES
+    global DIFF_JOBS, DIFF_PARALLEL, JOBS, COMPRESS_CACHE, MATRIX_WORKERS, LOD_MAX_LEAVES, TILES, UPLOAD_MAX_BYTES
+    started = time.time()
     
     if node_actions:
         DEFAULT_ACTIONS = node_actions
@@ -284,8 +1284,57 @@ def start_server(node_actions=None, tree_style=None, predraw_fn=None, host="loca
     if tree_style:
         DEFAULT_STYLE = tree_style
     else:
+        from ete3 import TreeStyle
         DEFAULT_STYLE = TreeStyle()
         
     PREDRAW_FN = predraw_fn
+    SYMMETRIC_DIFF = symmetric_diff
+    DIFF_JOBS = diff_jobs
+    DIFF_PARALLEL = diff_parallel
+    MATRIX_WORKERS = matrix_workers
+    LOD_MAX_LEAVES = lod_max_leaves
+    UPLOAD_MAX_BYTES = max_upload_bytes
+    if threads and not render_workers:
+        log.warning('threaded servers should render trees with render_workers')
+
+    if diff_cache_size or diff_cache_dir:
+        DIFF_CACHE = DiffCache(diff_cache_size, diff_cache_dir, diff_cache_bytes)
+    else:
+        DIFF_CACHE = None
 
-    run(host=host, port=port)
+    COMPRESS_CACHE = CompressionCache(compress_cache_size, compress_level)
+    TILES = TileCache(tile_scenes, tile_cache_size)
+    METRICS_PLUGIN.profile_dir = profile_dir
+
+    if workers > 1 and not session_dir:
+        session_dir = tempfile.mkdtemp(prefix='ete3_webserver_')
+
+    if session_dir:
+        shared = [DEFAULT_ACTIONS, DEFAULT_STYLE] + list(shared_objects or [])
+        LOADED_TREES = FileTreeStore(session_dir, max_trees, max_tree_bytes, tree_ttl, shared_objects=shared)
+        log.info('storing loaded trees in %s' %session_dir)
+    else:
+        LOADED_TREES = TreeStore(max_trees, max_tree_bytes, tree_ttl)
+
+    JOBS = JobManager(job_workers, os.path.join(session_dir, 'jobs') if session_dir else None,
+                      result_ttl=job_result_ttl, max_result_bytes=max_job_result_bytes)
+
+    renderer.configure(render_workers, render_timeout)
+
+    def prepare_worker():
+        renderer.get_pool()
+        timings = renderer.warmup() if warmup else {}
+        for name, secs in timings.items():
+            METRICS.set('ete_startup_seconds', secs, phase=name)
+        METRICS.set('ete_startup_seconds', time.time() - started, phase='total')
+        log.info('server worker %d ready in %0.3f secs%s' %(os.getpid(), time.time() - started,
+                 ''.join(', %s %0.3f secs' %item for item in timings.items())))
+
+    if workers > 1:
+        run(host=host, port=port, server=PreforkServer, workers=workers, threads=threads, post_fork=prepare_worker)
+    elif threads:
+        prepare_worker()
+        run(host=host, port=port, server_class=ThreadingWSGIServer)
+    else:
+        prepare_worker()
+        run(host=host, port=port)
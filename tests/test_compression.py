@@ -0,0 +1,67 @@
+import gzip
+import zlib
+import unittest
+
+from ete3_webserver.compression import negotiate, compress, CompressionCache
+
+
+class NegotiateTest(unittest.TestCase):
+
+    def test_preference(self):
+        self.assertEqual(negotiate('gzip, deflate, br'), 'gzip')
+        self.assertEqual(negotiate('deflate, gzip'), 'gzip')
+        self.assertEqual(negotiate('br, deflate'), 'deflate')
+
+    def test_quality_values(self):
+        self.assertEqual(negotiate('gzip;q=0.5, deflate;q=0.8'), 'deflate')
+        self.assertEqual(negotiate('GZIP ; q=1.0'), 'gzip')
+        self.assertIsNone(negotiate('gzip;q=0, deflate;q=0'))
+        self.assertEqual(negotiate('gzip;q=oops, deflate'), 'deflate')
+
+    def test_wildcard(self):
+        self.assertEqual(negotiate('*'), 'gzip')
+        self.assertEqual(negotiate('gzip;q=0, *;q=0.5'), 'deflate')
+
+    def test_no_encoding(self):
+        self.assertIsNone(negotiate(None))
+        self.assertIsNone(negotiate(''))
+        self.assertIsNone(negotiate('identity, br'))
+
+
+class CompressionCacheTest(unittest.TestCase):
+
+    def test_compress(self):
+        data = b'((A,B),(C,D));' * 100
+        self.assertEqual(gzip.decompress(compress(data, 'gzip')), data)
+        self.assertEqual(zlib.decompress(compress(data, 'deflate', 1)), data)
+        # Identical bodies compress to identical bytes, as gzip leaves the time out
+        self.assertEqual(compress(data, 'gzip'), compress(data, 'gzip'))
+        with self.assertRaises(ValueError):
+            compress(data, 'br')
+
+    def test_cache(self):
+        cache = CompressionCache(max_entries=2)
+        bodies = [(b'tree %d ' %index) * 100 for index in range(3)]
+        first = cache.compress(bodies[0], 'gzip')
+        self.assertIs(cache.compress(bodies[0], 'gzip'), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        # Encodings are cached apart
+        self.assertEqual(zlib.decompress(cache.compress(bodies[0], 'deflate')), bodies[0])
+        self.assertEqual(cache.misses, 2)
+
+        cache.compress(bodies[1], 'gzip')
+        self.assertEqual(len(cache), 2)
+        cache.compress(bodies[0], 'gzip')
+        self.assertEqual(cache.misses, 4)
+
+    def test_disabled_cache(self):
+        cache = CompressionCache(max_entries=0)
+        data = b'A' * 1000
+        cache.compress(data, 'gzip')
+        cache.compress(data, 'gzip')
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.misses, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
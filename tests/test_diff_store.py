@@ -0,0 +1,81 @@
+import copy
+import pickle
+import unittest
+
+from ete3_webserver.diff_store import DiffStore
+
+
+class DiffStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.store = DiffStore()
+        self.store.set(0, 3, 0.5, {'A', 'B'}, {'A', 'C'}, {'B', 'C'})
+        self.store.set(4)
+
+    def test_set_fills_fields(self):
+        view = self.store[0]
+        self.assertEqual(view['target_nodeid'], 3)
+        self.assertEqual(view['distance'], 0.5)
+        self.assertEqual(view['side1'], {'A', 'B'})
+        self.assertEqual(view['side2'], {'A', 'C'})
+        self.assertEqual(view['diff'], {'B', 'C'})
+
+    def test_empty_diff(self):
+        self.assertEqual(self.store[4], {'target_nodeid': -1, 'distance': None, 'side1': None,
+                                         'side2': None, 'diff': frozenset()})
+
+    def test_membership(self):
+        self.assertEqual(len(self.store), 2)
+        self.assertEqual(list(self.store), [0, 4])
+        self.assertNotIn(2, self.store)
+        self.assertNotIn(9, self.store)
+        with self.assertRaises(KeyError):
+            self.store[2]
+
+    def test_view_reads_the_store(self):
+        view = self.store[0]
+        self.store.set_target_nodeid(0, 7)
+        self.assertEqual(view['target_nodeid'], 7)
+        self.assertEqual(view.get('distance'), 0.5)
+        self.assertIsNone(view.get('missing'))
+        with self.assertRaises(KeyError):
+            self.store.set_target_nodeid(2, 1)
+
+    def test_pop(self):
+        entry = self.store.pop(0)
+        self.assertEqual(entry['target_nodeid'], 3)
+        self.assertEqual(entry['diff'], {'B', 'C'})
+        self.assertNotIn(0, self.store)
+        self.assertEqual(len(self.store), 1)
+        self.assertEqual(self.store.pop(0, 'gone'), 'gone')
+
+    def test_interned_sets_are_shared(self):
+        self.store.set(1, 2, 0.0, {'A', 'B'}, ['B', 'A'])
+        self.assertIs(self.store[0]['side1'], self.store[1]['side1'])
+        self.assertIs(self.store[1]['side1'], self.store[1]['side2'])
+
+    def test_compact_drops_unused_sets(self):
+        self.store.pop(0)
+        size = self.store.memory_usage()
+        self.store.compact()
+        self.assertEqual(self.store._sets, {})
+        self.assertLess(self.store.memory_usage(), size)
+
+    def test_snapshot(self):
+        view = self.store[0]
+        self.assertEqual(view.snapshot(), {'target_nodeid': 3, 'distance': 0.5, 'diff': {'B', 'C'}})
+        snapshot = view.snapshot(sides=True)
+        self.assertEqual(snapshot, view)
+        self.store.set_target_nodeid(0, 1)
+        self.assertEqual(snapshot['target_nodeid'], 3)
+
+    def test_pickled_views_keep_their_store(self):
+        view = pickle.loads(pickle.dumps(self.store[0]))
+        self.assertEqual(view, self.store[0])
+        self.assertEqual(len(view.store), 2)
+        views = copy.deepcopy([self.store[0], self.store[4]])
+        self.assertIs(views[0].store, views[1].store)
+
+
+if __name__ == '__main__':
+    unittest.main()
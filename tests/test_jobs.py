@@ -0,0 +1,73 @@
+import shutil
+import tempfile
+import unittest
+
+from ete3_webserver.jobs import JobManager
+
+
+def job(progress, size):
+    progress('working', 0.5)
+    return {'data' : 'x' * size}
+
+def failing_job(progress):
+    raise ValueError('bad tree')
+
+
+class JobManagerTest(unittest.TestCase):
+
+    def run_jobs(self, manager, *jobs):
+        jobids = [manager.submit(fn, *args) for fn, args in jobs]
+        # Waits for every job to finish
+        manager._executor.shutdown(wait=True)
+        return jobids
+
+    def test_result_fetched_once(self):
+        manager = JobManager(workers=1)
+        jobid, = self.run_jobs(manager, (job, (10,)))
+        status = manager.status(jobid)
+        self.assertTrue(status['done'])
+        self.assertEqual(status['phase'], 'done')
+        self.assertEqual(status['result'], {'data' : 'x' * 10})
+        status = manager.status(jobid)
+        self.assertIsNone(status['result'])
+        self.assertEqual(status['result_dropped'], 'fetched')
+        self.assertIsNone(manager.status('job_unknown'))
+
+    def test_result_expired(self):
+        manager = JobManager(workers=1, result_ttl=0)
+        jobid, = self.run_jobs(manager, (job, (10,)))
+        status = manager.status(jobid)
+        self.assertIsNone(status['result'])
+        self.assertEqual(status['result_dropped'], 'expired')
+
+    def test_results_over_budget(self):
+        manager = JobManager(workers=1, max_result_bytes=150)
+        first, second = self.run_jobs(manager, (job, (100,)), (job, (100,)))
+        self.assertEqual(manager.status(first)['result_dropped'], 'evicted')
+        self.assertEqual(manager.status(second)['result'], {'data' : 'x' * 100})
+
+        # The newest result is kept even if larger than the budget
+        manager = JobManager(workers=1, max_result_bytes=10)
+        jobid, = self.run_jobs(manager, (job, (100,)))
+        self.assertIsNotNone(manager.status(jobid)['result'])
+
+    def test_failed_job(self):
+        manager = JobManager(workers=1)
+        with self.assertLogs(level='ERROR'):
+            jobid, = self.run_jobs(manager, (failing_job, ()))
+        status = manager.status(jobid)
+        self.assertTrue(status['done'])
+        self.assertEqual(status['error'], 'bad tree')
+
+    def test_shared_state(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        jobid, = self.run_jobs(JobManager(workers=1, state_dir=state_dir), (job, (10,)))
+        # Another server worker reports the job, and its result once
+        other = JobManager(workers=1, state_dir=state_dir)
+        self.assertEqual(other.status(jobid)['result'], {'data' : 'x' * 10})
+        self.assertEqual(other.status(jobid)['result_dropped'], 'fetched')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import threading
+import unittest
+
+from ete3_webserver.mutations import MutationQueue
+
+
+class MutationQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = MutationQueue()
+        self.batches = []
+        self.renders = 0
+        self.rendering = threading.Event()
+        self.render_done = threading.Event()
+        self.render_done.set()
+        self.mutating = threading.Event()
+        self.mutate_done = threading.Event()
+        self.mutate_done.set()
+
+    def run_batch(self, items, take, unlocked):
+        items = list(items)
+        self.mutating.set()
+        self.mutate_done.wait(10)
+        items.extend(take())
+        self.batches.append(items)
+        with unlocked():
+            self.renders += 1
+            self.rendering.set()
+            self.render_done.wait(10)
+        return [(None, item * 10) for item in items]
+
+    def submit_all(self, items):
+        results = dict()
+        def submit(item):
+            results[item] = self.queue.submit('pair', item, self.run_batch)
+        threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+        for thread in threads:
+            thread.start()
+        return threads, results
+
+    def wait_queued(self, count):
+        # Mutations waiting for a batch, not taken yet
+        for _ in range(1000):
+            with self.queue._lock:
+                if len(self.queue._keys['pair'][1]) == count:
+                    return
+            threading.Event().wait(0.01)
+        self.fail('mutations were not queued')
+
+    def test_concurrent_submits_one_batch(self):
+        with self.queue.lock('pair'):
+            threads, results = self.submit_all(range(6))
+            self.wait_queued(6)
+        for thread in threads:
+            thread.join(10)
+        self.assertEqual(len(self.batches), 1)
+        self.assertEqual(sorted(self.batches[0]), list(range(6)))
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(results, dict((item, item * 10) for item in range(6)))
+
+    def test_submits_during_render_join_next_batch(self):
+        self.render_done.clear()
+        first, results = self.submit_all([0])
+        self.assertTrue(self.rendering.wait(10))
+        others, more_results = self.submit_all(range(1, 6))
+        self.wait_queued(5)
+        self.render_done.set()
+        for thread in first + others:
+            thread.join(10)
+        self.assertEqual([sorted(batch) for batch in self.batches], [[0], [1, 2, 3, 4, 5]])
+        self.assertEqual(self.renders, 2)
+        self.assertEqual(more_results, dict((item, item * 10) for item in range(1, 6)))
+
+    def test_submits_while_mutating_join_batch(self):
+        self.mutate_done.clear()
+        first, results = self.submit_all([0])
+        self.assertTrue(self.mutating.wait(10))
+        others, more_results = self.submit_all(range(1, 6))
+        self.wait_queued(5)
+        self.mutate_done.set()
+        for thread in first + others:
+            thread.join(10)
+        self.assertEqual([sorted(batch) for batch in self.batches], [list(range(6))])
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(more_results, dict((item, item * 10) for item in range(1, 6)))
+        # The key is free again once the batch is done
+        self.assertEqual(self.queue.submit('pair', 6, self.run_batch), 60)
+
+    def test_batch_errors(self):
+        def failing(items, take, unlocked):
+            return [(ValueError('unknown node'), None) if item else (None, 'ok') for item in items]
+        self.assertEqual(self.queue.submit('pair', 0, failing), 'ok')
+        with self.assertRaises(ValueError):
+            self.queue.submit('pair', 1, failing)
+        self.assertEqual(self.queue._keys, dict())
+
+
+if __name__ == '__main__':
+    unittest.main()
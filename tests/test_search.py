@@ -0,0 +1,45 @@
+import unittest
+from types import SimpleNamespace
+
+from ete3_webserver.search import NodeIndex
+
+
+NAMES = ['Homo_sapiens', 'Homo_erectus', 'Pan_troglodytes', 'pan_paniscus', 'Gorilla', '', None]
+
+
+class NodeIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        nodes = dict((nid, SimpleNamespace(name=name)) for nid, name in enumerate(NAMES))
+        # Internal nodes may share names with leaves
+        nodes[7] = SimpleNamespace(name='Gorilla', taxid=9592)
+        self.index = NodeIndex(nodes, features=('name', 'taxid'))
+
+    def test_unnamed_nodes_are_not_indexed(self):
+        self.assertEqual(len(self.index), 6)
+
+    def test_exact(self):
+        self.assertEqual(self.index.search('gorilla', 'exact'), [4, 7])
+        self.assertEqual(self.index.search('9592', 'exact'), [7])
+        self.assertEqual(self.index.search('goril', 'exact'), [])
+
+    def test_prefix(self):
+        self.assertEqual(self.index.search('HOMO_', 'prefix'), [1, 0])
+        self.assertEqual(self.index.search('pan', 'prefix'), [3, 2])
+        self.assertEqual(self.index.search('zebra', 'prefix'), [])
+
+    def test_substring(self):
+        self.assertEqual(self.index.search('sapiens'), [0])
+        self.assertEqual(self.index.search('PAN'), [3, 2])
+        self.assertEqual(self.index.search('_'), [1, 0, 3, 2])
+        self.assertEqual(self.index.search('o_s'), [0])
+        self.assertEqual(self.index.search('homo_pan'), [])
+
+    def test_queries(self):
+        self.assertEqual(self.index.search(''), [])
+        with self.assertRaises(ValueError):
+            self.index.search('homo', 'regex')
+
+
+if __name__ == '__main__':
+    unittest.main()
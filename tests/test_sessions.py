@@ -0,0 +1,135 @@
+import shutil
+import tempfile
+import unittest
+
+from ete3_webserver.sessions import TreeStore, FileTreeStore, TreeExpired
+from ete3_webserver.tree_handler import WebTreeHandler, NodeActions
+
+
+class TreeStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.actions = NodeActions()
+
+    def handler(self, treeid, newick='((A,B),(C,D));'):
+        return WebTreeHandler(newick, '', treeid, self.actions, None)
+
+    def pair(self, treeid1, treeid2):
+        h1, h2 = self.handler(treeid1), self.handler(treeid2)
+        h1.diffdict['target'] = h2
+        h2.diffdict['target'] = h1
+        return h1, h2
+
+    def test_lru_eviction(self):
+        store = TreeStore(max_entries=2)
+        for treeid in 'abc':
+            store[treeid] = self.handler(treeid)
+            if treeid == 'b':
+                store['a']
+        self.assertEqual(len(store), 2)
+        self.assertIn('a', store)
+        self.assertNotIn('b', store)
+        with self.assertRaises(TreeExpired):
+            store['b']
+        with self.assertRaises(KeyError):
+            store['z']
+        self.assertEqual(store.stats()['evictions'], 1)
+
+    def test_pair_eviction(self):
+        store = TreeStore(max_entries=3)
+        h1, h2 = self.pair('a', 'b')
+        store['a'] = h1
+        store['b'] = h2
+        store['c'] = self.handler('c')
+        # Both trees of the pair go, the new tree stays
+        store['d'] = self.handler('d')
+        self.assertEqual(sorted(store._entries), ['c', 'd'])
+        self.assertEqual(store.stats()['evictions'], 2)
+
+    def test_byte_budget(self):
+        h = self.handler('a')
+        size = h.memory_usage()
+        store = TreeStore(max_bytes=size * 2)
+        for treeid in 'abc':
+            store[treeid] = self.handler(treeid)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.memory_usage(), size * 2)
+
+        # Growing trees are measured again when refreshed
+        big = store['c']
+        big.tree.children[0].add_child(name='E')
+        big.sync_nodes()
+        store.refresh('c')
+        self.assertEqual(store.memory_usage(), big.memory_usage())
+        self.assertEqual(list(store._entries), ['c'])
+
+    def test_idle_eviction(self):
+        store = TreeStore(ttl=60)
+        store['a'] = self.handler('a')
+        store['b'] = self.handler('b')
+        store._entries['a'][3] -= 120
+        with self.assertRaises(TreeExpired):
+            store['a']
+        self.assertEqual(store['b'].treeid, 'b')
+
+
+class FileTreeStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.actions = NodeActions()
+
+    def store(self, **kargs):
+        # Every worker registers the shared objects in the same order
+        return FileTreeStore(self.path, shared_objects=[self.actions], **kargs)
+
+    def handler(self, treeid):
+        return WebTreeHandler('((A,B),(C,D));', '', treeid, self.actions, None)
+
+    def test_round_trip(self):
+        h1, h2 = self.handler('a'), self.handler('b')
+        h1.diffdict['target'] = h2
+        h2.diffdict['target'] = h1
+        for n in h1.tree.traverse():
+            h1.set_diff(n, n._nid, 0.5, set(['A']), set(['B']), set(['A', 'B']))
+        store = self.store()
+        store['b'] = h2
+        store['a'] = h1
+
+        loaded = self.store()['a']
+        self.assertIsNot(loaded, h1)
+        self.assertEqual(loaded.tree.write(), h1.tree.write())
+        self.assertIs(loaded.tree.actions, self.actions)
+        self.assertEqual(loaded.diffdict['target'].treeid, 'b')
+        self.assertIs(loaded.diffdict['target'].diffdict['target'], loaded)
+        for nid, n in loaded.nodes.items():
+            self.assertIs(loaded.get_node(nid), n)
+            self.assertEqual(n.diffdict['distance'], 0.5)
+            self.assertEqual(n.diffdict['diff'], set(['A', 'B']))
+
+    def test_modified_trees_are_stored_again(self):
+        store = self.store()
+        store['a'] = self.handler('a')
+        other = self.store()
+        h = other['a']
+        h.tree.name = 'renamed'
+        other.refresh('a')
+        self.assertEqual(store['a'].tree.name, 'renamed')
+
+    def test_eviction(self):
+        store = self.store(max_entries=2)
+        for treeid in 'abc':
+            store[treeid] = self.handler(treeid)
+        self.assertEqual(len(store), 2)
+        with self.assertRaises(TreeExpired):
+            self.store()['a']
+        with self.assertRaises(KeyError):
+            store['z']
+        store.evict('b')
+        self.assertEqual(len(store), 1)
+        self.assertEqual(store.stats()['evictions'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,191 @@
+import sys
+import types
+import unittest
+
+from ete3_webserver.tree_handler import WebTreeHandler, NodeActions
+from ete3_webserver.diff_cache import DiffCache
+
+
+def eucl_dist(a, b, support, attr1, attr2):
+    return 1 - len(a & b) / float(max(len(a), len(b), 1))
+
+def treediff(t1, t2, attr1='name', attr2='name', dist_fn=eucl_dist, support=None, reduce_matrix=False, extended=None, jobs=1, parallel=None):
+    # Every node of t1 against every node of t2, as ete_diff does without matrix reduction
+    TREEDIFF_CALLS.append((len(t1.get_leaves()), len(t2.get_leaves())))
+    c1 = t1.get_cached_content(store_attr=attr1)
+    c2 = t2.get_cached_content(store_attr=attr2)
+    rows = []
+    for n1 in t1.traverse('preorder'):
+        d, n2 = min(((dist_fn(c1[n1], c2[n2], support, attr1, attr2), n2) for n2 in t2.traverse('preorder')), key=lambda pair: pair[0])
+        rows.append([d, -1, c1[n1], c2[n2], c1[n1] ^ c2[n2], n1, n2])
+    return rows
+
+TREEDIFF_CALLS = []
+
+def restore_ete_diff(saved):
+    if saved is None:
+        sys.modules.pop('ete3.tools.ete_diff', None)
+    else:
+        sys.modules['ete3.tools.ete_diff'] = saved
+ETE_DIFF = types.ModuleType('ete3.tools.ete_diff')
+ETE_DIFF.treediff = treediff
+ETE_DIFF.EUCL_DIST = eucl_dist
+
+SOURCE = '((((A,B),(C,D)),((E,F),(G,H))),(((I,J),(K,L)),((M,N),(O,P))));'
+TARGET = '((((A,C),(B,D)),((E,F),(G,H))),(((I,J),(K,L)),((M,N),(P,O))));'
+
+
+class TreeHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        # Only this module is swapped, the modules imported meanwhile must stay loaded
+        saved = sys.modules.get('ete3.tools.ete_diff')
+        sys.modules['ete3.tools.ete_diff'] = ETE_DIFF
+        self.addCleanup(restore_ete_diff, saved)
+        del TREEDIFF_CALLS[:]
+        self.actions = NodeActions()
+        self.actions.add_action('Delete', lambda node: True, lambda tree, node, diff: node.detach())
+        self.delete = [index for index, name, _, _ in self.actions if name == 'Delete'][0]
+        self.compared = 0
+
+    def counting_dist(self, a, b, support, attr1, attr2):
+        self.compared += 1
+        return eucl_dist(a, b, support, attr1, attr2)
+
+    def pair(self, source=SOURCE, target=TARGET, **kargs):
+        h1 = WebTreeHandler(source, '', 'source', self.actions, None)
+        h2 = WebTreeHandler(target, '', 'target', self.actions, None)
+        h1.diff(h2, dist_fn=self.counting_dist, **kargs)
+        return h1, h2
+
+    def mapping(self, h):
+        content = h.tree.get_cached_content(store_attr='name')
+        target = h.diffdict['target']
+        target_content = target.tree.get_cached_content(store_attr='name')
+        mapping = dict()
+        for nid, n in h.nodes.items():
+            entry = h.diffdict['nodes'][nid]
+            mapping[frozenset(content[n])] = (frozenset(target_content[target.nodes[entry['target_nodeid']]]), entry['distance'])
+        return mapping
+
+    def test_node_index(self):
+        h = WebTreeHandler(SOURCE, '', 'source', self.actions, None)
+        self.assertEqual(len(h.nodes), 31)
+        for n in h.tree.traverse():
+            self.assertIs(h.get_node(n._nid), n)
+            self.assertIs(h.get_node(str(n._nid)), n)
+            self.assertEqual(h.parents[n._nid], n.up._nid if n.up else -1)
+        with self.assertRaises(KeyError):
+            h.get_node(31)
+
+    def test_sync_nodes(self):
+        h1, h2 = self.pair(symmetric=True)
+        self.assertFalse(h1.sync_nodes())
+
+        leaf = h1.tree.search_nodes(name='A')[0]
+        removed = leaf._nid
+        matched = [nid for nid, entry in h2.diffdict['nodes'].items() if entry['target_nodeid'] == removed]
+        self.assertTrue(matched)
+        parent = leaf.up
+        leaf.detach()
+        moved = h1.tree.search_nodes(name='P')[0]
+        moved.detach()
+        parent.add_child(moved)
+        added = parent.add_child(name='Q')
+        self.assertTrue(h1.sync_nodes())
+
+        self.assertNotIn(removed, h1.nodes)
+        self.assertNotIn(removed, h1.diffdict['nodes'])
+        self.assertEqual(added._nid, 31)
+        self.assertIs(h1.get_node(31), added)
+        self.assertEqual(h1.parents[31], parent._nid)
+        self.assertEqual(h1.parents[moved._nid], parent._nid)
+        self.assertEqual(h1.topology_version, 1)
+        # Target nodes matched with the removed leaf are left unmatched
+        self.assertEqual([h2.diffdict['nodes'][nid]['target_nodeid'] for nid in matched], [-1] * len(matched))
+
+    def test_symmetric_diff_identical_trees(self):
+        h1, h2 = self.pair(SOURCE, SOURCE, symmetric=True)
+        self.assertEqual(len(TREEDIFF_CALLS), 1)
+        self.assertIs(h1.diffdict['target'], h2)
+        self.assertIs(h2.diffdict['target'], h1)
+        self.assertEqual(h2._diff_params['attr1'], 'name')
+        for nid, entry in h2.diffdict['nodes'].items():
+            self.assertEqual(entry['target_nodeid'], nid)
+            self.assertEqual(entry['distance'], 0)
+
+    def test_symmetric_diff_matches_every_target_node(self):
+        h1, h2 = self.pair(symmetric=True)
+        r2, _ = self.pair(TARGET, SOURCE)
+        forward = WebTreeHandler(SOURCE, '', 'forward', self.actions, None)
+        forward.diff(WebTreeHandler(TARGET, '', 'target', self.actions, None), dist_fn=self.counting_dist)
+        self.assertEqual(self.mapping(h1), self.mapping(forward))
+        for nid, entry in h2.diffdict['nodes'].items():
+            self.assertNotEqual(entry['target_nodeid'], -1)
+            # Derived from the forward treediff, never better than the best match
+            self.assertGreaterEqual(entry['distance'], r2.diffdict['nodes'][nid]['distance'])
+            content = h1.tree.get_cached_content(store_attr='name')[h1.nodes[entry['target_nodeid']]]
+            self.assertEqual(entry['side2'], content)
+
+    def test_symmetric_diff_cache_hit(self):
+        cache = DiffCache(8)
+        h1, h2 = self.pair(symmetric=True, cache=cache)
+        calls = len(TREEDIFF_CALLS)
+        self.compared = 0
+        c1, c2 = self.pair(symmetric=True, cache=cache)
+        self.assertEqual(len(TREEDIFF_CALLS), calls)
+        self.assertEqual(self.compared, 0)
+        self.assertEqual(self.mapping(c1), self.mapping(h1))
+        self.assertEqual(self.mapping(c2), self.mapping(h2))
+        # The reverse comparison reuses both mappings too
+        _, r1 = self.pair(TARGET, SOURCE, symmetric=True, cache=cache)
+        self.assertEqual(len(TREEDIFF_CALLS), calls)
+        self.assertEqual(self.mapping(r1), self.mapping(h1))
+
+    def test_diff_cache_byte_budget(self):
+        h1, h2 = self.pair()
+        rows = [(nid, entry['target_nodeid'], entry['distance'], entry['side1'], entry['side2'], entry['diff'])
+                for nid, entry in h1.diffdict['nodes'].items()]
+        cache = DiffCache(8)
+        cache.put('a', rows)
+        size = cache.memory_usage()
+        self.assertGreater(size, 0)
+        cache = DiffCache(8, max_bytes=size * 2)
+        for key in 'abc':
+            cache.put(key, list(rows))
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('c'), rows)
+        self.assertLessEqual(cache.memory_usage(), size * 2)
+
+    def test_rediff_scores_changed_nodes_only(self):
+        h1, h2 = self.pair(symmetric=True)
+        del TREEDIFF_CALLS[:]
+        self.compared = 0
+        leaf = h1.tree.search_nodes(name='A')[0]
+        changed = set(n._nid for n in leaf.get_ancestors())
+        reset = [nid for nid, entry in h2.diffdict['nodes'].items()
+                 if entry['target_nodeid'] in changed or entry['target_nodeid'] == leaf._nid]
+        h1.run_action(self.delete, leaf._nid)
+
+        # The ancestors of the deleted leaf against every target node, and the target nodes
+        # matched with them or with the deleted leaf against every node left
+        self.assertEqual(TREEDIFF_CALLS, [])
+        self.assertEqual(self.compared, len(changed) * len(h2.nodes) + len(reset) * len(h1.nodes))
+        self.assertLess(self.compared, len(h1.nodes) * len(h2.nodes) // 2)
+
+        f1, f2 = self.pair(h1.tree.write(format=9), TARGET)
+        f2.diff(f1, dist_fn=self.counting_dist)
+        self.assertEqual(self.mapping(h1), self.mapping(f1))
+        distances = lambda h: sorted(entry['distance'] for _, entry in h.diffdict['nodes'].items())
+        self.assertEqual(distances(h2), distances(f2))
+
+    def test_rediff_without_changes(self):
+        h1, h2 = self.pair(symmetric=True)
+        self.compared = 0
+        self.assertEqual(h1.rediff(), 0)
+        self.assertEqual(self.compared, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import io
+import gzip
+import unittest
+
+from ete3_webserver.uploads import Upload, UploadTooLarge, read_multipart
+
+
+def multipart(boundary, fields, files):
+    body = [b'preamble\r\n']
+    for name, value in fields.items():
+        body.append(('--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n%s\r\n' %(boundary, name, value)).encode('utf-8'))
+    for name, (filename, data) in files.items():
+        body.append(('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                     'Content-Type: application/octet-stream\r\n\r\n' %(boundary, name, filename)).encode('utf-8'))
+        body.append(data + b'\r\n')
+    body.append(('--%s--\r\n' %boundary).encode('utf-8'))
+    return io.BytesIO(b''.join(body))
+
+
+class ReadMultipartTest(unittest.TestCase):
+
+    def test_mixed_case_boundary(self):
+        # As sent by browsers, the boundary is case sensitive
+        boundary = '----WebKitFormBoundaryAbCdEfGh12'
+        stream = multipart(boundary, {'treeid1' : 'a'}, {'newick1' : ('t.nw', b'((A,B),C);\r\n')})
+        params = read_multipart(stream, 'multipart/form-data; boundary=%s' %boundary)
+        self.assertEqual(params['treeid1'], 'a')
+        self.assertIsInstance(params['newick1'], Upload)
+        self.assertEqual(params['newick1'].text(), '((A,B),C);')
+
+    def test_gzip_alignment(self):
+        fasta = b'>A\nAC\n>B\nGT\n>Z\nTT\n'
+        stream = multipart('XyZ', {}, {'alg1' : ('a.fa.gz', gzip.compress(fasta))})
+        upload = read_multipart(stream, 'multipart/form-data; boundary="XyZ"')['alg1']
+        self.assertEqual(upload.fasta(['A', 'B']), '>A\nAC\n>B\nGT\n')
+        self.assertTrue(upload.compressed)
+        self.assertEqual(upload.size, len(fasta))
+
+    def test_file_limit_while_spooling(self):
+        stream = multipart('XyZ', {}, {'alg1' : ('a.fa', b'>A\n' + b'A' * 1000)})
+        with self.assertRaises(UploadTooLarge):
+            read_multipart(stream, 'multipart/form-data; boundary=XyZ', max_bytes=100)
+
+    def test_param_limit(self):
+        stream = multipart('XyZ', {'newick1' : 'A' * 1000}, {})
+        with self.assertRaises(UploadTooLarge):
+            read_multipart(stream, 'multipart/form-data; boundary=XyZ', max_bytes=100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,14 @@
 /*  it requires jquery loaded */
 var ete_webplugin_URL = "http://localhost:8989";
 var loading_img = '<img border=0 src="loader.gif">';
+var async_load_chars = 200000; // trees larger than this are loaded as background jobs
+var tiled_view = false; // whether trees are drawn as lazily loaded tiles, for large trees
+var tile_views = {}; // tree id -> tiled view state
+var loaded_trees = []; // source and target tree ids
+var tree_versions = {}; // tree id -> render version of the last drawing shown after an action
+var search_delay = 200; // milliseconds without typing before searching
+var search_timer = null;
+var ete_link = '<div style="margin:0px;padding:0px;text-align:left;"><a href="http://etetoolkit.org" style="font-size:7pt;" target="_blank" >Powered by etetoolkit</a></div>';
 
 function update_server_status(){
   /**
@@ -33,37 +41,387 @@ function get_tree_diff(newick1, recipient1, newick2, recipient2){
   $(recipient2).html('<div id="' + treeid2 + '">' + loading_img + '</div>'); //Loading gif
 
     
-  // Get trees from text
+  // Load, diff and draw both trees in one request, large trees are loaded in the background
   var params = {'newick1':newick1, 'treeid1':treeid1,'newick2':newick2, 'treeid2':treeid2};
+  if (newick1.length + newick2.length > async_load_chars){
+    params['async'] = 1;
+  }
 
-    
-  $.post(ete_webplugin_URL+'/load_trees', params ,
+  $.post(ete_webplugin_URL+'/load_and_draw', params,
       function(e) {
-        
-      // Draw trees
-      var params = {"treeid": treeid1};
-      $('#'+treeid1).load(ete_webplugin_URL+'/draw_tree', params,
-        function() {
-                $('#'+treeid1).fadeTo(0, 0.0);
-                $('#'+treeid1).fadeTo(1000, 1);
-      });
-
-      var params = {"treeid": treeid2};
-      $('#'+treeid2).load(ete_webplugin_URL+'/draw_tree', params,
-        function() {
-                $('#'+treeid2).fadeTo(0, 0.0);
-                $('#'+treeid2).fadeTo(1000, 1);
-      });        
-        
+        if (e.jobid){
+          wait_for_job(e.jobid, function(status) { show_trees(status.result.trees); });
+        } else {
+          show_trees(e.trees);
+        }
+  }, 'json');
+
+}
 
+
+function show_trees(trees){
+  /**
+  Displays the geometry of several trees returned by /load_and_draw
+  
+  Parameters:
+    trees: list of tree node geometry
+  */
+  loaded_trees = [];
+  for (var i = 0; i < trees.length; i++){
+    loaded_trees.push(trees[i].treeid);
+    if (tiled_view){
+      draw_tree_tiles(trees[i].treeid);
+    } else {
+      show_tree_geometry(trees[i]);
+    }
+    $('#'+trees[i].treeid).fadeTo(0, 0.0);
+    $('#'+trees[i].treeid).fadeTo(1000, 1);
+  }
+}
+
+
+function wait_for_job(jobid, callback){
+  /**
+  Polls the status of a background job until it finishes, showing its progress
+  
+  Parameters:
+    jobid: job id
+    callback: function called with the job status once the job is done
+  */
+  $.getJSON(ete_webplugin_URL+'/job_status', {'jobid': jobid},
+      function(status) {
+        if (status.error){
+          $('#server_status').html('Error: ' + status.error);
+        } else if (status.done){
+          update_server_status();
+          callback(status);
+        } else {
+          $('#server_status').html(loading_img + ' ' + status.phase + ' (' + Math.round(status.progress*100) + '%)');
+          setTimeout(function() { wait_for_job(jobid, callback); }, 500);
+        }
   });
+}
 
-    
 
+function draw_tree(treeid){
+  /**
+  Draws a loaded tree into its container
+  
+  Parameters:
+    treeid: tree id, also the id of the element where the tree image will be displayed
+  */
+  if (tiled_view){
+    draw_tree_tiles(treeid);
+    return;
+  }
+  var params = {"treeid": treeid};
+  $.getJSON(ete_webplugin_URL+'/tree_geometry', params,
+    function(geom) {
+            show_tree_geometry(geom);
+            $('#'+treeid).fadeTo(0, 0.0);
+            $('#'+treeid).fadeTo(1000, 1);
+  });
+}
+
+
+function show_tree_geometry(geom){
+  /**
+  Displays a tree image and builds its hit areas from the node geometry returned by the server
+  
+  Parameters:
+    geom: columnar node geometry and diff information, as returned by /tree_geometry
+  */
+  if (tile_views[geom.treeid]){
+    // Tiled trees are redrawn at their current zoom level and position
+    draw_tree_tiles(geom.treeid, tile_views[geom.treeid].zoom);
+    return;
+  }
+  var areas = geom.areas;
+  var nodes = geom.nodes;
+  var node_index = {};
+  for (var j = 0; j < nodes.nid.length; j++){
+    node_index[nodes.nid[j]] = j;
+  }
+
+  var html = ['<map name="' + geom.mapid + '" id="' + geom.mapid + '" class="ete_tree_img">'];
+  for (var i = 0; i < areas.nid.length; i++){
+    html.push('<area shape="rect" coords="' + areas.coords.slice(4*i, 4*i+4).join(',') + '" href="javascript:void(0);" data-area="' + i + '">');
+  }
+  html.push('</map>');
+  html.push('<div id="' + geom.boxid + '" ><img id="' + geom.imgid + '" class="ete_tree_img" usemap="#' + geom.mapid + '" onLoad="javascript:bind_popup();" src="' + (geom.image || ete_webplugin_URL + '/tree_image/' + geom.treeid + '/' + geom.version) + '">' + ete_link + '</div>');
+  $('#'+geom.treeid).html(html.join(''));
+
+  $('#'+geom.mapid).delegate('area', 'mouseover', function() {
+      var i = parseInt($(this).attr('data-area'));
+      var j = node_index[areas.nid[i]];
+      highlight_node(geom.treeid, geom.target_treeid, areas.nid[i], nodes.target_nid[j], areas.text[i],
+                     nodes.box[4*j], nodes.box[4*j+1], nodes.box[4*j+2], nodes.box[4*j+3],
+                     nodes.target_box[4*j], nodes.target_box[4*j+1], nodes.target_box[4*j+2], nodes.target_box[4*j+3],
+                     nodes.dist[j]);
+  }).delegate('area', 'mouseout', function() {
+      hide_diff();
+  }).delegate('area', 'click', function() {
+      var i = parseInt($(this).attr('data-area'));
+      show_actions(geom.treeid, areas.nid[i], areas.text[i]);
+  });
 }
 
 
 
+function focus_node(treeid, nodeid){
+  /**
+  Draws only the clade of a node and its matched clade in the target tree
+  
+  Parameters:
+    treeid: source tree id
+    nodeid: clade root node id
+  */
+  $("#popup").hide();
+  $("#popup2").hide();
+  clear_elements();
+
+  var params = {"treeid": treeid, "nodeid": nodeid};
+  $.post(ete_webplugin_URL+'/subtree_geometry', params,
+    function(e) {
+      var treeids = [e.trees[0].treeid, e.trees[1].treeid];
+      for (var i = 0; i < e.trees.length; i++){
+        // Clades are drawn as plain images, the whole trees keep their tiled view setting
+        delete tile_views[e.trees[i].treeid];
+        show_tree_geometry(e.trees[i]);
+        $('#'+e.trees[i].treeid).append('<div class="ete_focus_tools"><a href="javascript:void(0);" onClick="draw_tree(\'' + treeids[0] +
+                                         '\'); draw_tree(\'' + treeids[1] + '\');">[whole tree]</a></div>');
+      }
+  }, 'json');
+}
+
+
+function draw_tree_tiles(treeid, zoom){
+  /**
+  Draws a loaded tree as a scrollable view whose image tiles and hit areas are only
+  loaded once they become visible
+  
+  Parameters:
+    treeid: tree id, also the id of the element where the tree will be displayed
+    zoom: zoom level, the tree is drawn at 2^zoom times its size, 0 if not given
+  */
+  $.getJSON(ete_webplugin_URL+'/tree_tiles/'+treeid, function(info) {
+    var old = tile_views[treeid];
+    zoom = Math.max(info.min_zoom, Math.min(info.max_zoom, zoom === undefined ? 0 : zoom));
+    var scale = Math.pow(2, zoom);
+    var view = {'info': info, 'zoom': zoom, 'scale': scale, 'loaded': {}};
+    tile_views[treeid] = view;
+
+    $('#'+treeid).html('<div class="ete_tile_tools"><a href="javascript:void(0);" onClick="zoom_tree_tiles(\'' + treeid + '\', 1);">[+]</a> ' +
+                       '<a href="javascript:void(0);" onClick="zoom_tree_tiles(\'' + treeid + '\', -1);">[-]</a></div>' +
+                       '<div id="tiles_' + treeid + '" class="ete_tile_view" style="position:relative; overflow:auto; width:100%; height:600px;">' +
+                       '<div style="position:relative; width:' + Math.ceil(info.width*scale) + 'px; height:' + Math.ceil(info.height*scale) + 'px;"></div></div>' + ete_link);
+
+    var viewport = $('#tiles_'+treeid);
+    if (old){
+      // Keep the center of the view when zooming
+      var ratio = scale / old.scale;
+      viewport.scrollLeft((old.left + old.width/2) * ratio - viewport.width()/2);
+      viewport.scrollTop((old.top + old.height/2) * ratio - viewport.height()/2);
+    }
+    viewport.bind('scroll', function() { load_visible_tiles(treeid); });
+    load_visible_tiles(treeid);
+  });
+}
+
+
+function zoom_tree_tiles(treeid, delta){
+  /**
+  Zooms a tiled tree view in or out
+  
+  Parameters:
+    treeid: tree id
+    delta: zoom level change, as integer
+  */
+  clear_elements();
+  draw_tree_tiles(treeid, tile_views[treeid].zoom + delta);
+}
+
+
+function load_visible_tiles(treeid){
+  /**
+  Loads the image tiles and hit areas of a tiled tree view inside its visible region
+  
+  Parameters:
+    treeid: tree id
+  */
+  var view = tile_views[treeid];
+  var info = view.info;
+  var viewport = $('#tiles_'+treeid);
+  var canvas = viewport.children().first();
+  var size = info.tile_size;
+  view.left = viewport.scrollLeft();
+  view.top = viewport.scrollTop();
+  view.width = viewport.width();
+  view.height = viewport.height();
+
+  var columns = Math.ceil(info.width * view.scale / size);
+  var rows = Math.ceil(info.height * view.scale / size);
+  for (var y = Math.floor(view.top/size); y <= Math.min(rows-1, Math.floor((view.top+view.height)/size)); y++){
+    for (var x = Math.floor(view.left/size); x <= Math.min(columns-1, Math.floor((view.left+view.width)/size)); x++){
+      if (view.loaded[x+'_'+y]){
+        continue;
+      }
+      view.loaded[x+'_'+y] = true;
+      var path = '/' + info.version + '/' + view.zoom + '/' + x + '/' + y;
+      var mapid = 'tilemap_' + treeid + '_' + x + '_' + y;
+      canvas.append('<map name="' + mapid + '" id="' + mapid + '"></map>' +
+                    '<img class="ete_tree_img" usemap="#' + mapid + '" style="position:absolute; left:' + x*size + 'px; top:' + y*size + 'px; border:0;"' +
+                    ' width="' + size + '" height="' + size + '" src="' + ete_webplugin_URL + '/tree_tile/' + treeid + path + '">');
+      $.getJSON(ete_webplugin_URL+'/tree_tile_geometry/' + treeid + path, function(geom) { show_tile_geometry(geom); });
+    }
+  }
+}
+
+
+function show_tile_geometry(geom){
+  /**
+  Builds the hit areas of a tree image tile from its node geometry
+  
+  Parameters:
+    geom: columnar node geometry and diff information, as returned by /tree_tile_geometry
+  */
+  var view = tile_views[geom.treeid];
+  if (!view || view.zoom != geom.zoom){
+    return;
+  }
+  var areas = geom.areas;
+  var nodes = geom.nodes;
+  var node_index = {};
+  for (var j = 0; j < nodes.nid.length; j++){
+    node_index[nodes.nid[j]] = j;
+  }
+
+  // Area coordinates are relative to the tile
+  var x0 = geom.x * geom.tile_size;
+  var y0 = geom.y * geom.tile_size;
+  var html = [];
+  for (var i = 0; i < areas.nid.length; i++){
+    var c = areas.coords.slice(4*i, 4*i+4);
+    html.push('<area shape="rect" coords="' + [Math.round(c[0]*view.scale-x0), Math.round(c[1]*view.scale-y0),
+                                               Math.round(c[2]*view.scale-x0), Math.round(c[3]*view.scale-y0)].join(',') +
+              '" href="javascript:void(0);" data-area="' + i + '">');
+  }
+  var mapid = 'tilemap_' + geom.treeid + '_' + geom.x + '_' + geom.y;
+  $('#'+mapid).html(html.join(''));
+
+  $('#'+mapid).delegate('area', 'mouseover', function() {
+      var i = parseInt($(this).attr('data-area'));
+      var j = node_index[areas.nid[i]];
+      highlight_node(geom.treeid, geom.target_treeid, areas.nid[i], nodes.target_nid[j], areas.text[i],
+                     nodes.box[4*j], nodes.box[4*j+1], nodes.box[4*j+2], nodes.box[4*j+3],
+                     nodes.target_box[4*j], nodes.target_box[4*j+1], nodes.target_box[4*j+2], nodes.target_box[4*j+3],
+                     nodes.dist[j]);
+  }).delegate('area', 'mouseout', function() {
+      hide_diff();
+  }).delegate('area', 'click', function() {
+      var i = parseInt($(this).attr('data-area'));
+      show_actions(geom.treeid, areas.nid[i], areas.text[i]);
+  });
+  bind_popup();
+}
+
+
+function view_box(treeid, x, y, width, height){
+  /**
+  Converts a box of the tree image to the current position of the tree element,
+  scaling and scrolling it for tiled views
+  
+  Parameters:
+    treeid: tree id
+    x: x origin of the box in the tree image
+    y: y origin of the box in the tree image
+    width: width of the box
+    height: height of the box
+
+  Returns:
+    list: x, y, width and height of the box relative to the tree element
+  */
+  var view = tile_views[treeid];
+  if (!view){
+    return [x, y, width, height];
+  }
+  var viewport = $('#tiles_'+treeid);
+  var dx = viewport.offset().left - $('#'+treeid).offset().left - viewport.scrollLeft();
+  var dy = viewport.offset().top - $('#'+treeid).offset().top - viewport.scrollTop();
+  return [x*view.scale + dx, y*view.scale + dy, width*view.scale, height*view.scale];
+}
+
+
+function search_tree(query){
+  /**
+  Searches the source tree nodes as the user types, once typing pauses
+  
+  Parameters:
+    query: searched node name
+  */
+  clearTimeout(search_timer);
+  search_timer = setTimeout(function() { search_nodes(query); }, search_delay);
+}
+
+
+function search_nodes(query){
+  /**
+  Lists the source tree nodes whose name contains the query, hovering a node highlights
+  it and its matched target node
+  
+  Parameters:
+    query: searched node name
+  */
+  if (!loaded_trees.length || !query){
+    $('#search_results').html('');
+    return;
+  }
+  var params = {"treeid": loaded_trees[0], "q": query, "limit": 20};
+  $.getJSON(ete_webplugin_URL+'/search', params, function(result) {
+    if (result.query != $('#search').val().replace(/^\s+|\s+$/g, '')){
+      return; // outdated response
+    }
+    var m = result.matches;
+    var html = ['<ul class="ete_search_list">'];
+    for (var i = 0; i < m.nid.length; i++){
+      html.push('<li><a href="javascript:void(0);" data-match="' + i + '">' + $('<div/>').text(m.name[i] || m.nid[i]).html() + '</a></li>');
+    }
+    html.push('</ul>');
+    if (result.total > m.nid.length){
+      html.push('<div>' + (result.total - m.nid.length) + ' more</div>');
+    }
+    $('#search_results').html(html.join(''));
+
+    $('#search_results').find('a').bind('mouseover', function() {
+        var i = parseInt($(this).attr('data-match'));
+        highlight_node(result.treeid, result.target_treeid, m.nid[i], m.target_nid[i], '',
+                       m.box[4*i], m.box[4*i+1], m.box[4*i+2], m.box[4*i+3],
+                       m.target_box[4*i], m.target_box[4*i+1], m.target_box[4*i+2], m.target_box[4*i+3],
+                       m.dist[i]);
+    }).bind('mouseout', function() {
+        hide_diff();
+    }).bind('click', function() {
+        var i = parseInt($(this).attr('data-match'));
+        show_actions(result.treeid, m.nid[i], '');
+    });
+  });
+}
+
+
+function cancel_search(){
+  /**
+  Clears the node search box and its results
+  
+  Parameters:
+    None
+  */
+  clearTimeout(search_timer);
+  $('#search').val('');
+  $('#search_results').html('');
+  unhighlight_node();
+}
+
+
 function run_action(treeid1, treeid2, nodeid1, nodeid2, faceid, aindex){
   /**
   Runs action on both trees and updates their images and updates server status
@@ -83,24 +441,88 @@ function run_action(treeid1, treeid2, nodeid1, nodeid2, faceid, aindex){
   
   clear_elements();
     
-  var params = {"treeid": treeid1, "nodeid": nodeid1, "side" : "source", "faceid": faceid, "aindex": aindex};
-  $('#'+treeid1).load(ete_webplugin_URL+'/run_action', params,
-    function() {
+  // Actions queued on the same trees are applied together by the server, which answers
+  // every request with the drawing of the latest tree version
+  var params = {"treeid": treeid1, "nodeid": nodeid1, "side" : "source", "faceid": faceid, "aindex": aindex, "format": "json"};
+  $.post(ete_webplugin_URL+'/run_action', params,
+    function(geom) {
       console.log('run action');
-            $('#'+treeid1).fadeTo(0, 1);
-  });
+            show_changed_tree(geom);
+  }, 'json');
     
-  var params = {"treeid": treeid2, "nodeid": nodeid1, "side" : "target", "faceid": faceid, "aindex": aindex};
-  $('#'+treeid2).load(ete_webplugin_URL+'/run_action', params,
-    function() {
+  var params = {"treeid": treeid2, "nodeid": nodeid1, "side" : "target", "faceid": faceid, "aindex": aindex, "format": "json"};
+  $.post(ete_webplugin_URL+'/run_action', params,
+    function(geom) {
       console.log('run action');
-            $('#'+treeid2).fadeTo(0, 1);
-  });
+            show_changed_tree(geom);
+  }, 'json');
     
   $('#server_status').load(ete_webplugin_URL+"/status");
 }
 
 
+function expand_node(treeid, nodeid){
+  /**
+  Expands a collapsed clade and updates the tree image
+  
+  Parameters:
+    treeid: tree id
+    nodeid: collapsed node id
+  */
+  change_level_of_detail('/expand_node', treeid, nodeid);
+}
+
+
+function collapse_node(treeid, nodeid){
+  /**
+  Collapses a clade and updates the tree image
+  
+  Parameters:
+    treeid: tree id
+    nodeid: node id
+  */
+  change_level_of_detail('/collapse_node', treeid, nodeid);
+}
+
+
+function change_level_of_detail(path, treeid, nodeid){
+  /**
+  Expands or collapses a clade and updates the tree image
+  
+  Parameters:
+    path: /expand_node or /collapse_node
+    treeid: tree id
+    nodeid: node id
+  */
+  $("#popup").hide();
+  $("#popup2").hide();
+  clear_elements();
+
+  var params = {"treeid": treeid, "nodeid": nodeid, "format": "json"};
+  $.post(ete_webplugin_URL+path, params,
+    function(geom) {
+            show_changed_tree(geom);
+  }, 'json');
+}
+
+
+function show_changed_tree(geom){
+  /**
+  Displays a tree modified by an action, unless the drawing of a later version of the tree
+  was already shown, as responses to queued actions may arrive out of order
+  
+  Parameters:
+    geom: node geometry, as returned by /run_action
+  */
+  if (geom.version < (tree_versions[geom.treeid] || 0)){
+    return;
+  }
+  tree_versions[geom.treeid] = geom.version;
+  show_tree_geometry(geom);
+  $('#'+geom.treeid).fadeTo(0, 1);
+}
+
+
 function show_actions(treeid, nodeid, faceid){
   /**
   Shows available actions for selected node
@@ -207,6 +629,11 @@ function highlight_node(treeid1, treeid2, nodeid1, nodeid2, faceid, x1, y1, widt
 
     console.log(treeid1, treeid2, nodeid1, nodeid2, faceid, x1, y1, width1, height1, x2, y2, width2, height2, dist);
     if (dist < 1){
+        var box1 = view_box(treeid1, x1, y1, width1, height1);
+        var box2 = view_box(treeid2, x2, y2, width2, height2);
+        x1 = box1[0]; y1 = box1[1]; width1 = box1[2]; height1 = box1[3];
+        x2 = box2[0]; y2 = box2[1]; width2 = box2[2]; height2 = box2[3];
+
         var img1 = $('#'+treeid1);
         var offset1 = img1.offset();
         console.log(img1);
@@ -277,6 +704,10 @@ function clear_all(){
     hide_popup();
     hide_diff();
     unhighlight_node();
+    tile_views = {};
+    loaded_trees = [];
+    tree_versions = {};
+    cancel_search();
     $(".column").html("");
 }
 